@@ -0,0 +1,57 @@
+"""Compare archive codecs on a study directory.
+
+    python benchmarks/bench_compression.py /tmp/dicom_storage/<study> --workers 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from compression import ENGINES, write_archive, zstandard
+
+
+class NullWriter(io.RawIOBase):
+    """Discard output so the benchmark measures compression, not the disk."""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+
+def run(source_dir, codecs, workers, level=None):
+    """Compress ``source_dir`` once per codec/worker count and return the reports."""
+    reports = []
+    for codec in codecs:
+        for worker_count in sorted({1, workers}):
+            report = write_archive(source_dir, NullWriter(), codec=codec, level=level, workers=worker_count)
+            report['workers'] = worker_count
+            reports.append(report)
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archive codec throughput benchmark')
+    parser.add_argument('source_dir', help='Study directory to compress')
+    parser.add_argument('--codecs', nargs='+', default=[c for c in ENGINES if c != 'zstd' or zstandard])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    args = parser.parse_args()
+
+    reports = run(args.source_dir, args.codecs, args.workers, args.level)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    print(f"{'codec':<8}{'workers':>8}{'MB in':>10}{'MB out':>10}{'ratio':>8}{'MB/s':>10}")
+    for r in reports:
+        print(f"{r['codec']:<8}{r['workers']:>8}{r['bytes_in'] / 1e6:>10.1f}{r['bytes_out'] / 1e6:>10.1f}"
+              f"{r['ratio']:>8.2f}{r['mb_per_s']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
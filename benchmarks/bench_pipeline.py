@@ -0,0 +1,273 @@
+"""End-to-end load test: SCU associations -> DICOMServer -> archive -> HTTP sink, over loopback.
+
+    python benchmarks/bench_pipeline.py --studies 1xCR,300xCT,3000xMR --associations 8 \\
+        --transfer-syntaxes implicit explicit deflated --output results.json
+
+Synthetic studies are generated and sent from worker processes, so the
+server process's peak RSS and CPU are not inflated by the load generator.
+Uploads go to a local aiohttp sink that records when each archive arrived.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from aiohttp import web
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, generate_uid
+
+from dicom_server import DICOMServer
+from synthetic import SOP_CLASSES, free_port, make_instance, parse_shape
+
+TRANSFER_SYNTAXES = {
+    'implicit': ImplicitVRLittleEndian,
+    'explicit': ExplicitVRLittleEndian,
+    'deflated': DeflatedExplicitVRLittleEndian,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def plan(shape, associations, transfer_syntaxes):
+    """Split every study into per-association batches of ``(study, series, modality, ts, first, count)``."""
+    batches = [[] for _ in range(associations)]
+    studies = {}
+    slot = 0
+    for count, modality in shape:
+        study_uid, series_uid = generate_uid(), generate_uid()
+        transfer_syntax = TRANSFER_SYNTAXES[transfer_syntaxes[len(studies) % len(transfer_syntaxes)]]
+        studies[study_uid] = {'modality': modality, 'instances': count, 'transfer_syntax': str(transfer_syntax)}
+        share, extra = divmod(count, associations)
+        first = 0
+        for n in range(associations):
+            size = share + (1 if n < extra else 0)
+            if size:
+                batches[(slot + n) % associations].append(
+                    (study_uid, series_uid, modality, str(transfer_syntax), first, size))
+                first += size
+        slot += 1
+    return [batch for batch in batches if batch], studies
+
+
+def send_batch(port, batch):
+    """Worker process: send one association's share and return per-instance timings."""
+    from pynetdicom import AE
+
+    ae = AE(ae_title="BENCHSCU")
+    for modality in {item[2] for item in batch}:
+        for transfer_syntax in {item[3] for item in batch}:
+            ae.add_requested_context(SOP_CLASSES[modality], transfer_syntax)
+    assoc = ae.associate("127.0.0.1", port, ae_title="BOUNCE")
+    if not assoc.is_established:
+        raise RuntimeError("Association rejected or aborted")
+
+    latencies, last_sent, sent_bytes, failures = [], {}, 0, 0
+    templates = {}
+    began = time.time()
+    try:
+        for study_uid, series_uid, modality, transfer_syntax, first, count in batch:
+            for number in range(first, first + count):
+                key = (study_uid, modality)
+                if key not in templates:
+                    templates[key] = make_instance(study_uid, series_uid, modality)
+                    templates[key].file_meta = FileMetaDataset()
+                    templates[key].file_meta.TransferSyntaxUID = transfer_syntax
+                ds = templates[key]
+                ds.SOPInstanceUID = generate_uid()
+                ds.InstanceNumber = number + 1
+                started = time.perf_counter()
+                status = assoc.send_c_store(ds)
+                latencies.append(time.perf_counter() - started)
+                if not status or status.Status != 0x0000:
+                    failures += 1
+                sent_bytes += len(ds.PixelData)
+                last_sent[study_uid] = time.time()
+    finally:
+        assoc.release()
+    return latencies, last_sent, sent_bytes, failures, began
+
+
+async def start_sink(port, received):
+    """Stand-in destination that drains multipart uploads and notes when each study arrived."""
+
+    async def upload(request):
+        size, filename = 0, None
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'file':
+                filename = part.filename
+                while chunk := await part.read_chunk(1024 * 1024):
+                    size += len(chunk)
+            else:
+                await part.read()
+        study_uid = filename.split('.tar')[0].split('.delta')[0]
+        received[study_uid] = {'completed': time.time(), 'bytes': size}
+        return web.json_response({'status': 'ok'})
+
+    app = web.Application(client_max_size=1 << 40)
+    app.router.add_post('/upload', upload)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def run(args):
+    shape = parse_shape(args.studies)
+    batches, studies = plan(shape, args.associations, args.transfer_syntaxes)
+    base_dir = tempfile.mkdtemp(prefix="bounce-bench-")
+    dicom_port, sink_port = free_port(), free_port()
+    received = {}
+    sink = await start_sink(sink_port, received)
+    config = {
+        'dicom': {'host': '127.0.0.1', 'port': dicom_port, 'workers': args.workers},
+        'timeout': args.timeout,
+        'transmission': {'api_endpoint': f"http://127.0.0.1:{sink_port}/upload", 'api_key': "bench",
+                         'streaming': args.stream, 'workers': args.upload_workers},
+        'storage': {'base_dir': base_dir, 'raw_write': args.raw_write,
+                    'incremental_archive': args.incremental_archive},
+        'compression': {'codec': args.codec, 'workers': args.compress_workers},
+        'delete_after_send': True,
+    }
+    server = DICOMServer(config)
+    server.ae.maximum_associations = max(10, args.associations)
+    await server.start_outbound()
+    server.start_in_thread()
+    await asyncio.sleep(0.2 if args.workers == 1 else 3)  # Receiver processes need to import and bind
+
+    loop = asyncio.get_running_loop()
+    context = multiprocessing.get_context("spawn")
+    try:
+        with context.Pool(len(batches)) as pool:
+            results = await loop.run_in_executor(None, pool.starmap, send_batch,
+                                                 [(dicom_port, batch) for batch in batches])
+        sent = time.time()
+        deadline = sent + args.timeout + args.drain_timeout
+        while len(received) < len(studies) and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        finished = time.time()
+    finally:
+        server.shutdown()
+        await server.close()
+        await sink.cleanup()
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    # Measured from the first C-STORE, leaving out worker start-up and association negotiation
+    started = min(result[4] for result in results)
+    latencies = [latency for result in results for latency in result[0]]
+    last_sent = {}
+    for result in results:
+        for study_uid, when in result[1].items():
+            last_sent[study_uid] = max(when, last_sent.get(study_uid, 0))
+    sent_bytes = sum(result[2] for result in results)
+    to_upload = [received[uid]['completed'] - last_sent[uid] for uid in studies if uid in received]
+    instances = len(latencies)
+
+    return {
+        'commit': git_commit(),
+        'config': {
+            'studies': args.studies, 'associations': args.associations, 'transfer_syntaxes': args.transfer_syntaxes,
+            'timeout': args.timeout, 'workers': args.workers, 'codec': args.codec, 'compress_workers': args.compress_workers,
+            'stream': args.stream, 'raw_write': args.raw_write, 'incremental_archive': args.incremental_archive,
+        },
+        'instances': instances,
+        'failed_instances': sum(result[3] for result in results),
+        'studies': len(studies),
+        'studies_delivered': len(received),
+        'send_seconds': sent - started,
+        'instances_per_s': instances / (sent - started),
+        'mb_per_s': sent_bytes / 1e6 / (sent - started),
+        'cstore_latency_ms': {'p50': ms(percentile(latencies, 0.5)), 'p99': ms(percentile(latencies, 0.99)),
+                              'max': ms(max(latencies, default=None))},
+        # Includes the debounce timeout; after_timeout subtracts it
+        'last_instance_to_upload_s': {
+            'p50': percentile(to_upload, 0.5), 'max': max(to_upload, default=None),
+            'p50_after_timeout': sub(percentile(to_upload, 0.5), args.timeout),
+            'max_after_timeout': sub(max(to_upload, default=None), args.timeout),
+        },
+        'uploaded_mb': sum(entry['bytes'] for entry in received.values()) / 1e6,
+        'total_seconds': finished - started,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+def sub(value, offset):
+    return value - offset if value is not None else None
+
+
+COMPARED = (('instances_per_s',), ('mb_per_s',), ('cstore_latency_ms', 'p50'), ('cstore_latency_ms', 'p99'),
+            ('last_instance_to_upload_s', 'p50_after_timeout'), ('peak_rss_mb',))
+
+
+def compare(baseline, results):
+    """Print the relative change of the headline numbers against an earlier run."""
+    print(f"{'metric':<42}{'baseline':>12}{'current':>12}{'change':>9}", file=sys.stderr)
+    for path in COMPARED:
+        before, after = baseline, results
+        for key in path:
+            before, after = (before or {}).get(key), (after or {}).get(key)
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else "n/a"
+        print(f"{'.'.join(path):<42}{before or 0:>12.2f}{after or 0:>12.2f}{change:>9}", file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput and latency benchmark')
+    parser.add_argument('--studies', default='1xCR,300xCT,1000xMR',
+                        help='Study mix as <instances>x<modality>, comma separated (modalities: CR, CT, MR, US)')
+    parser.add_argument('--associations', type=int, default=4, help='Concurrent SCU associations')
+    parser.add_argument('--transfer-syntaxes', nargs='+', default=['explicit'], choices=sorted(TRANSFER_SYNTAXES),
+                        help='Transfer syntaxes, assigned to studies round-robin')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Study quiet timeout in seconds')
+    parser.add_argument('--drain-timeout', type=float, default=300, help='Seconds to wait for uploads to finish')
+    parser.add_argument('--workers', type=int, default=1, help='Receiver processes (SO_REUSEPORT)')
+    parser.add_argument('--codec', default='gzip')
+    parser.add_argument('--compress-workers', type=int, default=1)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--raw-write', action='store_true')
+    parser.add_argument('--incremental-archive', action='store_true')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
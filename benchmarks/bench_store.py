@@ -0,0 +1,61 @@
+"""Instances per second through DICOMServer.handle_store, decode/re-encode vs raw write.
+
+    python benchmarks/bench_store.py --modality CT --instances 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pydicom.uid import generate_uid
+from dicom_server import DICOMServer
+from synthetic import encode, make_instance, make_store_event
+
+
+def run(mode, datasets, encoded):
+    """Store every instance once and return instances per second."""
+    with tempfile.TemporaryDirectory() as base_dir:
+        config = {'storage': {'base_dir': base_dir, 'raw_write': mode == 'raw'}, 'timeout': 3600}
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = DICOMServer(config)
+        # Fresh events each run so nothing is served from pynetdicom's decode cache
+        events = [make_store_event(ds, raw=raw) for ds, raw in zip(datasets, encoded)]
+        started = time.perf_counter()
+        for event in events:
+            assert server.handle_store(event) == 0x0000
+        elapsed = time.perf_counter() - started
+        # Stop the writer, index and spool threads so they do not run into the next measurement
+        loop.run_until_complete(server.close())
+        loop.close()
+    return len(events) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='C-STORE write path benchmark')
+    parser.add_argument('--modality', default='CT')
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    args = parser.parse_args()
+
+    study_uid, series_uid = generate_uid(), generate_uid()
+    datasets = [make_instance(study_uid, series_uid, args.modality, n) for n in range(args.instances)]
+    encoded = [encode(ds) for ds in datasets]
+
+    results = {mode: run(mode, datasets, encoded) for mode in ('decode', 'raw')}
+    results['speedup'] = results['raw'] / results['decode']
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"decode + save_as: {results['decode']:8.1f} instances/s")
+        print(f"raw write:        {results['raw']:8.1f} instances/s ({results['speedup']:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
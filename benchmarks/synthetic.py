@@ -0,0 +1,96 @@
+"""Synthetic DICOM instances and C-STORE events for the benchmarks and tests."""
+import os
+import socket
+import zlib
+from io import BytesIO
+from unittest.mock import MagicMock
+
+from pydicom.dataset import Dataset
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.uid import (CTImageStorage, ComputedRadiographyImageStorage, ExplicitVRLittleEndian, MRImageStorage, UID,
+                         UltrasoundImageStorage, generate_uid)
+from pynetdicom import evt
+from pynetdicom.dimse_primitives import C_STORE
+from pynetdicom.events import Event
+from pynetdicom.presentation import build_context
+
+SOP_CLASSES = {
+    'CR': ComputedRadiographyImageStorage,
+    'CT': CTImageStorage,
+    'MR': MRImageStorage,
+    'US': UltrasoundImageStorage,
+}
+
+# Typical matrix sizes per modality (rows, columns)
+MATRIX = {'CR': (2048, 2500), 'CT': (512, 512), 'MR': (256, 256), 'US': (480, 640)}
+
+
+def make_instance(study_uid, series_uid, modality='CT', number=1, rows=None, columns=None, noise=0.2):
+    """Build an uncompressed 16-bit image dataset of a plausible size for ``modality``."""
+    default_rows, default_columns = MATRIX[modality]
+    rows, columns = rows or default_rows, columns or default_columns
+    ds = Dataset()
+    ds.SOPClassUID = SOP_CLASSES[modality]
+    ds.SOPInstanceUID = generate_uid()
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = modality
+    ds.PatientName = "BENCH^SYNTHETIC"
+    ds.PatientID = "BENCH"
+    ds.InstanceNumber = number
+    ds.Rows, ds.Columns = rows, columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+    # Smooth background plus a fraction of random bytes, roughly like real images
+    size = rows * columns * 2
+    noisy = int(size * noise)
+    ds.PixelData = os.urandom(noisy) + bytes(size - noisy)
+    return ds
+
+
+def encode(ds, transfer_syntax=ExplicitVRLittleEndian):
+    """Encode a dataset as it would arrive in a C-STORE request."""
+    transfer_syntax = UID(transfer_syntax)
+    fp = DicomBytesIO()
+    fp.is_little_endian = transfer_syntax.is_little_endian
+    fp.is_implicit_VR = transfer_syntax.is_implicit_VR
+    write_dataset(fp, ds)
+    raw = fp.getvalue()
+    if transfer_syntax.is_deflated:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(raw) + compressor.flush()
+    return raw
+
+
+def make_store_event(ds, transfer_syntax=ExplicitVRLittleEndian, raw=None):
+    """Return a pynetdicom C-STORE ``Event`` as an SCP handler would receive it."""
+    request = C_STORE()
+    request.AffectedSOPClassUID = ds.SOPClassUID
+    request.AffectedSOPInstanceUID = ds.SOPInstanceUID
+    request.DataSet = BytesIO(raw if raw is not None else encode(ds, transfer_syntax))
+    context = build_context(ds.SOPClassUID, transfer_syntax)
+    context.context_id = 1
+    assoc = MagicMock()
+    assoc.requestor.ae_title = "SYNTHETIC"
+    return Event(assoc, evt.EVT_C_STORE, {'request': request, 'context': context.as_tuple})
+
+
+def free_port():
+    """A TCP port on localhost that nothing listens on right now."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_shape(shape):
+    """Parse a study mix such as ``"1xCR,300xCT"`` into ``[(1, 'CR'), (300, 'CT')]``."""
+    studies = []
+    for item in shape.split(','):
+        count, _, modality = item.strip().lower().partition('x')
+        modality = modality.upper()
+        if modality not in SOP_CLASSES:
+            raise ValueError(f"Unknown modality {modality!r}; expected one of {sorted(SOP_CLASSES)}")
+        studies.append((int(count), modality))
+    return studies
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+import uuid
+
+import metrics
+import pipeline as stages
+import tracing
+from compression import MANIFEST_NAME, compression_report, get_engine, is_precompressed, open_engine
+from encryption import EncryptingWriter
+from http_client import destination_key
+from instance_index import file_sha256
+from retry import TransmissionError
+from transmission import post_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STUDY_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_STUDIES = 100
+DEFAULT_MAX_AGE = 5.0
+
+# Per-study statuses in the destination's reply that mean the study was accepted
+ACCEPTED = frozenset(('ok', 'accepted', 'stored', 'success', 'duplicate'))
+
+
+class StudyBatcher:
+    """Collects small ready studies and sends them together as one archive.
+
+    Studies of at most ``study_bytes`` are held until the batch reaches
+    ``max_bytes`` or ``max_studies`` or its first study has waited
+    ``max_age`` seconds. ``send(study_ids, on_state)`` delivers a batch
+    and returns ``{study_id: delivered}``; each study's ``on_done`` is then
+    called with its own result, so a study the destination rejected is
+    retried on its own schedule while the rest of its batch is done.
+    Must be used from the event loop.
+    """
+
+    def __init__(self, send, study_bytes=DEFAULT_STUDY_BYTES, max_bytes=DEFAULT_MAX_BYTES,
+                 max_studies=DEFAULT_MAX_STUDIES, max_age=DEFAULT_MAX_AGE):
+        self.send = send
+        self.study_bytes = study_bytes
+        self.max_bytes = max_bytes
+        self.max_studies = max_studies
+        self.max_age = max_age
+        self.pending = []  # (study_id, on_state, on_done)
+        self.pending_bytes = 0
+        self.timer = None
+        self.tasks = set()
+
+    def accepts(self, study):
+        """Whether a study's journal entry is small enough to be batched."""
+        return study is not None and 0 < (study.get('bytes') or 0) <= self.study_bytes
+
+    def add(self, study_id, study, on_state, on_done):
+        self.pending.append((study_id, on_state, on_done))
+        self.pending_bytes += study['bytes']
+        if len(self.pending) >= self.max_studies or self.pending_bytes >= self.max_bytes:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_age, self.flush)
+
+    def flush(self):
+        """Send what has been collected now."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending, self.pending_bytes = self.pending, [], 0
+        task = asyncio.ensure_future(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        def on_state(state):
+            for _, study_on_state, _ in batch:
+                study_on_state(state)
+
+        study_ids = [study_id for study_id, _, _ in batch]
+        metrics.BATCH_STUDIES.observe(len(study_ids))
+        try:
+            results = await self.send(study_ids, on_state)
+        except Exception as e:
+            logger.error(f"Failed to send a batch of {len(study_ids)} studies: {e}")
+            results = {}
+        for study_id, _, on_done in batch:
+            on_done(bool(results.get(study_id)))
+
+    async def stop(self):
+        """Stop without sending; collected studies stay ready in the journal and are recovered on restart."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending, self.pending_bytes = [], 0
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def study_files(study_path):
+    """Relative paths of a study's instances, skipping the storage writer's dot-files."""
+    files = []
+    for root, dirs, names in os.walk(study_path):
+        dirs.sort()
+        for name in sorted(names):
+            if not name.startswith('.'):
+                files.append(os.path.relpath(os.path.join(root, name), study_path))
+    return files
+
+
+def batch_manifest(studies):
+    """Describe a batch: per study its directory in the archive, its files with their SHA-256, and a study digest.
+
+    ``studies`` is a list of ``(study_id, study_path, delta)``; a ``delta``
+    from ``instance_index.plan_delta`` limits a study to its new files.
+    The study digest is the SHA-256 of its ``"<path> <sha256>\\n"`` lines, so
+    the destination can verify each study on its own.
+    """
+    entries = []
+    for study_id, study_path, delta in studies:
+        files = delta[0] if delta is not None else study_files(study_path)
+        instances = [{'path': rel_path, 'sha256': file_sha256(os.path.join(study_path, rel_path))}
+                     for rel_path in files]
+        digest = hashlib.sha256("".join(f"{i['path']} {i['sha256']}\n" for i in instances).encode())
+        entries.append({'study_instance_uid': study_id, 'directory': study_id, 'delta': delta is not None,
+                        'sha256': digest.hexdigest(), 'instances': instances})
+    return {'batch': True, 'studies': entries}
+
+
+def write_batch_archive(studies, fileobj, codec="gzip", level=None, workers=1, codec_aware=True):
+    """Write several studies into one compressed tar and return a compression report.
+
+    ``manifest.json`` (see ``batch_manifest``) comes first, then each study
+    under ``./<study_id>/`` laid out like a single-study archive.
+    """
+    manifest = batch_manifest(studies)
+    engine = open_engine(fileobj, codec, level, workers)
+    started = time.monotonic()
+    with tarfile.open(fileobj=engine, mode="w") as tar:
+        data = json.dumps(manifest, indent=2).encode()
+        tarinfo = tarfile.TarInfo(os.path.join(os.curdir, MANIFEST_NAME))
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tar.addfile(tarinfo, io.BytesIO(data))
+        for (study_id, study_path, _), entry in zip(studies, manifest['studies']):
+            for instance in entry['instances']:
+                file_path = os.path.join(study_path, instance['path'])
+                engine.set_compressible(not (codec_aware and is_precompressed(file_path)))
+                tar.add(file_path, arcname=os.path.join(os.curdir, study_id, instance['path']))
+        engine.set_compressible(True)
+    engine.close()
+
+    report = compression_report(engine.name, engine.bytes_in, engine.bytes_out, time.monotonic() - started)
+    metrics.observe_compression(report)
+    return report
+
+
+def _write_batch_file(studies, archive_path, compression, encryption_key=None):
+    with open(archive_path, 'wb') as archive_file:
+        sink = EncryptingWriter(archive_file, encryption_key) if encryption_key else archive_file
+        report = write_batch_archive(studies, sink, **(compression or {}))
+        if encryption_key:
+            sink.close()
+        return report
+
+
+def batch_results(response, study_ids):
+    """Map the destination's reply to a batch onto ``{study_id: delivered}``.
+
+    The destination answers ``{"studies": {"<uid>": {"status": "ok"}, ...}}``
+    (a list of objects with ``study_instance_uid``, or a bare status or
+    boolean per study, works too). A study missing from the reply was not
+    delivered; a reply without per-study results accepts the whole batch.
+    """
+    results = response.get('studies') if isinstance(response, dict) else None
+    if results is None:
+        return dict.fromkeys(study_ids, True)
+    if isinstance(results, list):
+        results = {result.get('study_instance_uid'): result for result in results if isinstance(result, dict)}
+
+    def accepted(result):
+        if isinstance(result, dict):
+            result = result.get('status', result.get('ok'))
+        if isinstance(result, str):
+            return result.lower() in ACCEPTED
+        return bool(result)
+
+    return {study_id: accepted(results.get(study_id)) for study_id in study_ids}
+
+
+async def send_batch(api_endpoint, api_key, studies, work_dir, compression=None, encryption_key=None, client=None,
+                     policy=None, on_state=None, pipeline=None):
+    """Archive ``studies`` (``(study_id, study_path, delta)``) together and upload them in one request.
+
+    The archive is written to ``work_dir`` (in the compress stage of
+    ``pipeline``, if given), posted like a single-study archive and
+    removed afterwards. Returns ``{study_id: delivered}``
+    (see ``batch_results``); a failed request fails every study in it.
+    """
+    on_state = on_state or (lambda state: None)
+    study_ids = [study_id for study_id, _, _ in studies]
+    compression = compression or {}
+    engine = get_engine(compression.get('codec', 'gzip'))
+    batch = f"batch-{uuid.uuid4().hex}"
+    archive_path = os.path.join(work_dir, f"{batch}{engine.extension}{'.enc' if encryption_key else ''}")
+    content_type = 'application/octet-stream' if encryption_key else engine.content_type
+    try:
+        on_state('compressing')
+        with tracing.span(tracing.COMPRESS, batch=batch, studies=len(studies)):
+            report = await stages.run(pipeline, stages.COMPRESS, _write_batch_file, studies, archive_path,
+                                      compression, encryption_key)
+        if pipeline is not None and pipeline[stages.COMPRESS].kind == stages.PROCESS:
+            # Observed in the worker process, where nobody scrapes it
+            metrics.observe_compression(report)
+
+        on_state('sending')
+        size = os.path.getsize(archive_path)
+        async with stages.slot(pipeline, stages.UPLOAD):
+            started = time.monotonic()
+            response = await post_file(api_endpoint, api_key, archive_path, client=client, policy=policy,
+                                       multipart=True, content_type=content_type, pipeline=pipeline)
+            seconds = time.monotonic() - started
+        metrics.observe_upload(destination_key(api_endpoint), 'batch', size, seconds)
+        results = batch_results(response, study_ids)
+        for study_id in study_ids:
+            tracing.record(tracing.UPLOAD, study_id, seconds, mode='batch', batch=batch)
+        logger.info(f"Sent a batch of {len(study_ids)} studies to {api_endpoint}; "
+                    f"{sum(results.values())} accepted")
+        return results
+    except TransmissionError as e:
+        logger.error(f"Failed to send batch {archive_path}: {e}")
+    except Exception as e:
+        logger.error(f"Error sending batch {archive_path}: {e}")
+    finally:
+        try:
+            os.remove(archive_path)
+        except FileNotFoundError:
+            pass
+    return dict.fromkeys(study_ids, False)
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+
+import pipeline as stages
+from http_client import destination_key, open_session, throttle
+from retry import FatalError, RetryPolicy, TransmissionError, call_with_retry, classify_status, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_PARALLEL_PARTS = 4
+
+
+class UploadExpired(FatalError):
+    """The destination no longer knows the upload being resumed."""
+
+
+def checkpoint_path(archive_path, destination=None):
+    """Where an upload's state is kept; each named destination of a shared archive has its own.
+
+    Destination names may be URLs, so they are reduced to a filename-safe
+    slug, with a short hash of the name to keep different ones apart.
+    """
+    if destination is None:
+        return f"{archive_path}.upload.json"
+    slug = re.sub(r'[^A-Za-z0-9._@-]+', '_', destination).strip('_')[:64]
+    if slug != destination:
+        slug = f"{slug}-{hashlib.sha256(destination.encode()).hexdigest()[:8]}"
+    return f"{archive_path}.upload-{slug}.json"
+
+
+def load_checkpoint(archive_path, part_size, destination=None):
+    """Return the saved upload state if it still matches the archive on disk."""
+    try:
+        with open(checkpoint_path(archive_path, destination)) as f:
+            checkpoint = json.load(f)
+        stat = os.stat(archive_path)
+    except (OSError, ValueError):
+        return None
+    if (checkpoint.get('size') != stat.st_size or checkpoint.get('mtime') != stat.st_mtime
+            or checkpoint.get('part_size') != part_size):
+        return None
+    return checkpoint
+
+
+def save_checkpoint(archive_path, checkpoint, destination=None):
+    """Atomically persist the upload state next to the archive."""
+    path = checkpoint_path(archive_path, destination)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def remove_checkpoint(archive_path, destination=None):
+    try:
+        os.remove(checkpoint_path(archive_path, destination))
+    except FileNotFoundError:
+        pass
+
+
+def read_part(archive_path, number, part_size):
+    with open(archive_path, 'rb') as f:
+        f.seek(number * part_size)
+        return f.read(part_size)
+
+
+async def upload_file_chunked(api_endpoint, api_key, archive_path, checksum, client=None,
+                              part_size=DEFAULT_PART_SIZE, parallel=DEFAULT_PARALLEL_PARTS,
+                              part_retries=3, retry_delay=1, metadata=None, destination=None, fingerprint=None,
+                              pipeline=None):
+    """Upload ``archive_path`` in fixed-size parts, resuming a previous attempt if possible.
+
+    Protocol, relative to ``api_endpoint``:
+
+    - ``POST /uploads`` with JSON ``{filename, size, part_size, checksum}``
+      returns ``{"upload_id": ...}``
+    - ``PUT /uploads/<id>/parts/<n>`` with the part body and its SHA-256 in
+      ``X-Checksum``; a 404 means the upload has expired
+    - ``POST /uploads/<id>/complete`` with ``{parts, checksum}``
+
+    Completed part numbers are checkpointed to ``<archive>.upload.json``
+    after each part, so a dropped connection or a restart only re-sends the
+    parts that were in flight. Parts are read and checkpoints written in the
+    IO stage of ``pipeline``; parts that finish while a checkpoint is being
+    written go into the next write together. ``metadata`` is sent with the initial request
+    and kept in the checkpoint, as is the ``fingerprint`` of the content the
+    archive was built from (see ``transmission.study_fingerprint``);
+    ``destination`` names the checkpoint when one archive is uploaded to
+    several destinations. Returns True once the destination has
+    acknowledged the completed upload.
+    """
+    headers = {'Authorization': f'Bearer {api_key}'}
+    base_url = api_endpoint.rstrip('/')
+    size = os.path.getsize(archive_path)
+    part_count = max(1, -(-size // part_size))
+
+    checkpoint = load_checkpoint(archive_path, part_size, destination)
+    if checkpoint is None:
+        async with open_session(client, api_endpoint) as session:
+            body = {'filename': os.path.basename(archive_path), 'size': size, 'part_size': part_size,
+                    'checksum': checksum, 'metadata': metadata or {}}
+            async with session.post(f"{base_url}/uploads", json=body, headers=headers) as response:
+                if response.status not in (200, 201):
+                    logger.error(f"Could not start chunked upload of {archive_path}. Status: {response.status}")
+                    return False
+                upload_id = (await response.json())['upload_id']
+        checkpoint = {'upload_id': upload_id, 'size': size, 'mtime': os.stat(archive_path).st_mtime,
+                      'part_size': part_size, 'metadata': metadata or {}, 'fingerprint': fingerprint, 'parts': {}}
+        await stages.run(pipeline, stages.IO, save_checkpoint, archive_path, checkpoint, destination)
+    else:
+        logger.info(f"Resuming upload {checkpoint['upload_id']} of {archive_path}: "
+                    f"{len(checkpoint['parts'])}/{part_count} parts already sent")
+
+    upload_url = f"{base_url}/uploads/{checkpoint['upload_id']}"
+    semaphore = asyncio.Semaphore(parallel)
+    policy = RetryPolicy(max_attempts=part_retries + 1, base_delay=retry_delay)
+    breaker = client.breaker(api_endpoint) if client is not None else None
+    checkpoint_lock = asyncio.Lock()
+    saved_parts = len(checkpoint['parts'])
+
+    async def persist():
+        nonlocal saved_parts
+        async with checkpoint_lock:
+            if len(checkpoint['parts']) == saved_parts:
+                return  # Written by the save this one waited for
+            snapshot = {**checkpoint, 'parts': dict(checkpoint['parts'])}
+            await stages.run(pipeline, stages.IO, save_checkpoint, archive_path, snapshot, destination)
+            saved_parts = len(snapshot['parts'])
+
+    async def send_part(number):
+        async with semaphore:
+            data = await stages.run(pipeline, stages.IO, read_part, archive_path, number, part_size)
+            part_checksum = hashlib.sha256(data).hexdigest()
+
+            async def attempt(n):
+                await throttle(client, api_endpoint, len(data))
+                async with open_session(client, api_endpoint) as session:
+                    async with session.put(f"{upload_url}/parts/{number}", data=data,
+                                           headers={**headers, 'X-Checksum': part_checksum}) as response:
+                        if response.status == 404:
+                            raise UploadExpired(checkpoint['upload_id'], status=404)
+                        if not 200 <= response.status < 300:
+                            raise classify_status(response.status,
+                                                  parse_retry_after(response.headers.get('Retry-After')))
+
+            try:
+                await call_with_retry(attempt, policy, breaker, f"part {number} of {archive_path}",
+                                      destination=destination_key(api_endpoint))
+            except UploadExpired:
+                raise
+            except TransmissionError:
+                return False
+            checkpoint['parts'][str(number)] = part_checksum
+        await persist()
+        return True
+
+    remaining = [n for n in range(part_count) if str(n) not in checkpoint['parts']]
+    try:
+        results = await asyncio.gather(*(send_part(n) for n in remaining))
+    except UploadExpired:
+        logger.warning(f"Upload {checkpoint['upload_id']} expired on the destination; starting over next time.")
+        remove_checkpoint(archive_path, destination)
+        return False
+    if not all(results):
+        logger.error(f"Chunked upload of {archive_path} incomplete; {results.count(False)} parts failed.")
+        return False
+
+    parts = [{'number': n, 'checksum': checkpoint['parts'][str(n)]} for n in range(part_count)]
+    async with open_session(client, api_endpoint) as session:
+        async with session.post(f"{upload_url}/complete", json={'parts': parts, 'checksum': checksum},
+                                headers=headers) as response:
+            if response.status not in (200, 201):
+                logger.error(f"Destination rejected completion of {archive_path}. Status: {response.status}")
+                if 400 <= response.status < 500:
+                    remove_checkpoint(archive_path, destination)  # Expired or corrupt; start over next time
+                return False
+
+    remove_checkpoint(archive_path, destination)
+    logger.info(f"Chunked upload of {archive_path} complete ({part_count} parts).")
+    return True
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom import AE, build_role
+from pynetdicom.dimse_messages import N_ACTION_RSP
+from pynetdicom.sop_class import StorageCommitmentPushModel, StorageCommitmentPushModelInstance
+
+logger = logging.getLogger(__name__)
+
+REQUEST_COMMITMENT = 1  # N-ACTION Action Type ID
+ALL_COMMITTED = 1       # N-EVENT-REPORT Event Type IDs
+SOME_FAILED = 2
+NO_SUCH_OBJECT = 0x0112  # Failure Reason
+
+
+def commitment_request(event):
+    """Return ``(transaction_uid, [(sop_class, sop_instance)])`` of a Storage Commitment N-ACTION, or None."""
+    if event.request.RequestedSOPClassUID != StorageCommitmentPushModel or event.action_type != REQUEST_COMMITMENT:
+        return None
+    info = event.action_information
+    references = [(str(item.ReferencedSOPClassUID), str(item.ReferencedSOPInstanceUID))
+                  for item in info.get('ReferencedSOPSequence', [])]
+    return str(info.TransactionUID), references
+
+
+def commitment_report(transaction_uid, references, committed):
+    """Build the N-EVENT-REPORT ``(event_type, event_information)``; ``committed`` holds the instances we have."""
+    report = Dataset()
+    report.TransactionUID = transaction_uid
+    succeeded, failed = [], []
+    for sop_class, sop_instance in references:
+        item = Dataset()
+        item.ReferencedSOPClassUID = sop_class
+        item.ReferencedSOPInstanceUID = sop_instance
+        if sop_instance in committed:
+            succeeded.append(item)
+        else:
+            item.FailureReason = NO_SUCH_OBJECT
+            failed.append(item)
+    if succeeded:
+        report.ReferencedSOPSequence = succeeded
+    if failed:
+        report.FailedSOPSequence = failed
+    return (SOME_FAILED if failed else ALL_COMMITTED), report
+
+
+class CommitmentReporter:
+    """Answers Storage Commitment requests with the N-EVENT-REPORT the Push Model promises.
+
+    An instance is committed once it is in ``index``. As the index may lag
+    the C-STORE acknowledgements (another receiver process, ENQUEUE
+    durability), missing instances are looked up again for up to ``wait``
+    seconds before they are reported as failed. The report goes out on the
+    requesting association once its N-ACTION response has been sent, or,
+    if the modality released it meanwhile, on a new association to the
+    modality's address in ``peers`` (``{ae_title: {'host': ..., 'port': ...}}``).
+    """
+
+    def __init__(self, index, peers=None, ae_title='BOUNCE', wait=10, network_timeout=30):
+        self.index = index
+        self.peers = peers or {}
+        self.ae_title = ae_title
+        self.wait = wait
+        self.network_timeout = network_timeout
+        self.lock = threading.Lock()
+        self.requests = {}  # association -> commitment requests awaiting their N-ACTION response
+
+    def requested(self, event):
+        """EVT_N_ACTION: note the request; returns the SOP Instance UIDs it refers to."""
+        request = commitment_request(event)
+        if request is None:
+            return []
+        with self.lock:
+            self.requests.setdefault(event.assoc, []).append(request)
+        return [sop_instance for _, sop_instance in request[1]]
+
+    def on_sent(self, event):
+        """EVT_DIMSE_SENT: report on requests whose N-ACTION response just went out."""
+        if not isinstance(event.message, N_ACTION_RSP) or event.assoc not in self.requests:
+            return
+        with self.lock:
+            requests = self.requests.pop(event.assoc, [])
+        for request in requests:
+            threading.Thread(target=self._report, args=(event.assoc, *request), name="CommitmentReport",
+                             daemon=True).start()
+
+    def _committed(self, references):
+        deadline = time.monotonic() + self.wait
+        committed = set()
+        while True:
+            for _, sop_instance in references:
+                if sop_instance not in committed and self.index.get(sop_instance) is not None:
+                    committed.add(sop_instance)
+            if len(committed) == len(references) or time.monotonic() >= deadline:
+                return committed
+            time.sleep(0.1)
+
+    def _report(self, assoc, transaction_uid, references):
+        try:
+            event_type, report = commitment_report(transaction_uid, references, self._committed(references))
+            calling_ae = str(assoc.requestor.ae_title).strip()
+            if assoc.is_established:
+                self._send(assoc, event_type, report)
+            elif calling_ae in self.peers:
+                self._send_to(self.peers[calling_ae], calling_ae, event_type, report)
+            else:
+                logger.warning(f"Cannot report Storage Commitment {transaction_uid} to {calling_ae}: it released "
+                               f"the association and is not among the commitment peers")
+                return
+            failed = len(report.get('FailedSOPSequence', []))
+            logger.info(f"Reported Storage Commitment {transaction_uid} to {calling_ae}: "
+                        f"{len(references) - failed} committed, {failed} failed")
+        except Exception as e:
+            logger.error(f"Could not report Storage Commitment {transaction_uid}: {e}")
+
+    @staticmethod
+    def _send(assoc, event_type, report):
+        status, _ = assoc.send_n_event_report(report, event_type, StorageCommitmentPushModel,
+                                              StorageCommitmentPushModelInstance)
+        if status.get('Status') != 0x0000:
+            raise RuntimeError(f"N-EVENT-REPORT answered with status {status.get('Status')}")
+
+    def _send_to(self, peer, ae_title, event_type, report):
+        ae = AE(ae_title=self.ae_title)
+        ae.network_timeout = self.network_timeout
+        ae.add_requested_context(StorageCommitmentPushModel)
+        # On an association we open, we still act as the SCP of the commitment
+        assoc = ae.associate(peer['host'], peer['port'], ae_title=ae_title,
+                             ext_neg=[build_role(StorageCommitmentPushModel, scp_role=True)])
+        if not assoc.is_established:
+            raise RuntimeError(f"could not associate with {ae_title}@{peer['host']}:{peer['port']}")
+        try:
+            self._send(assoc, event_type, report)
+        finally:
+            assoc.release()
+
+    def forget(self, assoc):
+        """Drop requests of an association that closed before answering them."""
+        with self.lock:
+            self.requests.pop(assoc, None)
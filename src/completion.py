@@ -0,0 +1,145 @@
+import logging
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class GapEstimator:
+    """EWMA of inter-arrival gaps and their deviation, as TCP estimates round-trip times."""
+
+    __slots__ = ('mean', 'deviation', 'samples', 'alpha', 'beta')
+
+    def __init__(self, alpha=0.125, beta=0.25):
+        self.mean = None
+        self.deviation = 0.0
+        self.samples = 0
+        self.alpha = alpha
+        self.beta = beta
+
+    def update(self, gap):
+        if self.mean is None:
+            self.mean, self.deviation = gap, gap / 2
+        else:
+            self.deviation += self.beta * (abs(gap - self.mean) - self.deviation)
+            self.mean += self.alpha * (gap - self.mean)
+        self.samples += 1
+
+
+class _OpenStudy:
+    __slots__ = ('key', 'opened', 'last', 'received', 'expected', 'associations')
+
+    def __init__(self, key, opened):
+        self.key = key
+        self.opened = opened
+        self.last = None
+        self.received = 0
+        self.expected = None
+        self.associations = set()
+
+
+class CompletionDetector:
+    """Decides when a receiving study is complete and moves its deadline on the ``StudyScheduler``.
+
+    The quiet timeout of each study is learned from the inter-arrival gaps
+    seen for its calling AE title and modality: ``mean + factor *
+    deviation``, no shorter than ``min_timeout`` and never longer than the
+    fixed ``timeout``, which is also used until ``min_samples`` gaps have
+    been seen. Explicit signals end a study early:
+
+    - every instance of Number of Study Related Instances has arrived;
+    - the modality asked for Storage Commitment of the study's instances;
+    - the last association that sent instances of the study was released
+      normally (the deadline moves to ``release_grace`` from then, in case a
+      new association picks up where the old one stopped).
+
+    All methods must be called from the loop's own thread.
+    """
+
+    def __init__(self, scheduler, timeout=60, adaptive=True, min_timeout=2.0, factor=4.0, min_samples=5,
+                 release_grace=2.0):
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        self.factor = factor
+        self.min_samples = min_samples
+        self.release_grace = release_grace
+        self.estimators = {}  # (calling AE, modality) -> GapEstimator
+        self.studies = {}  # study_id -> _OpenStudy
+        self.associations = {}  # association key -> study ids it has sent
+
+    def timeout_for(self, key):
+        estimator = self.estimators.get(key)
+        if not self.adaptive or estimator is None or estimator.samples < self.min_samples:
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, estimator.mean + self.factor * estimator.deviation))
+
+    def instance_stored(self, study_id, attributes=None):
+        """Note an instance of a study and push back (or bring forward) its deadline."""
+        attributes = attributes or {}
+        now = self.scheduler.loop.time()
+        key = (attributes.get('calling_ae'), attributes.get('modality'))
+        study = self.studies.get(study_id)
+        if study is None:
+            study = self.studies[study_id] = _OpenStudy(key, now)
+        elif study.last is not None:
+            # Gaps longer than the fallback would have ended the study anyway
+            gap = min(now - study.last, self.timeout)
+            self.estimators.setdefault(study.key, GapEstimator()).update(gap)
+        study.last = now
+        study.received += 1
+        if attributes.get('expected_instances'):
+            study.expected = attributes['expected_instances']
+        association = attributes.get('association')
+        if association is not None:
+            study.associations.add(association)
+            self.associations.setdefault(association, set()).add(study_id)
+
+        if study.expected is not None and study.received >= study.expected:
+            logger.info(f"Study {study_id} has all {study.expected} instances it announced.")
+            self.scheduler.touch(study_id, 0)
+        else:
+            self.scheduler.touch(study_id, self.timeout_for(study.key))
+
+    def association_closed(self, association, released=True):
+        """An association ended; a normal release completes the studies no other association is sending."""
+        # A connection close is reported for every association, sometimes before the release that preceded
+        # it, so an unreleased association is only forgotten once a release or its studies' ``forget`` follow
+        studies = self.associations.pop(association, ()) if released else self.associations.get(association, ())
+        for study_id in studies:
+            study = self.studies.get(study_id)
+            if study is None:
+                continue
+            study.associations.discard(association)
+            if released and not study.associations:
+                self._bring_forward(study_id, self.release_grace, "its association was released")
+
+    def commitment_requested(self, study_ids):
+        """The modality asked to commit these studies' instances, so it has sent them."""
+        for study_id in study_ids:
+            self._bring_forward(study_id, 0, "storage commitment was requested")
+
+    def _bring_forward(self, study_id, delay, reason):
+        current = self.scheduler.deadlines.get(study_id)
+        if current is None:
+            return
+        deadline = self.scheduler.loop.time() + delay
+        if deadline < current:
+            logger.info(f"Study {study_id} looks complete: {reason}.")
+            self.scheduler.reschedule(study_id, deadline)
+
+    def forget(self, study_id):
+        """Drop a study's state once it has been handed on for sending."""
+        study = self.studies.pop(study_id, None)
+        if study is None:
+            return
+        # From the first instance until the study was judged complete
+        tracing.record(tracing.DEBOUNCE, study_id, self.scheduler.loop.time() - study.opened,
+                       instances=study.received)
+        for association in study.associations:
+            studies = self.associations.get(association)
+            if studies is not None:
+                studies.discard(study_id)
+                if not studies:
+                    del self.associations[association]
@@ -1,12 +1,309 @@
+import abc
+import atexit
+import io
+import json
+import logging
 import os
+import struct
 import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
+from pydicom.errors import InvalidDicomError
+from pydicom.filereader import read_file_meta_info
+from pydicom.uid import UID
 
-def compress_study(source_dir, output_tar_gz):
-    with tarfile.open(output_tar_gz, "w:gz") as tar:
-        # Add each file inside the directory, without preserving the folder structure
-        for root, _, files in os.walk(source_dir):
-            for file in files:
+import metrics
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEVEL = 6
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # Uncompressed bytes per parallel gzip block
+DICTIONARY_SIZE = 32 * 1024  # Deflate window primed from the previous block
+MANIFEST_NAME = "manifest.json"
+
+_process_pools = {}
+
+
+def get_process_pool(workers):
+    """Return a shared process pool with ``workers`` processes."""
+    pool = _process_pools.get(workers)
+    if pool is None:
+        pool = _process_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return pool
+
+
+def shutdown_pools():
+    """Stop the shared process pools; ``get_process_pool`` starts new ones if called again."""
+    while _process_pools:
+        _, pool = _process_pools.popitem()
+        pool.shutdown(cancel_futures=True)
+
+
+atexit.register(shutdown_pools)
+
+
+def _deflate_block(data, level, zdict, last):
+    """Raw-deflate one block, primed with the tail of the previous block.
+
+    Blocks end on a byte boundary (sync flush) so they can be concatenated
+    into one deflate stream; only the last block sets the final bit.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ArchiveEngine(abc.ABC):
+    """A write-only file object that compresses a tar stream into ``fileobj``.
+
+    ``set_compressible(False)`` hints that the bytes written next (e.g. an
+    already-compressed DICOM instance) should be stored rather than
+    recompressed; engines that cannot honour the hint ignore it.
+    """
+    name = None
+    extension = None
+    content_type = None
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def tell(self):
+        return self.bytes_in
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._write(data)
+        return len(data)
+
+    @abc.abstractmethod
+    def _write(self, data):
+        """Compress ``data`` and ``_emit`` whatever output is ready."""
+
+    def _emit(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.bytes_out += len(data)
+
+    def set_compressible(self, compressible):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Finish the compressed stream; ``fileobj`` itself is left open."""
+
+
+class StoreEngine(ArchiveEngine):
+    """Plain, uncompressed tar."""
+    name = "store"
+    extension = ".tar"
+    content_type = "application/x-tar"
+
+    def __init__(self, fileobj, **kwargs):
+        super().__init__(fileobj)
+
+    def _write(self, data):
+        self._emit(data)
+
+
+class GzipEngine(ArchiveEngine):
+    """pigz-style gzip: blocks are deflated in parallel into one gzip member.
+
+    Each block is primed with the last 32 KiB of the block before it and
+    sync-flushed, so the concatenated output is a single standard deflate
+    stream that any gunzip or ``tarfile`` can read. The CRC is computed in
+    order in the calling process, which is cheap next to deflate. Blocks of
+    incompressible members are deflated at level 0 (stored).
+    """
+    name = "gzip"
+    extension = ".tar.gz"
+    content_type = "application/gzip"
+
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, workers=1, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__(fileobj)
+        self.level = level
+        self.block_size = block_size
+        self.executor = get_process_pool(workers) if workers > 1 else None
+        self.max_pending = workers * 2
+        self.compressible = True
+        self.crc = 0
+        self._buffer = bytearray()
+        self._zdict = b""
+        self._pending = deque()
+        # gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self._emit(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def _write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, last=False)
+
+    def set_compressible(self, compressible):
+        if compressible != self.compressible:
+            # Cut the block so each one is deflated at a single level
+            if self._buffer:
+                self._submit(bytes(self._buffer), last=False)
+                self._buffer.clear()
+            self.compressible = compressible
+
+    def _submit(self, block, last):
+        level = self.level if self.compressible else 0
+        zdict = self._zdict
+        self._zdict = (zdict + block)[-DICTIONARY_SIZE:]
+        if self.executor is None:
+            self._emit(_deflate_block(block, level, zdict, last))
+            return
+        self._pending.append(self.executor.submit(_deflate_block, block, level, zdict, last))
+        while len(self._pending) > self.max_pending:
+            self._emit(self._pending.popleft().result())
+
+    def close(self):
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        while self._pending:
+            self._emit(self._pending.popleft().result())
+        self._emit(struct.pack("<II", self.crc & 0xFFFFFFFF, self.bytes_in & 0xFFFFFFFF))
+
+
+class ZstdEngine(ArchiveEngine):
+    """Zstandard, multi-threaded inside libzstd. Requires ``zstandard``."""
+    name = "zstd"
+    extension = ".tar.zst"
+    content_type = "application/zstd"
+
+    def __init__(self, fileobj, level=3, workers=1, **kwargs):
+        if zstandard is None:
+            raise RuntimeError("The zstd codec requires the 'zstandard' package")
+        super().__init__(fileobj)
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers if workers > 1 else 0)
+        self._writer = compressor.stream_writer(_CountingWriter(self), closefd=False)
+
+    def _write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        self._writer.close()
+
+
+class _CountingWriter:
+    """Adapter that routes a third-party compressor's output through ``_emit``."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def write(self, data):
+        self.engine._emit(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+ENGINES = {engine.name: engine for engine in (GzipEngine, ZstdEngine, StoreEngine)}
+
+
+def get_engine(codec):
+    """Look up an archive engine class by codec name."""
+    try:
+        return ENGINES[codec]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec {codec!r}; expected one of {sorted(ENGINES)}")
+
+
+def open_engine(fileobj, codec="gzip", level=None, workers=1):
+    """Return an archive engine writing to ``fileobj`` with the given codec options."""
+    options = {'workers': workers}
+    if level is not None:
+        options['level'] = level
+    return get_engine(codec)(fileobj, **options)
+
+
+def is_precompressed(file_path):
+    """Return True if a DICOM file's transfer syntax is already compressed."""
+    try:
+        transfer_syntax = UID(read_file_meta_info(file_path).TransferSyntaxUID)
+    except (InvalidDicomError, AttributeError, OSError, EOFError):
+        return False
+    return transfer_syntax.is_compressed or transfer_syntax.is_deflated
+
+
+def write_archive(source_dir, fileobj, codec="gzip", level=None, workers=1, codec_aware=True, flatten=False,
+                  files=None, manifest=None):
+    """Write a compressed tar of ``source_dir`` to ``fileobj`` and return a report.
+
+    By default members are laid out like ``shutil.make_archive(...,
+    source_dir)`` (``./<series>/<file>``); ``flatten`` stores bare file names.
+    ``files`` limits the archive to those paths relative to ``source_dir``,
+    and a ``manifest`` dict is stored first as ``manifest.json``.
+    """
+    engine = open_engine(fileobj, codec, level, workers)
+    started = time.monotonic()
+    selected = set(files) if files is not None else None
+    wanted_dirs = {os.path.dirname(path) or os.curdir for path in selected} if selected is not None else None
+
+    with tarfile.open(fileobj=engine, mode="w") as tar:
+        if not flatten:
+            tar.add(source_dir, arcname=os.curdir, recursive=False)
+        if manifest is not None:
+            data = json.dumps(manifest, indent=2).encode()
+            tarinfo = tarfile.TarInfo(MANIFEST_NAME if flatten else os.path.join(os.curdir, MANIFEST_NAME))
+            tarinfo.size = len(data)
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(data))
+        for root, dirs, names in os.walk(source_dir):
+            dirs.sort()
+            rel_root = os.path.relpath(root, source_dir)
+            if not flatten and rel_root != os.curdir and (wanted_dirs is None or rel_root in wanted_dirs):
+                tar.add(root, arcname=os.path.join(os.curdir, rel_root), recursive=False)
+            for file in sorted(names):
                 file_path = os.path.join(root, file)
-                tar.add(file_path, arcname=file)  # arcname=file ensures only the file name is added
+                rel_path = os.path.relpath(file_path, source_dir)
+                if (selected is not None and rel_path not in selected) or file.startswith('.'):
+                    continue  # Dot-files are the storage writer's temp files
+                arcname = file if flatten else os.path.join(os.curdir, rel_path)
+                engine.set_compressible(not (codec_aware and is_precompressed(file_path)))
+                tar.add(file_path, arcname=arcname)
+        engine.set_compressible(True)
+    engine.close()
+
+    report = compression_report(engine.name, engine.bytes_in, engine.bytes_out, time.monotonic() - started)
+    metrics.observe_compression(report)
+    return report
+
+
+def compression_report(codec, bytes_in, bytes_out, seconds):
+    """Summarise one compression run as throughput and ratio."""
+    return {
+        'codec': codec,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'seconds': seconds,
+        'mb_per_s': bytes_in / 1e6 / seconds if seconds else 0.0,
+        'ratio': bytes_in / bytes_out if bytes_out else 0.0,
+    }
+
 
+def compress_study(source_dir, output_tar_gz, codec="gzip", level=None, workers=1, codec_aware=True):
+    """Compress a study directory, adding each file without preserving the folder structure."""
+    with open(output_tar_gz, "wb") as output:
+        report = write_archive(source_dir, output, codec=codec, level=level, workers=workers,
+                               codec_aware=codec_aware, flatten=True)
+    logger.info(f"Compressed {source_dir} with {report['codec']}: {report['mb_per_s']:.1f} MB/s, "
+                f"ratio {report['ratio']:.2f}")
+    return report
@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -11,14 +12,27 @@ class ConfigManager:
             },
             'transmission': {
                 'api_key': os.getenv('API_KEY', 'default_api_key'),  # Default API key
-                'api_endpoint': os.getenv('API_ENDPOINT', 'https://api.example.com')  # Default endpoint
+                'api_endpoint': os.getenv('API_ENDPOINT', 'https://api.example.com'),  # Default endpoint
+                'streaming': os.getenv('STREAM_UPLOADS', 'false').lower() == 'true'  # Upload without a .tar.gz on disk
             },
             'dicom': {
                 'port': int(os.getenv('DICOM_PORT', 104)),  # Default DICOM port
                 'host': os.getenv('DICOM_HOST', '0.0.0.0')  # Default host
             },
+            'compression': {
+                'codec': os.getenv('COMPRESSION_CODEC', 'gzip'),  # gzip, zstd or store
+                'workers': int(os.getenv('COMPRESSION_WORKERS', 1))  # Parallel compression workers
+            },
+            'metrics': {
+                'port': int(os.getenv('METRICS_PORT', 0)) or None  # Serve /metrics on this port if set
+            },
             'storage': {
                 'base_dir': os.getenv('STORAGE_DIR', '/tmp/dicom_storage')  # Default storage directory
             }
         }
+        # Optionally fan studies out to several destinations listed in a JSON file
+        destinations_file = os.getenv('DESTINATIONS_FILE')
+        if destinations_file:
+            with open(destinations_file) as f:
+                config['transmission']['destinations'] = json.load(f)
         return config
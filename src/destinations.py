@@ -0,0 +1,98 @@
+import logging
+
+from upload_scheduler import matches_rule
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = 'primary'
+
+
+class Destination:
+    """Somewhere studies are delivered, with the rules that pick which studies.
+
+    Built from one entry of the ``transmission.destinations`` config list::
+
+        {'name': 'dr-archive', 'api_endpoint': 'https://dr.local/upload', 'api_key': '...',
+         'required': True,
+         'rules': [{'modality': ['CT', 'MR']}, {'calling_ae': 'ED_CR'}]}
+
+    A destination with a ``dicom`` section instead of an ``api_endpoint``
+    is a PACS that instances are relayed to over C-STORE as they arrive
+    (see ``dicom_forwarder.DicomForwarder``)::
+
+        {'name': 'pacs', 'dicom': {'host': 'pacs.local', 'port': 104, 'ae_title': 'PACS'}}
+
+    A study goes to a destination without ``rules``, or when any of its
+    rules matches (see ``upload_scheduler.matches_rule``). A study counts
+    as delivered, and its local files may be deleted, once every
+    ``required`` destination it goes to has confirmed it; failures at an
+    optional destination are logged and recorded but do not hold it back.
+    """
+
+    __slots__ = ('name', 'api_endpoint', 'api_key', 'required', 'rules', 'dicom')
+
+    def __init__(self, name, api_endpoint=None, api_key=None, required=True, rules=None, dicom=None):
+        self.name = name
+        self.api_endpoint = api_endpoint
+        self.api_key = api_key
+        self.required = required
+        self.rules = list(rules or [])
+        self.dicom = dicom
+
+    def matches(self, study):
+        return not self.rules or any(matches_rule(rule, study) for rule in self.rules)
+
+    def __repr__(self):
+        if self.dicom:
+            return f"Destination({self.name!r}, dicom={self.dicom.get('ae_title')}@{self.dicom.get('host')})"
+        return f"Destination({self.name!r}, {self.api_endpoint!r})"
+
+
+def load_destinations(transmission):
+    """Build the destination list from the ``transmission`` config section.
+
+    Without a ``destinations`` list, ``api_endpoint`` and ``api_key`` make
+    a single destination called 'primary' (none without an endpoint).
+    Entries without an ``api_key`` use the section's.
+    """
+    entries = transmission.get('destinations')
+    if not entries:
+        entries = [{'name': PRIMARY, 'api_endpoint': transmission['api_endpoint']}] \
+            if transmission.get('api_endpoint') else []
+    destinations = []
+    for entry in entries:
+        entry = dict(entry)
+        if entry.get('dicom'):
+            if not entry['dicom'].get('host') or not entry['dicom'].get('port'):
+                raise ValueError(f"DICOM destination {entry} needs a host and port")
+            entry.setdefault('name', f"{entry['dicom'].get('ae_title', 'ANY-SCP')}@{entry['dicom']['host']}")
+        elif not entry.get('api_endpoint'):
+            raise ValueError(f"Destination {entry} has no api_endpoint")
+        entry.setdefault('name', entry.get('api_endpoint'))
+        entry.setdefault('api_key', transmission.get('api_key'))
+        destinations.append(Destination(**entry))
+    names = [destination.name for destination in destinations]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Destination names must be unique: {names}")
+    return destinations
+
+
+def route(destinations, study):
+    """Return the destinations a study's journal entry goes to."""
+    return [destination for destination in destinations if destination.matches(study or {})]
+
+
+def pending(destinations, deliveries, latest_stored):
+    """Return the destinations that lack the study's newest instances.
+
+    ``deliveries`` maps destination names to the ``delivered_through``
+    time of their last confirmed delivery (see
+    ``journal.StudyJournal.deliveries``); ``latest_stored`` is when the
+    study's newest instance was stored, or None if that is not known.
+    """
+    result = []
+    for destination in destinations:
+        delivered_through = deliveries.get(destination.name)
+        if delivered_through is None or (latest_stored is not None and delivered_through < latest_stored):
+            result.append(destination)
+    return result
@@ -0,0 +1,300 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from pydicom import dcmread
+from pydicom.uid import UID, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE
+
+import metrics
+from retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Outcomes per instance
+FORWARDED = 'forwarded'
+RETRIED = 'retried'
+FAILED = 'failed'
+REJECTED = 'rejected'  # No presentation context for it was accepted; not retried
+
+# C-STORE statuses that mean the instance was stored
+SUCCESS_STATUSES = frozenset((0x0000, 0x0001, 0xB000, 0xB006, 0xB007))
+UNCOMPRESSED = (ExplicitVRLittleEndian, ImplicitVRLittleEndian)
+MAX_CONTEXTS = 128  # Presentation contexts one association may propose
+
+
+class ForwardError(Exception):
+    """An instance could not be stored at the destination."""
+
+
+class ContextCache:
+    """The presentation contexts negotiated with one destination AE.
+
+    Every association to the destination proposes the contexts its
+    instances have needed so far, most recently used first, so the pool's
+    associations rarely have to be reopened for a new SOP class. Contexts
+    the destination rejected are remembered and fail fast.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requested = collections.OrderedDict()  # (sop_class, compressed syntax or None) -> syntaxes
+        self.rejected = set()  # (sop_class, transfer_syntax)
+
+    @staticmethod
+    def _key(sop_class, transfer_syntax):
+        return (sop_class, None if not transfer_syntax.is_compressed else transfer_syntax)
+
+    def request(self, sop_class, transfer_syntax):
+        key = self._key(sop_class, transfer_syntax)
+        with self.lock:
+            self.requested[key] = UNCOMPRESSED if key[1] is None else (transfer_syntax,)
+            self.requested.move_to_end(key, last=False)
+
+    def contexts(self):
+        """``(sop_class, syntaxes)`` to propose, at most ``MAX_CONTEXTS``."""
+        with self.lock:
+            return [(key[0], syntaxes) for key, syntaxes in list(self.requested.items())[:MAX_CONTEXTS]]
+
+    def reject(self, sop_class, transfer_syntax):
+        with self.lock:
+            self.rejected.add((sop_class, transfer_syntax))
+
+    def is_rejected(self, sop_class, transfer_syntax):
+        with self.lock:
+            return (sop_class, transfer_syntax) in self.rejected
+
+
+def supports(contexts, sop_class, transfer_syntax):
+    """Whether accepted ``contexts`` can carry an instance; uncompressed data converts between syntaxes."""
+    for context in contexts:
+        if context.abstract_syntax != sop_class:
+            continue
+        accepted = UID(context.transfer_syntax[0])
+        if accepted == transfer_syntax or (not transfer_syntax.is_compressed and not accepted.is_compressed):
+            return True
+    return False
+
+
+class DicomForwarder:
+    """Relays stored instances to a DICOM destination over a pool of long-lived C-STORE associations.
+
+    Configured by a destination's ``dicom`` section::
+
+        {'host': 'pacs.local', 'port': 104, 'ae_title': 'PACS', 'calling_ae': 'BOUNCE',
+         'associations': 2, 'idle_timeout': 30, 'retry': {'max_attempts': 5, 'base_delay': 1}}
+
+    Instances are queued as they are stored (``forward``) and sent by
+    ``associations`` worker threads, each holding its association open
+    between instances and releasing it after ``idle_timeout`` seconds
+    without work. A failed instance is retried on its own with backoff;
+    ``wait(study_id)`` blocks until each of a study's instances was stored
+    or given up on, and ``delivered(study_id)`` says whether all of them
+    made it.
+    """
+
+    def __init__(self, name, host, port, ae_title='ANY-SCP', calling_ae='BOUNCE', associations=2, idle_timeout=30,
+                 retry=None, network_timeout=30):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.ae_title = ae_title
+        self.calling_ae = calling_ae
+        self.idle_timeout = idle_timeout
+        self.network_timeout = network_timeout
+        self.policy = RetryPolicy(**(retry or {'max_attempts': 5}))
+        self.contexts = ContextCache()
+        self.queue = queue.Queue()
+        self.cond = threading.Condition()
+        self.pending = {}  # study_id -> paths queued or being retried
+        self.forwarded = {}  # study_id -> paths stored at the destination
+        self.failed = {}  # study_id -> paths given up on
+        self.waiters = {}  # study_id -> futures from ``idle``, completed once nothing of it is pending
+        self.timers = set()
+        self.stopping = False
+        self.workers = [threading.Thread(target=self._run, name=f"DicomForwarder-{name}-{n}", daemon=True)
+                        for n in range(associations)]
+        for worker in self.workers:
+            worker.start()
+        logger.info(f"Forwarding to {ae_title}@{host}:{port} over {associations} associations")
+
+    def forward(self, study_id, path):
+        """Queue a stored instance; one already queued is sent once, as it is on disk by then."""
+        with self.cond:
+            if self.stopping or path in self.pending.get(study_id, ()):
+                return
+            self.pending.setdefault(study_id, set()).add(path)
+            self.forwarded.get(study_id, set()).discard(path)
+            self.failed.get(study_id, set()).discard(path)
+        self.queue.put((study_id, path, 0))
+
+    def forward_study(self, study_id, paths):
+        """Queue those of a study's instance ``paths`` that are not stored at the destination yet."""
+        with self.cond:
+            done = set(self.forwarded.get(study_id, ()))
+        for path in paths:
+            if path not in done:
+                self.forward(study_id, path)
+
+    def wait(self, study_id, timeout=None):
+        """Block until every queued instance of a study was stored or given up on."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending.get(study_id), timeout)
+
+    def idle(self, study_id):
+        """Return a ``Future`` completed once every queued instance of a study was stored or given up on.
+
+        Unlike ``wait`` it holds no thread, so the event loop can await it with ``asyncio.wrap_future``.
+        """
+        waiter = Future()
+        with self.cond:
+            if self.pending.get(study_id):
+                self.waiters.setdefault(study_id, []).append(waiter)
+                return waiter
+        waiter.set_result(True)
+        return waiter
+
+    def _wake(self, study_ids):
+        """Complete the ``idle`` futures of studies that have nothing pending any more; call holding ``cond``."""
+        self.cond.notify_all()
+        for study_id in study_ids:
+            for waiter in self.waiters.pop(study_id, ()):
+                waiter.set_result(True)
+
+    def delivered(self, study_id):
+        """Whether the study's last instances all reached the destination."""
+        with self.cond:
+            return not self.pending.get(study_id) and not self.failed.get(study_id)
+
+    def forget(self, study_id):
+        with self.cond:
+            if not self.pending.get(study_id):
+                self.pending.pop(study_id, None)
+                self.forwarded.pop(study_id, None)
+                self.failed.pop(study_id, None)
+
+    def _finish(self, study_id, path, outcome):
+        metrics.FORWARDED.labels(metrics.destination_label(self.name), outcome).inc()
+        with self.cond:
+            target = self.forwarded if outcome == FORWARDED else self.failed
+            target.setdefault(study_id, set()).add(path)
+            paths = self.pending.get(study_id)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.pending[study_id]
+                    self._wake([study_id])
+
+    def _retry(self, item):
+        study_id, path, attempt = item
+        if attempt + 1 >= self.policy.max_attempts or self.stopping:
+            self._finish(study_id, path, FAILED)
+            return
+        metrics.FORWARDED.labels(metrics.destination_label(self.name), RETRIED).inc()
+
+        def requeue():
+            with self.cond:
+                self.timers.discard(timer)
+            self.queue.put((study_id, path, attempt + 1))
+
+        timer = threading.Timer(self.policy.backoff(attempt), requeue)
+        timer.daemon = True
+        with self.cond:
+            self.timers.add(timer)
+        timer.start()
+
+    def _associate(self, assoc, sop_class, transfer_syntax):
+        """Return an association that can carry the instance, reopening it with the cached contexts if needed."""
+        if assoc is not None and assoc.is_established and supports(assoc.accepted_contexts, sop_class,
+                                                                   transfer_syntax):
+            return assoc
+        self._release(assoc)
+        self.contexts.request(sop_class, transfer_syntax)
+        ae = AE(ae_title=self.calling_ae)
+        ae.network_timeout = self.network_timeout
+        for context_sop_class, syntaxes in self.contexts.contexts():
+            ae.add_requested_context(context_sop_class, list(syntaxes))
+        assoc = ae.associate(self.host, self.port, ae_title=self.ae_title)
+        if not assoc.is_established:
+            raise ForwardError(f"Could not associate with {self.ae_title}@{self.host}:{self.port}")
+        return assoc
+
+    @staticmethod
+    def _release(assoc):
+        if assoc is not None and assoc.is_established:
+            try:
+                assoc.release()
+            except Exception:
+                assoc.abort()
+        return None
+
+    def _store(self, assoc, ds, sop_class, transfer_syntax, path):
+        if not supports(assoc.accepted_contexts, sop_class, transfer_syntax):
+            self.contexts.reject(sop_class, transfer_syntax)
+            raise ValueError(f"{self.ae_title} does not accept {sop_class.name} in {transfer_syntax.name}")
+        status = assoc.send_c_store(ds)
+        if 'Status' not in status:
+            # No response: the association was aborted or timed out
+            raise ForwardError(f"No C-STORE response from {self.ae_title} for {path}")
+        if status.Status not in SUCCESS_STATUSES:
+            raise ForwardError(f"{self.ae_title} answered C-STORE of {path} with status 0x{status.Status:04X}")
+
+    def _run(self):
+        assoc = None
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                assoc = self._release(assoc)
+                continue
+            if item is None:
+                break
+            study_id, path, attempt = item
+            started = time.monotonic()
+            try:
+                ds = dcmread(path)
+                sop_class = UID(ds.SOPClassUID)
+                transfer_syntax = UID(ds.file_meta.TransferSyntaxUID)
+                if self.contexts.is_rejected(sop_class, transfer_syntax):
+                    raise ValueError(f"{self.ae_title} does not accept {sop_class.name} in {transfer_syntax.name}")
+                assoc = self._associate(assoc, sop_class, transfer_syntax)
+                self._store(assoc, ds, sop_class, transfer_syntax, path)
+            except (ValueError, FileNotFoundError) as e:
+                logger.error(f"Not forwarding {path} to {self.name}: {e}")
+                self._finish(study_id, path, REJECTED)
+            except Exception as e:
+                logger.warning(f"Failed to forward {path} to {self.name} (attempt {attempt + 1}): {e}")
+                if assoc is not None and not assoc.is_established:
+                    assoc = None
+                self._retry(item)
+            else:
+                metrics.FORWARD_SECONDS.labels(metrics.destination_label(self.name)).observe(
+                    time.monotonic() - started)
+                self._finish(study_id, path, FORWARDED)
+        self._release(assoc)
+
+    def close(self):
+        """Stop the workers and release their associations; queued instances are forwarded again on the next push."""
+        with self.cond:
+            self.stopping = True
+            timers, self.timers = self.timers, set()
+        for timer in timers:
+            timer.cancel()
+        # Drop what is still queued so the workers stop promptly
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        with self.cond:
+            for study_id, paths in self.pending.items():
+                self.failed.setdefault(study_id, set()).update(paths)
+            self._wake(list(self.pending))
+            self.pending.clear()
@@ -0,0 +1,51 @@
+import zlib
+from io import BytesIO
+
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_file_meta_info
+from pydicom.uid import UID
+
+SOP_INSTANCE_UID = 0x00080018
+STUDY_INSTANCE_UID = 0x0020000D
+SERIES_INSTANCE_UID = 0x0020000E
+NUMBER_OF_STUDY_RELATED_INSTANCES = 0x00201208
+
+PREAMBLE = b"\x00" * 128 + b"DICM"
+
+
+def _past_routing(tag, vr, length):
+    return tag > NUMBER_OF_STUDY_RELATED_INSTANCES
+
+
+def read_routing_dataset(raw, transfer_syntax):
+    """Parse an encoded dataset up to (0020,1208) and return the partial dataset.
+
+    Pixel data and everything after Number of Study Related Instances are
+    never looked at; the UIDs, Modality and the other group 0008 elements
+    are available.
+    """
+    transfer_syntax = UID(transfer_syntax)
+    if transfer_syntax.is_deflated:
+        raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+    return read_dataset(BytesIO(raw), transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian,
+                        stop_when=_past_routing)
+
+
+def read_routing_uids(raw, transfer_syntax):
+    """Return ``(study, series, sop instance)`` UIDs from an encoded dataset."""
+    ds = read_routing_dataset(raw, transfer_syntax)
+    return str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID), str(ds.SOPInstanceUID)
+
+
+def write_raw_instance(fileobj, file_meta, raw):
+    """Write a DICOM Part 10 file from file meta and the dataset bytes as received."""
+    fileobj.write(PREAMBLE)
+    write_file_meta_info(fileobj, file_meta)
+    fileobj.write(raw)
+
+
+def encode_raw_instance(file_meta, raw):
+    """Return the Part 10 encoding of a received dataset without decoding it."""
+    buffer = BytesIO()
+    write_raw_instance(buffer, file_meta, raw)
+    return buffer.getvalue()
@@ -1,112 +1,320 @@
 import os
-import time
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 from pynetdicom import AE, evt, AllStoragePresentationContexts
-from transmission import send_archive
+from pynetdicom.sop_class import StorageCommitmentPushModel
+from batching import StudyBatcher, send_batch, study_files
+from commitment import CommitmentReporter
+from completion import CompletionDetector
+from destinations import load_destinations, pending, route
+from dicom_forwarder import DicomForwarder
+from http_client import HTTPClient
+from incremental_archive import IncrementalArchiver
+from instance_index import InstanceIndex, plan_delta
+import metrics
+from journal import SENT, StudyJournal
+from outbound import OutboundQueue
+from pipeline import CHECKSUM, IO, Pipeline
+from receiver import ReceiverPool, association_key, index_path, observe_store, open_writer, store_instance
+from retry import RetryPolicy
+from scheduler import StudyScheduler
+from spool import SpoolManager
+from transcoder import Transcoder
+from transmission import (archive_path_for, compress_study, compute_checksum, delete_local_study_files,
+                          send_archive)
+from upload_scheduler import BandwidthShaper, SchedulingPolicy, UploadQueue
 
 logger = logging.getLogger(__name__)
 
+# Recording an instance reported by a receiver process; it was acknowledged already, so it cannot be refused
+RECORD_RETRY = RetryPolicy(max_attempts=5, base_delay=0.5)
+
 
 class DICOMServer:
     def __init__(self, config):
         self.config = config
         self.ae = AE()
         self.ae.supported_contexts = AllStoragePresentationContexts
-        self.handlers = [(evt.EVT_C_STORE, self.handle_store)]
-        self.study_timers = {}  # Track asyncio tasks for each study
-        self.study_last_received = {}  # Track last file received time for each study
+        self.ae.add_supported_context(StorageCommitmentPushModel)
+        self.handlers = [
+            (evt.EVT_C_STORE, self.handle_store),
+            (evt.EVT_N_ACTION, self.handle_n_action),
+            (evt.EVT_DIMSE_SENT, lambda event: self.commitment.on_sent(event)),
+            (evt.EVT_RELEASED, lambda event: self.on_association_closed(association_key(event.assoc), True)),
+            (evt.EVT_CONN_CLOSE, self.handle_conn_close),
+        ]
         self.loop = asyncio.get_event_loop()  # Main event loop
-        self.executor = ThreadPoolExecutor(max_workers=5)  # Thread pool for offloading tasks
+        # Blocking work after a study is ready runs in stages sized separately (see ``pipeline``)
+        self.pipeline = Pipeline(self.config.get('pipeline'))
+        self.scheduler = StudyScheduler(self.loop, self.config.get('timeout', 60), self.on_study_ready)
+        # Learns quiet timeouts per calling AE and modality and acts on explicit completion signals
+        self.completion = CompletionDetector(self.scheduler, self.config.get('timeout', 60),
+                                             **self.config.get('completion', {}))
+        self.server_thread = None
+        self.receivers = None
+
+        # Study state is journaled on disk so unsent studies survive a restart
+        base_dir = self.config['storage']['base_dir']
+        os.makedirs(base_dir, exist_ok=True)
+        self.journal = StudyJournal(
+            self.config['storage'].get('journal', os.path.join(base_dir, '.bounce-journal.sqlite')))
+        # Content-addressed record of stored instances: drops exact re-sends, enables delta uploads
+        self.index = InstanceIndex(index_path(self.config['storage']))
+        # Storage Commitment requests are answered with an N-EVENT-REPORT once the instances are indexed
+        self.commitment = CommitmentReporter(self.index, **self.config.get('commitment', {}))
+        # Instances are written behind the association threads by dedicated I/O threads
+        self.writer = open_writer(self.config['storage'])
+        # Bound the bytes held under base_dir: refuse instances when full, evict delivered studies
+        self.spool = None
+        spool = self.config['storage'].get('spool') or {}
+        if spool.get('high_watermark'):
+            self.spool = SpoolManager(base_dir, spool['high_watermark'], spool.get('low_watermark'),
+                                      on_full=self._on_spool_full, on_evict=self._on_spool_evict)
+            metrics.SPOOL_BYTES.set_function(lambda: self.spool.used)
+        # Optionally append each instance to its study's archive as it is stored
+        self.archiver = None
+        if self.config['storage'].get('incremental_archive', False):
+            self.archiver = IncrementalArchiver(base_dir, self.config.get('compression'),
+                                                self.config.get('encryption', {}).get('key'))
+        # Optionally re-encode uncompressed instances losslessly, in worker processes, before they are archived
+        self.transcoder = None
+        if self.config['storage'].get('transcode'):
+            self.transcoder = Transcoder(**self.config['storage']['transcode'])
+        transmission = self.config.get('transmission', {})
+        # Where studies go: one endpoint, or several with routing rules
+        self.destinations = load_destinations(transmission)
+        # DICOM destinations are relayed to over pooled C-STORE associations as instances arrive
+        self.forwarders = {destination.name: DicomForwarder(destination.name, **destination.dicom)
+                           for destination in self.destinations if destination.dicom}
+        # Ready studies are ordered by priority class and fair share; uploads are paced by bandwidth caps
+        scheduling = self.config.get('scheduling') or {}
+        self.shaper = BandwidthShaper(scheduling.get('bandwidth'))
+        self.http = HTTPClient(
+            per_destination=transmission.get('max_in_flight', 4),
+            keepalive_timeout=transmission.get('keepalive_timeout', 60),
+            shaper=self.shaper,
+        )
+        # Request-level retries; the outbound queue retries whole studies on a longer horizon
+        self.retry_policy = RetryPolicy(**transmission.get('retry', {'max_attempts': 3}))
+        # Optionally send small studies together, amortizing per-request overhead
+        batcher = None
+        if transmission.get('batching'):
+            if self.archiver is not None:
+                logger.warning("Incremental archives are built per study; small studies will not be batched")
+            elif len(self.destinations) > 1 or self.forwarders:
+                logger.warning("Studies are fanned out to several destinations or relayed over DICOM; "
+                               "small studies will not be batched")
+            else:
+                options = {key: value for key, value in transmission['batching'].items() if key != 'api_endpoint'}
+                batcher = StudyBatcher(self.send_batch, **options)
+        self.outbound = OutboundQueue(
+            self.journal,
+            self.push_study,
+            workers=transmission.get('workers', 4),
+            max_attempts=transmission.get('max_attempts', 5),
+            retry_delay=transmission.get('retry_delay', 30),
+            queue=UploadQueue(SchedulingPolicy(scheduling)),
+            batcher=batcher,
+        )
+        metrics.STUDIES_PENDING.set_function(self.scheduler.pending)
+        metrics.QUEUE_DEPTH.set_function(self.outbound.depth)
+        # The stages before the pipeline's own: instances waiting to be written, studies waiting for a worker
+        metrics.PIPELINE_QUEUE_DEPTH.labels('store').set_function(self.writer.depth)
+        metrics.PIPELINE_QUEUE_DEPTH.labels('ready').set_function(self.outbound.depth)
 
     def start_in_thread(self):
-        """Start the DICOM server in a separate thread."""
+        """Start the DICOM server in a separate thread, or in receiver processes with ``dicom.workers`` > 1."""
         logger.info(f"Starting DICOM server on {self.config['dicom']['host']}:{self.config['dicom']['port']}")
-        self.ae.start_server((self.config['dicom']['host'], self.config['dicom']['port']), evt_handlers=self.handlers)
+        workers = self.config['dicom'].get('workers', 1)
+        if workers > 1:
+            self.receivers = ReceiverPool(self.config, workers, self.on_receiver_event)
+            self.receivers.spool_full.value = int(self.spool is not None and self.spool.full)
+            self.receivers.start()
+            return
+        self.server_thread = threading.Thread(
+            target=self.ae.start_server,
+            args=((self.config['dicom']['host'], self.config['dicom']['port']),),
+            kwargs={'evt_handlers': self.handlers},
+            name="DICOMServer",
+            daemon=True,
+        )
+        self.server_thread.start()
 
-    def handle_store(self, event):
-        """Handle incoming C-STORE requests synchronously."""
-        ds = event.dataset
-        ds.file_meta = event.file_meta
+    async def start_outbound(self):
+        """Re-queue studies left unsent by a previous run and start the upload workers."""
+        if self.spool is not None:
+            await self.pipeline.run(IO, self.spool.scan, self.journal.in_state(SENT))
+        requeue, debounce = await self.pipeline.run(IO, self.outbound.recover, self.config['storage']['base_dir'])
+        for study_id in debounce:
+            self.scheduler.touch(study_id)
+        for study_id in requeue:
+            self.outbound.enqueue(study_id)
+        self.outbound.start()
 
-        study_id = ds.StudyInstanceUID
-        series_id = ds.SeriesInstanceUID
-        sop_instance = ds.SOPInstanceUID
+    async def close(self):
+        """Flush pending writes, stop the upload workers, close pooled connections, the stages and the journal."""
+        await self.pipeline.run(IO, self.writer.close)
+        await self.outbound.stop()
+        await self.http.close()
+        if self.transcoder is not None:
+            await self.pipeline.run(IO, self.transcoder.close)
+        for forwarder in self.forwarders.values():
+            await self.pipeline.run(IO, forwarder.close)
+        if self.archiver is not None:
+            self.archiver.close()
+        if self.spool is not None:
+            self.spool.close()
+        self.index.close()
+        self.journal.close()
+        self.pipeline.close()
 
-        # Construct the path where the file will be saved
-        study_path = f"{self.config['storage']['base_dir']}/{study_id}/{series_id}"
-        os.makedirs(study_path, exist_ok=True)  # Ensure the directory exists
-        file_path = f"{study_path}/{sop_instance}.dcm"
+    def reconfigure_scheduling(self, scheduling):
+        """Apply new priority rules, fair shares and bandwidth caps; call on the loop's thread.
 
-        logger.info(f"Saving DICOM file to {file_path}")
+        The policy is validated before anything changes, so a bad config leaves the current one in place.
+        """
+        policy = SchedulingPolicy(scheduling)
+        self.outbound.queue.configure(policy)
+        self.shaper.configure(scheduling.get('bandwidth'))
+        self.config['scheduling'] = scheduling
 
-        try:
-            # Save the DICOM file synchronously
-            ds.save_as(file_path, write_like_original=False)
-            logger.info(f"Stored DICOM file: {file_path}")
+    def shutdown(self):
+        """Stop accepting associations and disarm the study scheduler."""
+        self.ae.shutdown()
+        if self.receivers is not None:
+            self.receivers.shutdown()
+        self.loop.call_soon_threadsafe(self.scheduler.close)
 
-            # Update last received time for the study
-            self.study_last_received[study_id] = time.time()
+    def handle_store(self, event):
+        """Handle incoming C-STORE requests synchronously (see ``receiver.store_instance``)."""
+        started = time.perf_counter()
+        status, outcome, size = store_instance(event, self.config['storage'], self.index, self.writer,
+                                               self._on_stored, admit=self.spool and self.spool.admit,
+                                               refund=self.spool and self.spool.refund)
+        observe_store(outcome, size, time.perf_counter() - started)
+        return status
 
-            # Cancel any existing task for this study
-            if study_id in self.study_timers:
-                self.study_timers[study_id].cancel()
+    def _on_stored(self, *record):
+        if not self.instance_stored(*record):
+            raise RuntimeError(f"Could not record stored instance {record[3]}")
 
-            # Start a new asyncio task to handle the timeout in a thread-safe way
-            timeout = self.config.get('timeout', 60)  # Default to 60 seconds
-            try:
-                logger.info(f"Scheduling push for study {study_id} with timeout {timeout}")
+    def on_receiver_event(self, kind, payload):
+        """Called for every event a receiver process reports."""
+        if kind == 'stored':
+            if self.spool is not None:
+                self.spool.charge(payload[0], max(payload[4]['size'] - payload[4].get('replaced_size', 0), 0))
+            self._record_reported(payload)
+        elif kind == 'handled':
+            observe_store(*payload)
+        elif kind == 'closed':
+            self.on_association_closed(*payload)
+        elif kind == 'commitment':
+            self.on_commitment(payload)
 
-                # Check if event loop is running
-                if self.loop.is_running():
-                    logger.info("Event loop is running, scheduling coroutine...")
-                else:
-                    logger.error("Event loop is not running!")
+    def _record_reported(self, record, attempt=0):
+        """Record an instance a receiver process has stored and acknowledged, retrying with backoff on failure."""
+        if self.instance_stored(*record):
+            return
+        metrics.RECORD_FAILURES.inc()
+        if attempt + 1 >= RECORD_RETRY.max_attempts:
+            logger.error(f"Gave up recording stored instance {record[3]} of study {record[0]}; "
+                         f"it stays on disk for the next recovery scan")
+            return
+        timer = threading.Timer(RECORD_RETRY.backoff(attempt), self._record_reported, args=(record, attempt + 1))
+        timer.daemon = True
+        timer.start()
 
-                # Log the current thread to check threading issues
-                import threading
-                logger.info(f"Current thread: {threading.current_thread().name}")
+    def handle_n_action(self, event):
+        """Storage Commitment requests tell us the modality has sent the referenced instances.
 
-                # Use executor to offload the task to a separate thread
-                self.loop.run_in_executor(self.executor, self.schedule_study_push, study_id, timeout)
+        The commitment result follows as an N-EVENT-REPORT (see ``commitment.CommitmentReporter``).
+        """
+        self.on_commitment(self.commitment.requested(event))
+        return 0x0000, None
 
-            except Exception as e:
-                logger.error(f"Failed to schedule study push for {study_id}: {e}")
+    def on_commitment(self, sop_instance_uids):
+        entries = (self.index.get(sop_instance_uid) for sop_instance_uid in sop_instance_uids)
+        study_ids = {entry['study_id'] for entry in entries if entry is not None}
+        if study_ids:
+            self.loop.call_soon_threadsafe(self.completion.commitment_requested, study_ids)
 
-            return 0x0000  # Success status
+    def handle_conn_close(self, event):
+        self.commitment.forget(event.assoc)
+        self.on_association_closed(association_key(event.assoc), False)
 
-        except Exception as e:
-            logger.error(f"Failed to save DICOM file: {e}")
-            return 0xC000  # Failure status
+    def on_association_closed(self, association, released):
+        self.loop.call_soon_threadsafe(self.completion.association_closed, association, released)
+
+    def _on_spool_full(self, full):
+        metrics.SPOOL_FULL.set(int(full))
+        if self.receivers is not None:
+            self.receivers.spool_full.value = int(full)
+
+    def _on_spool_evict(self, study_id):
+        if self.archiver is not None:
+            self.archiver.forget(study_id)
 
-    def schedule_study_push(self, study_id, timeout):
-        """Run the asynchronous schedule task in a separate thread using an executor."""
-        asyncio.run(self._schedule_study_push_async(study_id, timeout))
+    def instance_stored(self, study_id, sop_instance, checksum, file_path, attributes=None):
+        """Index, archive and journal a stored instance and push back its study's deadline.
 
-    async def _schedule_study_push_async(self, study_id, timeout):
-        """Asynchronous version of schedule_study_push."""
-        logger.info(f"Scheduling study push for {study_id} with a timeout of {timeout} seconds.")
+        ``attributes`` (size, calling AE title, modality) are journaled for upload scheduling.
+
+        Returns False if any of it failed.
+        """
         try:
-            # Sleep for the duration of the timeout
-            await asyncio.sleep(timeout)
-            logger.info(f"Timeout reached for study {study_id}. Preparing to push the study.")
+            self.index.record(sop_instance, study_id, checksum, file_path)
+
+            attributes = attributes or {}
+            if self.transcoder is not None and self.transcoder.wants(attributes.get('modality')):
+                # Archived once it has been rewritten
+                self.transcoder.submit(study_id, file_path,
+                                       on_done=lambda report: self._on_transcoded(study_id, file_path, report))
+            elif self.archiver is not None:
+                self.archiver.add(study_id, file_path)
+
+            self.journal.record_instance(study_id, size=attributes.get('size', 0),
+                                         calling_ae=attributes.get('calling_ae'), modality=attributes.get('modality'))
+            if self.forwarders:
+                # Relayed right away rather than once the study is complete
+                study = self.journal.get(study_id)
+                for destination in self.destinations:
+                    if destination.dicom and destination.matches(study):
+                        self.forwarders[destination.name].forward(study_id, file_path)
+
+            # Push back (or bring forward) the study's quiet deadline on the main loop
+            self.loop.call_soon_threadsafe(self.completion.instance_stored, study_id, attributes)
+            return True
 
-            # Log the last time a file was received for this study (debugging info)
-            last_received = self.study_last_received.get(study_id, None)
-            if last_received:
-                time_since_last = time.time() - last_received
-                logger.info(f"Last DICOM file received for study {study_id} was {time_since_last:.2f} seconds ago.")
+        except Exception as e:
+            logger.error(f"Failed to record stored instance {file_path}: {e}")
+            return False
+
+    def _on_transcoded(self, study_id, file_path, report):
+        if self.spool is not None and report is not None and report['bytes_out'] != report['bytes_in']:
+            self.spool.charge(study_id, report['bytes_out'] - report['bytes_in'])
+        if self.archiver is not None:
+            self.archiver.add(study_id, file_path)
 
-            # After the timeout, push the study
-            await self.push_study(study_id)
+    def on_study_ready(self, study_id):
+        """Called by the scheduler once a study has received nothing for the timeout."""
+        logger.info(f"Study {study_id} is complete. Queueing the study for sending.")
+        self.completion.forget(study_id)
+        entry = self.journal.get(study_id)
+        if entry is not None:
+            metrics.STUDY_INSTANCES.observe(entry['instances'])
+        self.outbound.enqueue(study_id)
 
-        except asyncio.CancelledError:
-            logger.info(f"Timeout for study {study_id} was cancelled due to new file arrival.")
-            # If the task was cancelled, simply return
+    async def push_study(self, study_id, on_state=None):
+        """Send the study after the timeout; returns True once every required destination has it.
 
-    async def push_study(self, study_id):
-        """Send the study after the timeout."""
+        The study goes to each destination whose rules match it and that
+        lacks its newest instances, so a retry after a partial failure only
+        sends to the destinations that failed. Archive destinations share
+        one archive, uploaded to them concurrently; DICOM destinations have
+        been sent the instances as they arrived and are only waited for.
+        """
         logger.info(f"Pushing study {study_id} after timeout.")
 
         study_path = f"{self.config['storage']['base_dir']}/{study_id}"
@@ -114,17 +322,193 @@ class DICOMServer:
 
         if not os.path.exists(study_path):
             logger.error(f"Study path {study_path} does not exist. Cannot push study.")
-            return
+            return False
 
         try:
-            # Send the archive (compression is handled within send_archive)
-            logger.info(f"Sending archive for study {study_id}")
-            await send_archive(
-                self.config['transmission']['api_endpoint'],
-                self.config['transmission']['api_key'],
-                study_path,
-                delete_after_send=self.config.get('delete_after_send', False)
-            )
-            logger.info(f"Study {study_id} sent successfully.")
+            if self.transcoder is not None:
+                # Waiting, not working, so not in a stage; nor on a thread
+                await asyncio.wrap_future(self.transcoder.idle(study_id))
+            started = time.time()
+            targets = route(self.destinations, self.journal.get(study_id))
+            if not targets:
+                logger.error(f"No destination accepts study {study_id}. Cannot push study.")
+                return False
+            deliveries = self.journal.deliveries(study_id)
+            due = pending(targets, deliveries, self.index.latest_stored(study_id))
+            if not due:
+                logger.info(f"Study {study_id} has nothing new since it was last sent.")
+                return True
+
+            uploads = [destination for destination in due if not destination.dicom]
+            relays = [destination for destination in due if destination.dicom]
+            results, *relayed = await asyncio.gather(
+                self._upload(study_id, study_path, uploads, deliveries, on_state),
+                *(self._relay(study_id, study_path, destination, deliveries.get(destination.name))
+                  for destination in relays))
+            results.update(zip((destination.name for destination in relays), relayed))
+            for name, ok in results.items():
+                if ok:
+                    deliveries[name] = started
+                    self.journal.record_delivery(study_id, name, started)
+                else:
+                    logger.error(f"Failed to send study {study_id} to {name}.")
+                    self.journal.record_delivery(study_id, name, error="delivery failed")
+
+            # Destinations that were not due already have what there is
+            failed = {name for name, ok in results.items() if not ok}
+            required = [destination for destination in targets if destination.required]
+            delivered = not any(d.name in failed for d in required) if required else len(failed) < len(due)
+            if delivered:
+                logger.info(f"Study {study_id} sent successfully.")
+                # Only what every required destination has counts as delivered
+                self._mark_delivered(study_id, min(deliveries[d.name] for d in required) if required else started)
+                if self.config.get('delete_after_send', False):
+                    try:
+                        delete_local_study_files(study_path)
+                        logger.info(f"Successfully deleted local files for study {study_path}")
+                    except Exception as e:
+                        logger.error(f"Error while deleting local files for study {study_path}: {e}")
+            return delivered
         except Exception as e:
             logger.error(f"Failed to send study {study_id}: {e}")
+            return False
+        finally:
+            if self.spool is not None:
+                # Archives are left next to the study whether or not the upload went through
+                compression = self.config.get('compression')
+                key = self.config.get('encryption', {}).get('key')
+                paths = [archive_path_for(study_path, compression, key, delta) for delta in (False, True)]
+                await self.pipeline.run(IO, self.spool.track_archives, study_id, paths)
+
+    async def _upload(self, study_id, study_path, destinations, deliveries, on_state=None):
+        """Archive the study once and upload it to each of ``destinations``; returns ``{name: delivered}``."""
+        if not destinations:
+            return {}
+        archive = None
+        if self.archiver is not None:
+            # Only the compressor's tail is left to flush
+            archive = await self.pipeline.run(IO, self.archiver.finalize, study_id)
+        # A study that was delivered before only needs its new instances; with several destinations,
+        # those new since the one that has the least of it
+        through = [deliveries.get(destination.name) for destination in destinations]
+        delta = None
+        if None not in through:
+            delta = await self.pipeline.run(IO, plan_delta, self.index, study_id, study_path, min(through))
+        elif len(self.destinations) == 1:
+            delta = await self.pipeline.run(IO, plan_delta, self.index, study_id, study_path)
+        if delta is not None:
+            if not delta[0]:
+                logger.info(f"Study {study_id} has nothing new since it was last sent.")
+                return {destination.name: True for destination in destinations}
+            logger.info(f"Study {study_id} was sent before; sending {len(delta[0])} new instances.")
+            archive = None
+
+        if len(destinations) > 1 and archive is None:
+            # Compress (and encrypt) once for every destination
+            if on_state is not None:
+                on_state('compressing')
+            path = await compress_study(study_path, self.config.get('compression'),
+                                        self.config.get('encryption', {}).get('key'), delta, self.pipeline)
+            archive = (path, await self.pipeline.run(CHECKSUM, compute_checksum, path))
+            delta = None
+
+        # Send the archive (compression is handled within send_archive unless it was built already)
+        logger.info(f"Sending archive for study {study_id} to {', '.join(d.name for d in destinations)}")
+        results = await asyncio.gather(*(
+            send_archive(
+                destination.api_endpoint,
+                destination.api_key,
+                study_path,
+                streaming=self.config['transmission'].get('streaming', False) and len(destinations) == 1,
+                compression=self.config.get('compression'),
+                on_state=on_state,
+                client=self.http,
+                chunked=self.config['transmission'].get('chunked'),
+                policy=self.retry_policy,
+                encryption_key=self.config.get('encryption', {}).get('key'),
+                archive=archive,
+                delta=delta,
+                destination=destination.name if len(self.destinations) > 1 else None,
+                pipeline=self.pipeline
+            )
+            for destination in destinations
+        ))
+        return {destination.name: delivered for destination, delivered in zip(destinations, results)}
+
+    async def _relay(self, study_id, study_path, destination, delivered_through=None):
+        """Wait for a DICOM destination to have every instance of the study; returns whether it does."""
+        forwarder = self.forwarders[destination.name]
+        # Picks up instances stored before a restart and those given up on last time
+        delta = None
+        if delivered_through is not None:
+            delta = await self.pipeline.run(IO, plan_delta, self.index, study_id, study_path, delivered_through)
+        files = delta[0] if delta is not None else await self.pipeline.run(IO, study_files, study_path)
+        forwarder.forward_study(study_id, [os.path.join(study_path, rel_path) for rel_path in files])
+        # Instances may wait out retries for a while; waiting, not working, so not in a stage nor on a thread
+        await asyncio.wrap_future(forwarder.idle(study_id))
+        return forwarder.delivered(study_id)
+
+    def _mark_delivered(self, study_id, started):
+        """Record that what the study held at ``started`` (a ``time.time()``) has been delivered."""
+        self.index.mark_sent(study_id, started)
+        if self.archiver is not None:
+            self.archiver.forget(study_id)
+        for forwarder in self.forwarders.values():
+            forwarder.forget(study_id)
+        if self.spool is not None:
+            self.spool.mark_sent(study_id, started)
+            if self.config.get('delete_after_send', False):
+                self.spool.release(study_id)
+
+    async def send_batch(self, study_ids, on_state=None):
+        """Send small studies in one archive (see ``batching``); returns ``{study_id: delivered}``."""
+        base_dir = self.config['storage']['base_dir']
+        transmission = self.config['transmission']
+        started = time.time()
+        results, studies = {}, []
+        for study_id in study_ids:
+            study_path = f"{base_dir}/{study_id}"
+            if not os.path.exists(study_path):
+                logger.error(f"Study path {study_path} does not exist. Cannot push study.")
+                results[study_id] = False
+                continue
+            if self.transcoder is not None:
+                await asyncio.wrap_future(self.transcoder.idle(study_id))
+            delta = await self.pipeline.run(IO, plan_delta, self.index, study_id, study_path)
+            if delta is not None and not delta[0]:
+                logger.info(f"Study {study_id} has nothing new since it was last sent.")
+                results[study_id] = True
+                continue
+            studies.append((study_id, study_path, delta))
+        if not studies:
+            return results
+
+        # Batch archives live in a dot directory, which the spool and recovery scans skip
+        work_dir = os.path.join(base_dir, '.batches')
+        os.makedirs(work_dir, exist_ok=True)
+        # Batching is only enabled with a single destination
+        destination = self.destinations[0]
+        results.update(await send_batch(
+            transmission.get('batching', {}).get('api_endpoint', destination.api_endpoint),
+            destination.api_key,
+            studies,
+            work_dir,
+            compression=self.config.get('compression'),
+            encryption_key=self.config.get('encryption', {}).get('key'),
+            client=self.http,
+            policy=self.retry_policy,
+            on_state=on_state,
+            pipeline=self.pipeline,
+        ))
+        for study_id, study_path, _ in studies:
+            if not results.get(study_id):
+                continue
+            self.journal.record_delivery(study_id, destination.name, started)
+            self._mark_delivered(study_id, started)
+            if self.config.get('delete_after_send', False):
+                try:
+                    delete_local_study_files(study_path)
+                except Exception as e:
+                    logger.error(f"Error while deleting local files for study {study_path}: {e}")
+        return results
+
@@ -1,10 +1,239 @@
-from cryptography.fernet import Fernet
+import base64
+import binascii
+import os
+import struct
+import time
 
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 
-def encrypt_file(input_file, output_file, key):
-    fernet = Fernet(key)
-    with open(input_file, "rb") as f:
-        data = f.read()
-    encrypted = fernet.encrypt(data)
-    with open(output_file, "wb") as f:
-        f.write(encrypted)
+import metrics
+
+# Segmented AES-256-GCM stream format:
+#
+#   header:  magic "BNC1" | version (1) | segment size (4, BE) | nonce prefix (7) | salt (16) |
+#            kdf (1) | kdf cost (1)
+#   body:    segments of `segment size` plaintext bytes, each sealed with a 16-byte tag
+#
+# Every segment uses the nonce  prefix | counter (4, BE) | last flag (1)  and
+# the header as associated data, so segments cannot be reordered, moved
+# between files or dropped from the end without failing authentication.
+# The per-file salt derives a fresh key with HKDF, so nonces never repeat
+# under one key. A passphrase (anything but a 32-byte base64 key) is first
+# stretched with scrypt, N = 2 ** cost, over the same salt.
+
+MAGIC = b"BNC1"
+VERSION = 2
+HEADER = struct.Struct(">4sBI7s16sBB")
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024  # A reader buffers one segment; larger ones in a header are refused
+MAX_SEGMENTS = 2 ** 32
+
+KDF_KEY = 0         # The secret is a random 32-byte key
+KDF_SCRYPT = 1      # The secret is a passphrase
+SCRYPT_COST = 15    # log2 of scrypt's N for new streams
+MAX_SCRYPT_COST = 20
+
+
+class DecryptionError(Exception):
+    """Raised when an encrypted stream is malformed, truncated or tampered with."""
+
+
+def _key_material(key):
+    """Return ``(kdf, secret)``: a Fernet-style urlsafe base64 key is used as is, other str/bytes are passphrases."""
+    if isinstance(key, str):
+        key = key.encode()
+    try:
+        decoded = base64.urlsafe_b64decode(key)
+        if len(decoded) == 32:
+            return KDF_KEY, decoded
+    except (binascii.Error, ValueError):
+        pass
+    return KDF_SCRYPT, key
+
+
+def _derive_key(secret, salt, kdf, cost):
+    if kdf == KDF_SCRYPT:
+        secret = Scrypt(salt=salt, length=32, n=2 ** cost, r=8, p=1).derive(secret)
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"bounce-stream-v2")
+    return hkdf.derive(secret)
+
+
+def _nonce(prefix, counter, last):
+    if counter >= MAX_SEGMENTS:
+        raise ValueError("Stream too long for one key")
+    return prefix + struct.pack(">IB", counter, 1 if last else 0)
+
+
+class StreamEncryptor:
+    """Incrementally encrypt a stream in constant memory.
+
+    Call ``update`` with plaintext as it becomes available and ``finalize``
+    at the end; each returns the ciphertext ready so far. One segment is
+    always held back so the final one can be flagged as last.
+    """
+
+    def __init__(self, key, segment_size=DEFAULT_SEGMENT_SIZE):
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise ValueError(f"Segment size must be between 1 and {MAX_SEGMENT_SIZE} bytes")
+        self.segment_size = segment_size
+        self.prefix = os.urandom(7)
+        salt = os.urandom(16)
+        kdf, secret = _key_material(key)
+        cost = SCRYPT_COST if kdf == KDF_SCRYPT else 0
+        self.header = HEADER.pack(MAGIC, VERSION, segment_size, self.prefix, salt, kdf, cost)
+        self.aead = AESGCM(_derive_key(secret, salt, kdf, cost))
+        self.counter = 0
+        self._buffer = bytearray()
+        self._header_sent = False
+
+    def _seal(self, segment, last):
+        sealed = self.aead.encrypt(_nonce(self.prefix, self.counter, last), bytes(segment), self.header)
+        self.counter += 1
+        return sealed
+
+    def update(self, data):
+        out = []
+        if not self._header_sent:
+            out.append(self.header)
+            self._header_sent = True
+        self._buffer += data
+        while len(self._buffer) > self.segment_size:
+            out.append(self._seal(self._buffer[:self.segment_size], last=False))
+            del self._buffer[:self.segment_size]
+        return b"".join(out)
+
+    def finalize(self):
+        out = self.update(b"") + self._seal(self._buffer, last=True)
+        self._buffer.clear()
+        return out
+
+
+class StreamDecryptor:
+    """Incrementally decrypt and authenticate a stream made by ``StreamEncryptor``."""
+
+    def __init__(self, key):
+        self.key = key
+        self.aead = None
+        self.header = None
+        self.counter = 0
+        self.finished = False
+        self._buffer = bytearray()
+
+    def _read_header(self):
+        magic, version, segment_size, prefix, salt, kdf, cost = HEADER.unpack(bytes(self._buffer[:HEADER.size]))
+        if magic != MAGIC or version != VERSION:
+            raise DecryptionError("Not a Bounce encrypted stream")
+        if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+            raise DecryptionError(f"Segment size {segment_size} out of range")
+        key_kdf, secret = _key_material(self.key)
+        if kdf != key_kdf:
+            raise DecryptionError("Stream was not encrypted with this kind of key (raw key or passphrase)")
+        if kdf == KDF_SCRYPT and not 0 < cost <= MAX_SCRYPT_COST:
+            raise DecryptionError(f"scrypt cost {cost} out of range")
+        self.header = bytes(self._buffer[:HEADER.size])
+        self.segment_size = segment_size
+        self.prefix = prefix
+        self.aead = AESGCM(_derive_key(secret, salt, kdf, cost))
+        del self._buffer[:HEADER.size]
+
+    def _open(self, sealed, last):
+        try:
+            plain = self.aead.decrypt(_nonce(self.prefix, self.counter, last), bytes(sealed), self.header)
+        except InvalidTag:
+            raise DecryptionError(f"Segment {self.counter} failed authentication")
+        self.counter += 1
+        return plain
+
+    def update(self, data):
+        self._buffer += data
+        if self.aead is None:
+            if len(self._buffer) < HEADER.size:
+                return b""
+            self._read_header()
+        sealed_size = self.segment_size + TAG_SIZE
+        out = []
+        while len(self._buffer) > sealed_size:
+            out.append(self._open(self._buffer[:sealed_size], last=False))
+            del self._buffer[:sealed_size]
+        return b"".join(out)
+
+    def finalize(self):
+        if self.aead is None:
+            raise DecryptionError("Stream ended before the header")
+        if len(self._buffer) < TAG_SIZE:
+            raise DecryptionError("Stream truncated")
+        out = self._open(self._buffer, last=True)
+        self._buffer.clear()
+        self.finished = True
+        return out
+
+
+class EncryptingWriter:
+    """Write-only file object that encrypts into ``fileobj``.
+
+    Drop it between a compressor and any sink (a file or a
+    ``streaming.QueueWriter``) to encrypt in the same streaming pass.
+    ``close`` writes the final segment but leaves ``fileobj`` open.
+    """
+
+    def __init__(self, fileobj, key, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.fileobj = fileobj
+        self.encryptor = StreamEncryptor(key, segment_size)
+        self.seconds = 0.0
+
+    def write(self, data):
+        started = time.perf_counter()
+        out = self.encryptor.update(data)
+        self.seconds += time.perf_counter() - started
+        if out:
+            self.fileobj.write(out)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.fileobj.write(self.encryptor.finalize())
+        metrics.ENCRYPTION_SECONDS.observe(self.seconds)
+
+
+async def encrypt_chunks(chunks, key, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Encrypt an async iterable of byte chunks as a streaming transform."""
+    encryptor = StreamEncryptor(key, segment_size)
+    async for chunk in chunks:
+        out = encryptor.update(chunk)
+        if out:
+            yield out
+    yield encryptor.finalize()
+
+
+async def decrypt_chunks(chunks, key):
+    """Decrypt and authenticate an async iterable of byte chunks."""
+    decryptor = StreamDecryptor(key)
+    async for chunk in chunks:
+        out = decryptor.update(chunk)
+        if out:
+            yield out
+    yield decryptor.finalize()
+
+
+def _transform_file(transform, input_file, output_file, chunk_size=DEFAULT_SEGMENT_SIZE):
+    with open(input_file, "rb") as src, open(output_file, "wb") as dst:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            dst.write(transform.update(chunk))
+        dst.write(transform.finalize())
+
+
+def encrypt_file(input_file, output_file, key, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Encrypt a file in constant memory using the segmented AES-GCM format."""
+    _transform_file(StreamEncryptor(key, segment_size), input_file, output_file)
+
+
+def decrypt_file(input_file, output_file, key):
+    """Decrypt and verify a file written by ``encrypt_file``."""
+    _transform_file(StreamDecryptor(key), input_file, output_file)
@@ -0,0 +1,111 @@
+import asyncio
+import contextlib
+import logging
+from urllib.parse import urlsplit
+
+import aiohttp
+from retry import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+
+def destination_key(url):
+    """Return the scheme://host:port a URL's connections are pooled under."""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    return f"{parts.scheme}://{parts.hostname}:{port}"
+
+
+class HTTPClient:
+    """One long-lived aiohttp session shared by every upload.
+
+    Connections are kept alive and reused across studies, DNS answers are
+    cached, and ``slot(url)`` caps the number of in-flight uploads per
+    destination so a burst of ready studies queues here instead of opening
+    a connection each. Each destination also gets a ``CircuitBreaker`` so a
+    failing endpoint is not hammered. Request bodies are paced by
+    ``shaper`` (an ``upload_scheduler.BandwidthShaper``) when one is given.
+    The session is created lazily on the running loop.
+    """
+
+    def __init__(self, limit=100, per_destination=4, keepalive_timeout=60, dns_cache_ttl=300,
+                 connect_timeout=30, read_timeout=300, failure_threshold=5, reset_timeout=30, shaper=None):
+        self.limit = limit
+        self.per_destination = per_destination
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.shaper = shaper
+        self.session = None
+        self.semaphores = {}
+        self.holding = {}  # destination -> uploads holding one of its slots
+        self.breakers = {}
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.per_destination,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        """Wait for a free upload slot for ``url``'s destination and yield the session."""
+        key = destination_key(url)
+        semaphore = self.semaphores.get(key)
+        if semaphore is None:
+            semaphore = self.semaphores[key] = asyncio.Semaphore(self.per_destination)
+        async with semaphore:
+            self.holding[key] = self.holding.get(key, 0) + 1
+            try:
+                yield self.get_session()
+            finally:
+                self.holding[key] -= 1
+
+    def breaker(self, url):
+        """Return the circuit breaker for ``url``'s destination."""
+        key = destination_key(url)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return breaker
+
+    def in_flight(self, url):
+        """Return the number of uploads currently holding a slot for ``url``."""
+        return self.holding.get(destination_key(url), 0)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+@contextlib.asynccontextmanager
+async def open_session(client, url):
+    """Yield ``client``'s pooled session for ``url``, or a one-off session without a client."""
+    if client is None:
+        async with aiohttp.ClientSession() as session:
+            yield session
+    else:
+        async with client.slot(url) as session:
+            yield session
+
+
+def shaped(client, url, body):
+    """Pace an async iterable request body by ``client``'s bandwidth limits, if any."""
+    if client is None or client.shaper is None:
+        return body
+    return client.shaper.shape(url, body)
+
+
+async def throttle(client, url, nbytes):
+    """Wait until ``nbytes`` may be sent to ``url`` under ``client``'s bandwidth limits, if any."""
+    if client is not None and client.shaper is not None:
+        await client.shaper.consume(url, nbytes)
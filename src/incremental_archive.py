@@ -0,0 +1,251 @@
+import glob
+import hashlib
+import io
+import logging
+import os
+import queue
+import tarfile
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+import metrics
+from compression import compression_report, is_precompressed, open_engine
+from encryption import EncryptingWriter
+from transmission import archive_path_for
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = ".partial"
+
+
+class _HashingWriter:
+    """Pass writes through to ``fileobj`` while hashing them."""
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        pass
+
+
+class StudyArchive:
+    """The archive of one study, appended to as its instances are stored.
+
+    Members are laid out like ``compression.write_archive`` (``./<series>/<file>``)
+    in arrival order. The output is hashed as it is written, so once
+    ``finalize`` has flushed the compressor the archive's SHA-256 is known
+    without reading it back. Until then it lives at ``<archive>.partial``.
+
+    A tar member cannot be replaced in place: a byte-identical duplicate of
+    an instance is skipped, while a changed one marks the archive stale and
+    ``finalize`` discards it so the caller rebuilds from disk. It is not
+    thread-safe; ``IncrementalArchiver`` drives each one from a single worker.
+    """
+
+    def __init__(self, study_path, archive_path, compression=None, encryption_key=None):
+        compression = dict(compression or {})
+        self.codec_aware = compression.pop('codec_aware', True)
+        self.study_path = study_path
+        self.archive_path = archive_path
+        self.partial_path = archive_path + PARTIAL_SUFFIX
+        self.members = {}  # arcname -> SHA-256 of the instance
+        self.seeded = False
+        self.stale = False
+        self.closed = False
+        self.seconds = 0.0  # Spent compressing, spread over the adds
+        self.hasher = hashlib.sha256()
+        self.file = open(self.partial_path, 'wb')
+        sink = _HashingWriter(self.file, self.hasher)
+        self.encryptor = EncryptingWriter(sink, encryption_key) if encryption_key else None
+        self.engine = open_engine(self.encryptor or sink, **compression)
+        self.tar = tarfile.open(fileobj=self.engine, mode="w")
+        self.tar.add(study_path, arcname=os.curdir, recursive=False)
+        self.dirs = {os.curdir}
+
+    def seed(self):
+        """Add every instance already on disk, e.g. stored by a previous run."""
+        for root, dirs, files in os.walk(self.study_path):
+            dirs.sort()
+            for file in sorted(files):
+                if not file.startswith('.'):
+                    self.add(os.path.join(root, file))
+        self.seeded = True
+
+    def add(self, file_path):
+        """Append one stored instance; returns False if it was already archived."""
+        arcname = os.path.join(os.curdir, os.path.relpath(file_path, self.study_path))
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        previous = self.members.get(arcname)
+        if previous is not None:
+            if previous != digest:
+                logger.warning(f"{arcname} changed after it was archived; the archive will be rebuilt")
+                self.stale = True
+            return False
+
+        parent = os.path.dirname(arcname)
+        if parent not in self.dirs:
+            self.tar.add(os.path.join(self.study_path, parent), arcname=parent, recursive=False)
+            self.dirs.add(parent)
+        tarinfo = self.tar.gettarinfo(file_path, arcname=arcname)
+        tarinfo.size = len(data)
+        started = time.monotonic()
+        self.engine.set_compressible(not (self.codec_aware and is_precompressed(file_path)))
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+        self.engine.set_compressible(True)
+        self.seconds += time.monotonic() - started
+        self.members[arcname] = digest
+        return True
+
+    def finalize(self):
+        """Finish the archive and return ``(path, sha256)``, or None if it was stale."""
+        self.closed = True
+        if self.stale:
+            self.abort()
+            return None
+        started = time.monotonic()
+        self.tar.close()
+        self.engine.close()
+        if self.encryptor is not None:
+            self.encryptor.close()
+        self.file.close()
+        os.replace(self.partial_path, self.archive_path)
+        report = compression_report(self.engine.name, self.engine.bytes_in, self.engine.bytes_out,
+                                    self.seconds + time.monotonic() - started)
+        metrics.observe_compression(report)
+        logger.info(f"Finalized incremental archive {self.archive_path}: {len(self.members)} instances, "
+                    f"ratio {report['ratio']:.2f}")
+        return self.archive_path, self.hasher.hexdigest()
+
+    def abort(self):
+        """Drop the partial archive."""
+        self.closed = True
+        self.file.close()
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class IncrementalArchiver:
+    """Keeps one open ``StudyArchive`` per study that is still receiving.
+
+    ``add`` is called from the C-STORE handler threads after an instance is
+    saved and only queues it: the read, hash and compression happen on
+    ``workers`` background threads, so the store is acknowledged without
+    waiting for them. A study always goes to the same worker, which is the
+    only thread touching its archive. ``finalize`` is called once the study
+    has gone quiet; it waits for the study's queued instances and leaves
+    only the compressor's tail to flush before the upload. The first
+    instance of a study seeds its archive from disk, which also covers
+    studies interrupted by a restart: their ``.partial`` archives cannot be
+    resumed (the compressor state is gone) and are removed at startup.
+    """
+
+    def __init__(self, base_dir, compression=None, encryption_key=None, workers=2):
+        self.base_dir = base_dir
+        self.compression = compression
+        self.encryption_key = encryption_key
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.finished = {}
+        for partial in glob.glob(os.path.join(glob.escape(base_dir), '*' + PARTIAL_SUFFIX)):
+            logger.info(f"Removing interrupted incremental archive {partial}")
+            os.remove(partial)
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.workers = [threading.Thread(target=self._run, args=(jobs,), name=f"IncrementalArchiver-{n}", daemon=True)
+                        for n, jobs in enumerate(self.queues)]
+        for worker in self.workers:
+            worker.start()
+
+    def _open(self, study_id):
+        study_path = os.path.join(self.base_dir, study_id)
+        archive_path = archive_path_for(study_path, self.compression, self.encryption_key)
+        return StudyArchive(study_path, archive_path, self.compression, self.encryption_key)
+
+    def _submit(self, fn, study_id, *args):
+        future = Future()
+        self.queues[zlib.crc32(study_id.encode()) % len(self.queues)].put((future, fn, study_id, args))
+        return future
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            future, fn, study_id, args = job
+            try:
+                future.set_result(fn(study_id, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def add(self, study_id, file_path):
+        """Queue a stored instance for its study's archive; the future says whether it was appended."""
+        return self._submit(self._add, study_id, file_path)
+
+    def _add(self, study_id, file_path):
+        with self.lock:
+            archive = self.archives.get(study_id)
+            if archive is None:
+                archive = self.archives[study_id] = self._open(study_id)
+                self.finished.pop(study_id, None)
+        if archive.stale:
+            return True  # Rebuilt from disk at finalize; stop feeding it
+        try:
+            if not archive.seeded:
+                archive.seed()
+                return True
+            return archive.add(file_path)
+        except Exception as e:
+            logger.error(f"Incremental archive of study {study_id} failed: {e}")
+            archive.stale = True
+            return True
+
+    def finalize(self, study_id):
+        """Return ``(path, sha256)`` of the study's finished archive, or None to build it from disk.
+
+        Blocks until the instances queued for the study before the call are in the archive.
+        """
+        return self._submit(self._finalize, study_id).result()
+
+    def _finalize(self, study_id):
+        with self.lock:
+            archive = self.archives.pop(study_id, None)
+            if archive is None:
+                return self.finished.get(study_id)
+        try:
+            result = archive.finalize()
+        except Exception as e:
+            logger.error(f"Could not finalize incremental archive of study {study_id}: {e}")
+            archive.abort()
+            result = None
+        if result is not None:
+            with self.lock:
+                if study_id not in self.archives:
+                    self.finished[study_id] = result
+        return result
+
+    def forget(self, study_id):
+        """Drop the record of a study's finished archive once it has been delivered."""
+        with self.lock:
+            self.finished.pop(study_id, None)
+
+    def close(self):
+        """Stop the workers and abort every open archive; they are rebuilt from disk after a restart."""
+        for jobs in self.queues:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        with self.lock:
+            archives, self.archives = list(self.archives.values()), {}
+        for archive in archives:
+            if not archive.closed:
+                archive.abort()
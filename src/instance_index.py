@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    sop_instance_uid TEXT PRIMARY KEY,
+    study_id TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    stored_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_by_study ON instances (study_id, sent);
+"""
+
+
+def content_hash(data):
+    """SHA-256 of an instance's dataset bytes as received."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_sha256(path):
+    """SHA-256 of a stored file, as it goes into an archive."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class InstanceIndex:
+    """Persistent, content-addressed record of every stored instance.
+
+    Keyed by SOPInstanceUID and the SHA-256 of the received dataset, so a
+    byte-identical re-send can be dropped before it reaches the disk, and
+    flagged once delivered, so a study that grows after it was sent can be
+    uploaded as a delta. Entries outlive ``delete_after_send``. Like the
+    ``StudyJournal`` it is one WAL-mode SQLite connection behind a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get(self, sop_instance_uid):
+        rows = self._execute("SELECT * FROM instances WHERE sop_instance_uid = ?", (sop_instance_uid,))
+        return dict(rows[0]) if rows else None
+
+    def is_duplicate(self, sop_instance_uid, sha256):
+        """True if this exact instance was already stored and is still on disk or was delivered."""
+        entry = self.get(sop_instance_uid)
+        if entry is None or entry['sha256'] != sha256:
+            return False
+        return bool(entry['sent']) or os.path.exists(entry['path'])
+
+    def record(self, sop_instance_uid, study_id, sha256, path):
+        """Note a stored instance; a changed one has to be sent again."""
+        self._execute(
+            "INSERT INTO instances (sop_instance_uid, study_id, sha256, path, stored_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(sop_instance_uid) DO UPDATE SET study_id = excluded.study_id, sha256 = excluded.sha256, "
+            "path = excluded.path, stored_at = excluded.stored_at, "
+            "sent = CASE WHEN sha256 = excluded.sha256 THEN sent ELSE 0 END",
+            (sop_instance_uid, study_id, sha256, path, time.time()),
+        )
+
+    def sent_paths(self, study_id):
+        """Return the paths of the study's instances that have been delivered."""
+        rows = self._execute("SELECT path FROM instances WHERE study_id = ? AND sent = 1", (study_id,))
+        return {row['path'] for row in rows}
+
+    def stored_through(self, study_id, stored_before):
+        """Return the paths of the study's instances stored before ``stored_before``."""
+        rows = self._execute("SELECT path FROM instances WHERE study_id = ? AND stored_at <= ?",
+                             (study_id, stored_before))
+        return {row['path'] for row in rows}
+
+    def latest_stored(self, study_id):
+        """Return when the study's newest instance was stored, or None for an unknown study."""
+        rows = self._execute("SELECT MAX(stored_at) AS latest FROM instances WHERE study_id = ?", (study_id,))
+        return rows[0]['latest']
+
+    def study(self, study_id):
+        rows = self._execute("SELECT * FROM instances WHERE study_id = ? ORDER BY path", (study_id,))
+        return [dict(row) for row in rows]
+
+    def mark_sent(self, study_id, stored_before):
+        """Flag the study's instances stored before ``stored_before`` as delivered."""
+        self._execute("UPDATE instances SET sent = 1 WHERE study_id = ? AND stored_at <= ?", (study_id, stored_before))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def plan_delta(index, study_id, study_path, delivered_through=None):
+    """Work out what of a study still has to be sent.
+
+    What counts as delivered is what is flagged sent, or with
+    ``delivered_through`` what was stored by then (for a destination that
+    got the study at a different time than the others). Returns None when
+    nothing was delivered before (send the whole study),
+    otherwise ``(files, manifest)``: the paths relative to ``study_path`` of
+    every file on disk that is not known to be delivered, and a manifest
+    describing them with the SHA-256 of each file as archived, like the
+    batch manifest. Files missing from the index count as new.
+    """
+    if delivered_through is None:
+        sent = index.sent_paths(study_id)
+    else:
+        sent = index.stored_through(study_id, delivered_through)
+    if not sent:
+        return None
+    entries = {entry['path']: entry for entry in index.study(study_id)}
+    files, instances = [], []
+    for root, dirs, names in os.walk(study_path):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if path in sent or name.startswith('.'):
+                continue
+            rel_path = os.path.relpath(path, study_path)
+            files.append(rel_path)
+            instances.append({'path': rel_path, 'sop_instance_uid': entries.get(path, {}).get('sop_instance_uid'),
+                              'sha256': file_sha256(path)})
+    manifest = {
+        'study_instance_uid': study_id,
+        'delta': True,
+        'previously_sent': len(sent),
+        'instances': instances,
+    }
+    return files, manifest
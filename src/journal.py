@@ -0,0 +1,197 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+RECEIVING = 'receiving'
+READY = 'ready'
+COMPRESSING = 'compressing'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+FINISHED_STATES = (SENT, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    study_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    instances INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    calling_ae TEXT,
+    modality TEXT
+)
+"""
+
+# Per-destination delivery of each study, for studies fanned out to several destinations
+DELIVERIES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    study_id TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    delivered_through REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (study_id, destination)
+)
+"""
+
+# Columns added since the first schema, with their definitions, for journals created by older versions
+ADDED_COLUMNS = {
+    'bytes': "INTEGER NOT NULL DEFAULT 0",
+    'calling_ae': "TEXT",
+    'modality': "TEXT",
+}
+
+
+class StudyJournal:
+    """Persistent record of every study between arrival and transmission.
+
+    Backed by SQLite in WAL mode so per-instance writes from the association
+    threads are cheap appends and survive a crash or ``os._exit``. One
+    connection is shared behind a lock; it is safe to call from any thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+        self.conn.execute(DELIVERIES_SCHEMA)
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(studies)")}
+        for name, definition in ADDED_COLUMNS.items():
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE studies ADD COLUMN {name} {definition}")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def record_instance(self, study_id, count=1, size=0, calling_ae=None, modality=None):
+        """Note that instances arrived; a finished study is reopened.
+
+        ``size`` bytes are added to the study; the calling AE title and
+        modality are kept from the first instance that carried them. A
+        failed study starts over with no attempts and no error.
+        """
+        now = time.time()
+        self._execute(
+            "INSERT INTO studies (study_id, state, instances, bytes, calling_ae, modality, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(study_id) DO UPDATE SET state = excluded.state, "
+            "instances = instances + excluded.instances, bytes = bytes + excluded.bytes, "
+            "calling_ae = COALESCE(calling_ae, excluded.calling_ae), modality = COALESCE(modality, excluded.modality), "
+            "attempts = CASE WHEN state = ? THEN 0 ELSE attempts END, "
+            "last_error = CASE WHEN state = ? THEN NULL ELSE last_error END, "
+            "updated_at = excluded.updated_at",
+            (study_id, RECEIVING, count, size, calling_ae, modality, now, now, FAILED, FAILED),
+        )
+
+    def set_state(self, study_id, state, error=None):
+        now = time.time()
+        self._execute(
+            "INSERT INTO studies (study_id, state, last_error, created_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(study_id) DO UPDATE SET state = excluded.state, last_error = excluded.last_error, "
+            "updated_at = excluded.updated_at",
+            (study_id, state, error, now, now),
+        )
+
+    def add_attempt(self, study_id):
+        """Increment and return the study's attempt count."""
+        with self.lock:
+            self.conn.execute("UPDATE studies SET attempts = attempts + 1, updated_at = ? WHERE study_id = ?",
+                              (time.time(), study_id))
+            row = self.conn.execute("SELECT attempts FROM studies WHERE study_id = ?", (study_id,)).fetchone()
+        return row['attempts'] if row else 0
+
+    def mark_sent(self, study_id, instances):
+        """Mark the study sent unless instances arrived after it had ``instances``; returns whether it was."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE studies SET state = ?, attempts = 0, last_error = NULL, updated_at = ? "
+                "WHERE study_id = ? AND instances = ?",
+                (SENT, time.time(), study_id, instances))
+        return cursor.rowcount > 0
+
+    def reset_attempts(self, study_id):
+        self._execute("UPDATE studies SET attempts = 0 WHERE study_id = ?", (study_id,))
+
+    def get(self, study_id):
+        rows = self._execute("SELECT * FROM studies WHERE study_id = ?", (study_id,))
+        return dict(rows[0]) if rows else None
+
+    def record_delivery(self, study_id, destination, delivered_through=None, error=None):
+        """Note an attempt to deliver a study to one destination.
+
+        A successful attempt passes ``delivered_through``, the ``time.time()``
+        up to which the study's instances are now at the destination; a
+        failed one passes the ``error`` and keeps the previous delivery.
+        """
+        self._execute(
+            "INSERT INTO deliveries (study_id, destination, delivered_through, attempts, last_error, updated_at) "
+            "VALUES (?, ?, ?, 1, ?, ?) "
+            "ON CONFLICT(study_id, destination) DO UPDATE SET attempts = attempts + 1, "
+            "delivered_through = COALESCE(excluded.delivered_through, delivered_through), "
+            "last_error = excluded.last_error, updated_at = excluded.updated_at",
+            (study_id, destination, delivered_through, error, time.time()),
+        )
+
+    def deliveries(self, study_id):
+        """Return ``{destination: delivered_through}`` for the study; None where nothing was delivered yet."""
+        rows = self._execute("SELECT destination, delivered_through FROM deliveries WHERE study_id = ?", (study_id,))
+        return {row['destination']: row['delivered_through'] for row in rows}
+
+    def unfinished(self):
+        """Return every study that has not reached sent or failed."""
+        placeholders = ", ".join("?" for _ in FINISHED_STATES)
+        rows = self._execute(f"SELECT * FROM studies WHERE state NOT IN ({placeholders})", FINISHED_STATES)
+        return [dict(row) for row in rows]
+
+    def in_state(self, state):
+        """Return the ids of every study in ``state``."""
+        return [row['study_id'] for row in self._execute("SELECT study_id FROM studies WHERE state = ?", (state,))]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def count_instances(study_path):
+    """Count the files below a study directory using ``os.scandir``."""
+    count = 0
+    stack = [study_path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                    count += 1
+    return count
+
+
+def scan_spool(base_dir, max_workers=8):
+    """Return ``{study_id: instance_count}`` for every study directory on disk.
+
+    Study directories are counted in parallel; on network storage each
+    ``scandir`` is dominated by round trips rather than CPU.
+    """
+    if not os.path.isdir(base_dir):
+        return {}
+    with os.scandir(base_dir) as entries:
+        study_paths = [entry.path for entry in entries
+                       if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        counts = pool.map(count_instances, study_paths)
+        return {os.path.basename(path): count for path, count in zip(study_paths, counts)}
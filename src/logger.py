@@ -1,15 +1,132 @@
+import atexit
+import json
 import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# Attributes every LogRecord has; anything else on a record came from ``extra``
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any ``extra`` fields (span, trace_id...)."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO, json_format=False, stream=None):
+    """Send every record through a queue to a listener thread that does the formatting and console I/O.
+
+    Logging call sites only pay for building the record and a queue put, so
+    association and writer threads never wait on the console. Calling it
+    again replaces the previous configuration.
+    """
+    global _handler, _listener
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JSONFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    with _lock:
+        root = logging.getLogger()
+        if _listener is not None:
+            root.removeHandler(_handler)
+            _listener.stop()
+        _handler = QueueHandler(records)
+        _listener = QueueListener(records, handler)
+        root.addHandler(_handler)
+        root.setLevel(level)
+        _listener.start()
+
+
+def stop_logging():
+    """Flush what is queued to the console; call before ``os._exit``."""
+    global _handler, _listener
+    with _lock:
+        if _listener is not None:
+            logging.getLogger().removeHandler(_handler)
+            _listener.stop()
+            _handler = _listener = None
+
+
+atexit.register(stop_logging)
 
 
 def get_logger(name):
-    # Configure logging programmatically (no need for YAML)
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.StreamHandler(),  # Logs to the console
-        ]
-    )
+    # Configure logging on first use; main() reconfigures it from the command line
+    if _listener is None:
+        configure_logging()
 
     # Return a logger instance
     return logging.getLogger(name)
+
+
+class RateLimitedLog:
+    """Lets at most ``burst`` messages per ``interval`` seconds through for each key.
+
+    Meant for per-instance messages on the C-STORE path: at thousands of
+    instances a second a line each would swamp the console, while a few a
+    second still show that traffic is flowing. The first message let
+    through after a quiet spell says how many were dropped.
+    """
+
+    def __init__(self, logger, burst=5, interval=1.0, clock=time.monotonic):
+        self.logger = logger
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        self.windows = {}  # key -> [window start, messages let through, messages dropped]
+        self.lock = threading.Lock()
+
+    def _admit(self, key):
+        """Return how many messages were dropped before this one, or None to drop it."""
+        now = self.clock()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                self.windows[key] = [now, 1, 0]
+                return window[2] if window else 0
+            if window[1] < self.burst:
+                window[1] += 1
+                return 0
+            window[2] += 1
+            return None
+
+    def log(self, level, key, message, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        dropped = self._admit(key)
+        if dropped is None:
+            return
+        if dropped:
+            message = f"{message} ({dropped} similar messages suppressed)"
+        kwargs.setdefault('stacklevel', 3)  # Attribute the record to the line that called info() and friends
+        self.logger.log(level, message, **kwargs)
+
+    def info(self, key, message, **kwargs):
+        self.log(logging.INFO, key, message, **kwargs)
+
+    def warning(self, key, message, **kwargs):
+        self.log(logging.WARNING, key, message, **kwargs)
+
+    def error(self, key, message, **kwargs):
+        self.log(logging.ERROR, key, message, **kwargs)
@@ -1,10 +1,14 @@
 import argparse
 import asyncio
+import json
 import os
 import signal
 import threading
+from compression import shutdown_pools
 from dicom_server import DICOMServer
-from logger import get_logger
+import profiler
+from metrics import start_metrics_server
+from logger import configure_logging, get_logger, stop_logging
 
 logger = get_logger(__name__)
 
@@ -15,22 +19,183 @@ def parse_arguments():
     parser.add_argument('--port', type=int, default=104, help='Port for the DICOM server to listen on')
     parser.add_argument('--destination', type=str, default='https://api.example.com',
                         help='Destination URL for transmission')
+    parser.add_argument('--destinations', type=str, default=None,
+                        help='JSON file listing destinations (name, api_endpoint and api_key or a dicom section '
+                             'for C-STORE relay, required, rules) to fan each study out to; replaces --destination')
+    parser.add_argument('--commitment-peers', type=str, default=None,
+                        help='JSON file mapping modality AE titles to {"host", "port"}, where Storage Commitment '
+                             'results are sent when the modality did not keep its association open for them')
     parser.add_argument('--api_key', type=str, required=True, help='API Key for transmission authentication')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of receiver processes sharing the DICOM port (SO_REUSEPORT); '
+                             'study state stays in the main process')
     parser.add_argument('--storage', type=str, default='/tmp/dicom_storage', help='Base directory to store DICOM files')
+    parser.add_argument('--raw-write', action='store_true',
+                        help='Store received datasets byte-for-byte without decoding and re-encoding them')
+    parser.add_argument('--incremental-archive', action='store_true',
+                        help='Append instances to their study archive as they arrive instead of compressing '
+                             'the whole study once it is complete')
+    parser.add_argument('--durability', type=str, default='write', choices=['enqueue', 'write', 'fsync'],
+                        help='When a C-STORE is acknowledged: once queued for writing, once written, '
+                             'or once fsynced with its group commit')
+    parser.add_argument('--io-threads', type=int, default=4, help='Number of threads writing received instances')
+    parser.add_argument('--fsync-interval', type=float, default=0.05,
+                        help='Seconds between group fsyncs of written instances (0 disables syncing)')
+    parser.add_argument('--spool-high-watermark', type=int, default=None,
+                        help='Refuse instances (0xA700) and evict delivered studies once the spool holds this many MB '
+                             '(unbounded by default)')
+    parser.add_argument('--spool-low-watermark', type=int, default=None,
+                        help='Accept instances again once eviction brings the spool down to this many MB '
+                             '(default 90%% of the high watermark)')
+    parser.add_argument('--transcode', type=str, default=None,
+                        help='Losslessly re-encode uncompressed instances before archiving: a comma-separated '
+                             'preference list of jpegls, j2k, rle and deflate, or auto for every installed codec')
+    parser.add_argument('--transcode-workers', type=int, default=1, help='Number of transcoding processes')
+    parser.add_argument('--transcode-modalities', type=str, default=None,
+                        help='Comma-separated modalities to transcode (default: all)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds without new instances after which a study is sent at the latest')
+    parser.add_argument('--min-timeout', type=float, default=2,
+                        help='Shortest quiet timeout learned from inter-arrival gaps per calling AE and modality')
+    parser.add_argument('--fixed-timeout', action='store_true',
+                        help='Always wait the full --timeout instead of learning it; explicit completion signals '
+                             '(association release, Number of Study Related Instances, Storage Commitment) '
+                             'still apply')
     parser.add_argument('--delete-after-send', action='store_true',
                         help='Delete local files after they are successfully sent')
+    parser.add_argument('--stream', action='store_true',
+                        help='Compress and upload studies in one streaming pass without writing a .tar.gz to disk')
+    parser.add_argument('--upload-workers', type=int, default=4,
+                        help='Number of studies uploaded concurrently from the outbound queue')
+    parser.add_argument('--max-in-flight', type=int, default=4,
+                        help='Maximum concurrent uploads to each destination over the shared connection pool')
+    parser.add_argument('--chunked-threshold', type=int, default=None,
+                        help='Upload archives of at least this many MB as resumable parts (disabled by default)')
+    parser.add_argument('--part-size', type=int, default=8, help='Size in MB of each resumable upload part')
+    parser.add_argument('--parallel-parts', type=int, default=4,
+                        help='Number of parts of one archive uploaded concurrently')
+    parser.add_argument('--batch-studies-under', type=float, default=None,
+                        help='Send ready studies of at most this many MB together in one archive (off by default)')
+    parser.add_argument('--batch-max-size', type=float, default=64, help='Size in MB at which a batch is sent')
+    parser.add_argument('--batch-max-studies', type=int, default=100, help='Number of studies at which a batch is sent')
+    parser.add_argument('--batch-max-age', type=float, default=5,
+                        help='Seconds the first study of a batch may wait for others')
+    parser.add_argument('--encryption-key', type=str, default=os.getenv('ENCRYPTION_KEY'),
+                        help='Encrypt archives with this key (AES-256-GCM, streamed); defaults to $ENCRYPTION_KEY')
+    parser.add_argument('--scheduling-config', type=str, default=None,
+                        help='JSON file with upload priority classes, rules, fair shares and bandwidth caps; '
+                             're-read on SIGHUP')
+    parser.add_argument('--bandwidth-limit', type=float, default=None,
+                        help='Cap total upload bandwidth at this many Mbit/s (overrides the scheduling config)')
+    parser.add_argument('--stage', action='append', default=[], metavar='NAME=WORKERS[:KIND]',
+                        help='Concurrency, and optionally executor kind (thread, process, async), of a pipeline '
+                             'stage: io, compress, checksum or upload; e.g. --stage compress=4:process. Repeatable')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port at /metrics (disabled by default)')
+    parser.add_argument('--codec', type=str, default='gzip', choices=['gzip', 'zstd', 'store'],
+                        help='Archive codec used to compress studies before upload')
+    parser.add_argument('--compress-level', type=int, default=None, help='Compression level for the chosen codec')
+    parser.add_argument('--compress-workers', type=int, default=1,
+                        help='Number of processes (gzip) or threads (zstd) used to compress each archive')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Log level; DEBUG adds per-instance receive and write spans')
+    parser.add_argument('--log-format', type=str, default='text', choices=['text', 'json'],
+                        help='Log as text lines or as one JSON object per line with span fields')
+    parser.add_argument('--profile-dir', type=str, default=None,
+                        help='Where SIGUSR1-triggered sampling profiles are written (default: the temp dir)')
 
     args = parser.parse_args()
+    chunked = None
+    if args.chunked_threshold is not None:
+        chunked = {'threshold': args.chunked_threshold * 1024 * 1024, 'part_size': args.part_size * 1024 * 1024,
+                   'parallel': args.parallel_parts}
+    transcode = None
+    if args.transcode:
+        transcode = {'syntaxes': args.transcode.split(','), 'workers': args.transcode_workers,
+                     'modalities': args.transcode_modalities.split(',') if args.transcode_modalities else None}
+    batching = None
+    if args.batch_studies_under is not None:
+        batching = {'study_bytes': args.batch_studies_under * 1024 * 1024,
+                    'max_bytes': args.batch_max_size * 1024 * 1024,
+                    'max_studies': args.batch_max_studies, 'max_age': args.batch_max_age}
+    spool = None
+    if args.spool_high_watermark is not None:
+        spool = {'high_watermark': args.spool_high_watermark * 1024 * 1024,
+                 'low_watermark': args.spool_low_watermark * 1024 * 1024 if args.spool_low_watermark else None}
     config = {
-        'dicom': {'host': '0.0.0.0', 'port': args.port},
-        'transmission': {'api_endpoint': args.destination, 'api_key': args.api_key},
-        'storage': {'base_dir': args.storage},
+        'dicom': {'host': '0.0.0.0', 'port': args.port, 'workers': args.workers},
+        'transmission': {'api_endpoint': args.destination, 'api_key': args.api_key, 'streaming': args.stream,
+                         'workers': args.upload_workers, 'max_in_flight': args.max_in_flight,
+                         'chunked': chunked, 'batching': batching,
+                         'destinations': load_destinations_file(args.destinations)},
+        'storage': {'base_dir': args.storage, 'raw_write': args.raw_write,
+                    'incremental_archive': args.incremental_archive, 'durability': args.durability,
+                    'io_threads': args.io_threads, 'fsync_interval': args.fsync_interval, 'spool': spool,
+                    'transcode': transcode},
+        'encryption': {'key': args.encryption_key},
+        'compression': {'codec': args.codec, 'level': args.compress_level, 'workers': args.compress_workers},
+        'pipeline': parse_stages(args.stage),
+        'metrics': {'port': args.metrics_port},
+        'logging': {'level': args.log_level, 'json_format': args.log_format == 'json'},
+        'profiling': {'directory': args.profile_dir},
+        'scheduling': load_scheduling(args.scheduling_config, args.bandwidth_limit),
+        'scheduling_source': {'path': args.scheduling_config, 'bandwidth_limit': args.bandwidth_limit},
+        'timeout': args.timeout,
+        'completion': {'adaptive': not args.fixed_timeout, 'min_timeout': args.min_timeout},
+        'commitment': {'peers': load_commitment_peers(args.commitment_peers)},
         'delete_after_send': args.delete_after_send
     }
 
     return config
 
 
+def parse_stages(specs):
+    """Turn ``--stage`` values (``NAME=WORKERS[:KIND]``) into the ``pipeline`` config section."""
+    stages = {}
+    for spec in specs:
+        name, _, value = spec.partition('=')
+        workers, _, kind = value.partition(':')
+        stages[name] = {'workers': int(workers), **({'kind': kind} if kind else {})}
+    return stages
+
+
+def load_scheduling(path, bandwidth_limit=None):
+    """Read the scheduling section from ``path``; ``bandwidth_limit`` in Mbit/s caps the global rate."""
+    scheduling = {}
+    if path:
+        with open(path) as f:
+            scheduling = json.load(f)
+    if bandwidth_limit:
+        scheduling.setdefault('bandwidth', {})['global'] = bandwidth_limit * 1e6 / 8
+    return scheduling
+
+
+def load_destinations_file(path):
+    """Read the list of destinations from ``path`` (see ``destinations.Destination``)."""
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_commitment_peers(path):
+    """Read ``{ae_title: {'host': ..., 'port': ...}}`` from ``path`` (see ``commitment.CommitmentReporter``)."""
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def reload_scheduling(dicom_server, path, bandwidth_limit=None):
+    """SIGHUP handler body: apply an edited scheduling config without restarting."""
+    try:
+        dicom_server.reconfigure_scheduling(load_scheduling(path, bandwidth_limit))
+        logger.info(f"Reloaded upload scheduling from {path}")
+    except Exception as e:
+        logger.error(f"Keeping the current upload scheduling; could not reload {path}: {e}")
+
+
 async def shutdown(loop, dicom_server):
     """Cleanup tasks tied to the event loop."""
     logger.info("Shutting down DICOM server and event loop...")
@@ -49,6 +214,13 @@ async def shutdown(loop, dicom_server):
         except Exception as e:
             logger.error(f"Error shutting down DICOM server: {e}")
 
+        # Stop the upload workers and close pooled connections; anything unsent
+        # is re-queued from the journal on the next start
+        try:
+            await dicom_server.close()
+        except Exception as e:
+            logger.error(f"Error closing outbound queue: {e}")
+
     # Cancel all running tasks
     tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
     for task in tasks:
@@ -61,7 +233,9 @@ async def shutdown(loop, dicom_server):
     loop.stop()
     logger.info("Event loop stopped.")
 
-    # Force exit in case any threads are hanging
+    # Force exit in case any threads are hanging; os._exit skips the atexit hooks
+    shutdown_pools()
+    stop_logging()
     os._exit(0)
 
 
@@ -74,6 +248,7 @@ def handle_exit(loop, dicom_server):
 async def start_server(dicom_server):
     """Start the DICOM server asynchronously in a separate thread."""
     try:
+        await dicom_server.start_outbound()
         dicom_server.start_in_thread()
     except Exception as e:
         logger.error(f"Failed to start DICOM server: {e}")
@@ -82,15 +257,24 @@ async def start_server(dicom_server):
 
 def main():
     config = parse_arguments()
+    configure_logging(**config['logging'])
 
     loop = asyncio.get_event_loop()
 
+    if config['metrics']['port']:
+        start_metrics_server(config['metrics']['port'])
+
     # Initialize and start the DICOM server
     dicom_server = DICOMServer(config)
     loop.create_task(start_server(dicom_server))
 
     # Setup a signal handler to directly catch SIGINT (Ctrl+C)
     signal.signal(signal.SIGINT, lambda s, f: handle_exit(loop, dicom_server))
+    # kill -USR1 starts a sampling profile of the running process; a second one writes it out
+    profiler.install(**config['profiling'])
+    # Priorities, shares and bandwidth caps can be changed at runtime
+    signal.signal(signal.SIGHUP, lambda s, f: loop.call_soon_threadsafe(
+        lambda: reload_scheduling(dicom_server, **config['scheduling_source'])))
 
     try:
         logger.info("Starting event loop...")
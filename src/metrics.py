@@ -0,0 +1,182 @@
+import logging
+import threading
+
+try:
+    import prometheus_client
+except ImportError:  # Metrics are optional
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# Every label value comes from configuration or a fixed set (outcome, codec,
+# destination host), never from a study, patient or calling AE, so the
+# number of series stays small however much traffic flows through.
+MAX_LABEL_VALUES = 32
+OTHER = "other"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+COUNT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+RATIO_BUCKETS = (1, 1.1, 1.25, 1.5, 2, 2.5, 3, 4, 6, 10)
+THROUGHPUT_BUCKETS = tuple(mb * 1e6 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+STAGE_BUCKETS = tuple(sorted(set(LATENCY_BUCKETS + DURATION_BUCKETS)))
+
+
+class _Noop:
+    """Stands in for every metric when prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, fn):
+        pass
+
+
+class BoundedLabel:
+    """Pass through the first ``limit`` distinct values of a label, fold the rest into 'other'."""
+
+    def __init__(self, limit=MAX_LABEL_VALUES):
+        self.limit = limit
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, value):
+        value = str(value)
+        with self.lock:
+            if value in self.seen:
+                return value
+            if len(self.seen) < self.limit:
+                self.seen.add(value)
+                return value
+        return OTHER
+
+
+destination_label = BoundedLabel()
+modality_label = BoundedLabel()
+
+if prometheus_client is not None:
+    REGISTRY = prometheus_client.CollectorRegistry()
+    _Counter = prometheus_client.Counter
+    _Gauge = prometheus_client.Gauge
+    _Histogram = prometheus_client.Histogram
+else:
+    REGISTRY = None
+
+    def _Counter(*args, **kwargs):
+        return _Noop()
+
+    _Gauge = _Histogram = _Counter
+
+
+def _metric(cls, name, documentation, labelnames=(), **kwargs):
+    return cls(f"bounce_{name}", documentation, labelnames, registry=REGISTRY, **kwargs)
+
+
+# Receiving
+CSTORE_SECONDS = _metric(_Histogram, "cstore_seconds", "C-STORE handling latency", ["outcome"],
+                         buckets=LATENCY_BUCKETS)
+RECEIVED_BYTES = _metric(_Counter, "received_bytes", "Dataset bytes received over C-STORE")
+INSTANCES = _metric(_Counter, "instances", "C-STORE requests by outcome (stored, duplicate, rejected, failed)",
+                    ["outcome"])
+WRITE_FAILURES = _metric(_Counter, "write_failures",
+                         "Instances the storage writer failed on, whatever the durability policy, by step "
+                         "(write, sync, on_written)", ["step"])
+RECORD_FAILURES = _metric(_Counter, "record_failures",
+                          "Instances stored by a receiver process that the coordinator failed to record (retried)")
+STUDY_INSTANCES = _metric(_Histogram, "study_instances", "Instances per study when it went quiet",
+                          buckets=COUNT_BUCKETS)
+STUDIES_PENDING = _metric(_Gauge, "studies_pending_debounce", "Studies waiting for their quiet timeout")
+QUEUE_DEPTH = _metric(_Gauge, "outbound_queue_depth", "Studies queued for upload")
+
+# Spool
+SPOOL_BYTES = _metric(_Gauge, "spool_bytes", "Bytes of instances and archives held in the spool")
+SPOOL_FULL = _metric(_Gauge, "spool_full", "1 while the spool is above its high watermark and refusing instances")
+SPOOL_EVICTIONS = _metric(_Counter, "spool_evictions", "Delivered studies evicted from the spool")
+SPOOL_EVICTED_BYTES = _metric(_Counter, "spool_evicted_bytes", "Bytes freed by spool eviction")
+
+# Transcoding
+TRANSCODED = _metric(_Counter, "transcoded_instances",
+                     "Instances through the transcoder by modality and outcome (transcoded, skipped, not_smaller, "
+                     "unsupported, failed)", ["modality", "outcome"])
+TRANSCODE_BYTES = _metric(_Counter, "transcode_bytes", "Instance bytes before and after transcoding",
+                          ["modality", "direction"])
+TRANSCODE_CPU_SECONDS = _metric(_Counter, "transcode_cpu_seconds", "CPU time spent transcoding", ["modality"])
+
+# Archiving
+COMPRESSION_SECONDS = _metric(_Histogram, "compression_seconds", "Time to write a study archive", ["codec"],
+                              buckets=DURATION_BUCKETS)
+COMPRESSION_RATIO = _metric(_Histogram, "compression_ratio", "Uncompressed / compressed archive size", ["codec"],
+                            buckets=RATIO_BUCKETS)
+COMPRESSION_BYTES = _metric(_Counter, "compression_bytes", "Archive bytes before and after compression",
+                            ["codec", "direction"])
+ENCRYPTION_SECONDS = _metric(_Histogram, "encryption_seconds", "CPU time spent encrypting one archive",
+                             buckets=DURATION_BUCKETS)
+
+# Uploading
+UPLOAD_SECONDS = _metric(_Histogram, "upload_seconds", "Time to deliver one archive", ["destination", "mode"],
+                         buckets=DURATION_BUCKETS)
+UPLOAD_BYTES = _metric(_Counter, "upload_bytes", "Archive bytes delivered", ["destination"])
+UPLOAD_THROUGHPUT = _metric(_Histogram, "upload_throughput_bytes_per_second", "Throughput of one archive upload",
+                            ["destination"], buckets=THROUGHPUT_BUCKETS)
+BATCH_STUDIES = _metric(_Histogram, "batch_studies", "Small studies sent together in one batch archive",
+                        buckets=COUNT_BUCKETS)
+FORWARDED = _metric(_Counter, "forwarded_instances",
+                    "Instances relayed over C-STORE by outcome (forwarded, retried, failed, rejected)",
+                    ["destination", "outcome"])
+FORWARD_SECONDS = _metric(_Histogram, "forward_seconds", "Time to relay one instance over C-STORE", ["destination"],
+                          buckets=LATENCY_BUCKETS)
+RETRIES = _metric(_Counter, "upload_retries", "Upload requests retried", ["destination"])
+FAILURES = _metric(_Counter, "upload_failures", "Upload requests given up on (fatal, exhausted, circuit_open, local)",
+                   ["destination", "reason"])
+
+# Pipeline
+PIPELINE_WORKERS = _metric(_Gauge, "pipeline_workers", "Configured concurrency of each pipeline stage", ["stage"])
+PIPELINE_QUEUE_DEPTH = _metric(_Gauge, "pipeline_queue_depth", "Work waiting for a worker of each pipeline stage",
+                               ["stage"])
+PIPELINE_BUSY = _metric(_Gauge, "pipeline_busy_workers", "Workers of each pipeline stage currently busy", ["stage"])
+PIPELINE_BUSY_SECONDS = _metric(_Counter, "pipeline_busy_seconds",
+                                "Worker time spent busy per pipeline stage; divide its rate by the workers "
+                                "for utilization", ["stage"])
+
+# Tracing
+STAGE_SECONDS = _metric(_Histogram, "stage_seconds",
+                        "Time spent in each pipeline stage (receive, write, debounce, compress, encrypt, upload)",
+                        ["stage"], buckets=STAGE_BUCKETS)
+
+
+def observe_compression(report):
+    """Record a ``compression.compression_report``."""
+    codec = report['codec']
+    COMPRESSION_SECONDS.labels(codec).observe(report['seconds'])
+    if report['bytes_out']:
+        COMPRESSION_RATIO.labels(codec).observe(report['ratio'])
+    COMPRESSION_BYTES.labels(codec, "in").inc(report['bytes_in'])
+    COMPRESSION_BYTES.labels(codec, "out").inc(report['bytes_out'])
+
+
+def observe_upload(destination, mode, size, seconds):
+    """Record one delivered archive."""
+    destination = destination_label(destination)
+    UPLOAD_SECONDS.labels(destination, mode).observe(seconds)
+    UPLOAD_BYTES.labels(destination).inc(size)
+    if seconds > 0:
+        UPLOAD_THROUGHPUT.labels(destination).observe(size / seconds)
+
+
+def start_metrics_server(port, addr="0.0.0.0"):
+    """Serve ``/metrics`` on ``port`` from a daemon thread; returns False without prometheus_client."""
+    if prometheus_client is None:
+        logger.warning("prometheus_client is not installed; metrics are disabled")
+        return False
+    prometheus_client.start_http_server(port, addr, registry=REGISTRY)
+    logger.info(f"Serving metrics on {addr}:{port}/metrics")
+    return True
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from journal import COMPRESSING, FAILED, READY, RECEIVING, SENDING, scan_spool
+from upload_scheduler import UploadQueue
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundQueue:
+    """Drain ready studies with a bounded pool of async workers.
+
+    Every state change is written to the ``StudyJournal`` first, so after a
+    crash ``recover`` can rebuild the queue from the journal and the spool
+    directory. ``send(study_id, on_state)`` does the actual work and returns
+    True once the study has been delivered. ``queue`` orders ready studies
+    (see ``upload_scheduler.UploadQueue``); by default they go first come,
+    first served. With a ``batcher`` (see ``batching.StudyBatcher``) small
+    studies are handed to it instead and their worker moves on; each is
+    finished when its batch has been sent.
+    """
+
+    def __init__(self, journal, send, workers=4, max_attempts=5, retry_delay=30, queue=None, batcher=None):
+        self.journal = journal
+        self.send = send
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = queue if queue is not None else UploadQueue()
+        self.batcher = batcher
+        self.queued = set()  # Studies waiting in the queue, so each is queued at most once
+        self.active = set()  # Studies a worker is sending right now
+        self.rerun = set()  # Studies that became ready again while being sent
+        self.retry_handles = {}
+        self.tasks = []
+
+    def start(self):
+        """Start the worker tasks; must be called with the event loop running."""
+        self.tasks = [asyncio.ensure_future(self._worker(n)) for n in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers. Interrupted studies are picked up again by ``recover``."""
+        for handle in self.retry_handles.values():
+            handle.cancel()
+        self.retry_handles.clear()
+        if self.batcher is not None:
+            await self.batcher.stop()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def enqueue(self, study_id):
+        """Mark a study ready and queue it for sending."""
+        self.journal.set_state(study_id, READY)
+        self._put(study_id)
+
+    def _put(self, study_id):
+        handle = self.retry_handles.pop(study_id, None)
+        if handle is not None:
+            handle.cancel()
+        if study_id in self.active:
+            self.rerun.add(study_id)
+            return
+        if study_id in self.queued:
+            return
+        self.queued.add(study_id)
+        self.queue.put_nowait(study_id, self.journal.get(study_id))
+
+    def depth(self):
+        return self.queue.qsize()
+
+    async def join(self):
+        """Wait until every queued study has been processed."""
+        await self.queue.join()
+
+    async def _worker(self, n):
+        while True:
+            study_id = await self.queue.get()
+            self.queued.discard(study_id)
+            self.active.add(study_id)
+            batched = False
+            try:
+                batched = self._batch(study_id)
+                if not batched:
+                    await self._process(study_id)
+            except Exception as e:
+                logger.error(f"Outbound worker {n} failed on study {study_id}: {e}")
+            finally:
+                if not batched:  # A batched study is released once its batch has been sent
+                    self._release(study_id)
+
+    def _release(self, study_id):
+        self.active.discard(study_id)
+        if study_id in self.rerun:
+            self.rerun.discard(study_id)
+            self._put(study_id)
+        self.queue.task_done()
+
+    def _batch(self, study_id):
+        """Hand a small study to the batcher; returns False if it has to be sent on its own."""
+        if self.batcher is None:
+            return False
+        study = self.journal.get(study_id)
+        if not self.batcher.accepts(study):
+            return False
+        attempts = self.journal.add_attempt(study_id)
+
+        def on_done(delivered):
+            try:
+                self._finish(study_id, attempts, study['instances'], delivered)
+            except Exception as e:
+                logger.error(f"Failed to record the batched send of study {study_id}: {e}")
+            finally:
+                self._release(study_id)
+
+        self.batcher.add(study_id, study, lambda state: self.journal.set_state(study_id, state), on_done)
+        return True
+
+    async def _process(self, study_id):
+        instances = (self.journal.get(study_id) or {}).get('instances')
+        attempts = self.journal.add_attempt(study_id)
+        delivered = await self.send(study_id, lambda state: self.journal.set_state(study_id, state))
+        self._finish(study_id, attempts, instances, delivered)
+
+    def _finish(self, study_id, attempts, instances, delivered):
+        """Record the outcome of a send that started when the study had ``instances`` instances."""
+        if delivered:
+            if self.journal.mark_sent(study_id, instances):
+                return
+            # The new instances were not in this send; the journal must not call them sent
+            logger.info(f"Study {study_id} received instances while it was sent; sending it again.")
+            self.journal.set_state(study_id, READY if study_id in self.rerun else RECEIVING)
+            self.journal.reset_attempts(study_id)
+            return
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up on study {study_id} after {attempts} attempts.")
+            self.journal.set_state(study_id, FAILED, error="maximum attempts exceeded")
+            return
+
+        delay = self.retry_delay * attempts
+        logger.info(f"Study {study_id} not delivered (attempt {attempts}); retrying in {delay} seconds.")
+        self.journal.set_state(study_id, READY, error="delivery failed")
+        loop = asyncio.get_running_loop()
+        self.retry_handles[study_id] = loop.call_later(delay, self._retry, study_id)
+
+    def _retry(self, study_id):
+        self.retry_handles.pop(study_id, None)
+        self._put(study_id)
+
+    def recover(self, base_dir):
+        """Find work left over from a previous run.
+
+        Returns ``(requeue, debounce)``: studies that were ready or
+        interrupted mid-send, and studies that were still receiving when the
+        process died and should go back through the debounce scheduler in
+        case the modality is still sending. Study directories the journal
+        has never seen are treated as ready. Blocking; run it in an executor.
+        """
+        on_disk = scan_spool(base_dir)
+        known = set()
+        requeue, debounce = [], []
+
+        for study in self.journal.unfinished():
+            study_id = study['study_id']
+            known.add(study_id)
+            if study_id not in on_disk:
+                self.journal.set_state(study_id, FAILED, error="study directory missing")
+            elif study['state'] == RECEIVING:
+                debounce.append(study_id)
+            elif study['state'] in (READY, COMPRESSING, SENDING):
+                requeue.append(study_id)
+
+        for study_id, count in on_disk.items():
+            if study_id in known or self.journal.get(study_id) is not None:
+                continue
+            self.journal.record_instance(study_id, count)
+            requeue.append(study_id)
+
+        logger.info(f"Recovered {len(requeue)} studies to send and {len(debounce)} still receiving "
+                    f"from {len(on_disk)} on disk.")
+        return requeue, debounce
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Kinds of executor a stage runs on
+THREAD = 'thread'    # Blocking disk work, and CPU work that releases the GIL
+PROCESS = 'process'  # CPU work that holds the GIL
+ASYNC = 'async'      # Network work on the event loop; the stage only bounds concurrency
+
+# Stages between a ready study and its delivery
+IO = 'io'
+COMPRESS = 'compress'
+CHECKSUM = 'checksum'
+UPLOAD = 'upload'
+
+DEFAULT_STAGES = {
+    IO: {'kind': THREAD, 'workers': 4, 'queue': 64},
+    COMPRESS: {'kind': THREAD, 'workers': 2, 'queue': 4},
+    CHECKSUM: {'kind': THREAD, 'workers': 2, 'queue': 8},
+    UPLOAD: {'kind': ASYNC, 'workers': 8, 'queue': 16},
+}
+
+
+class Stage:
+    """One step of the pipeline: ``workers`` run at a time, at most ``queue`` more wait.
+
+    A caller beyond that waits to get into the queue at all, so a slow
+    stage holds back the stage before it (ultimately the outbound workers,
+    which leave studies ready in the journal) instead of piling up work.
+    Queue depth, busy workers and busy seconds are exported per stage;
+    ``rate(busy_seconds) / workers`` is the stage's utilization.
+    """
+
+    def __init__(self, name, kind=THREAD, workers=1, queue=None):
+        if kind not in (THREAD, PROCESS, ASYNC):
+            raise ValueError(f"Unknown executor kind {kind!r} for stage {name}")
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = workers * 4 if queue is None else queue
+        self.executor = None
+        if kind == THREAD:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"Stage-{name}")
+        elif kind == PROCESS:
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.entry = asyncio.Semaphore(workers + self.queue_size)
+        self.slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.running = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+        metrics.PIPELINE_WORKERS.labels(name).set(workers)
+        metrics.PIPELINE_QUEUE_DEPTH.labels(name).set_function(lambda: self.waiting)
+        metrics.PIPELINE_BUSY.labels(name).set_function(lambda: self.running)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one of the stage's workers for the ``async with`` block."""
+        async with self.entry:
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            started = time.monotonic()
+            try:
+                yield
+            finally:
+                seconds = time.monotonic() - started
+                self.busy_seconds += seconds
+                metrics.PIPELINE_BUSY_SECONDS.labels(self.name).inc(seconds)
+                self.running -= 1
+                self.slots.release()
+
+    async def run(self, fn, *args):
+        """Run ``fn(*args)`` on the stage's executor, or await it for an async stage."""
+        async with self.slot():
+            if self.kind == ASYNC:
+                return await fn(*args)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def utilization(self):
+        """Fraction of the stage's worker time spent busy since it was created."""
+        elapsed = time.monotonic() - self.started
+        return self.busy_seconds / (self.workers * elapsed) if elapsed > 0 else 0.0
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Pipeline:
+    """The stages a ready study's work is spread over, each on its own kind of executor.
+
+    ``stages`` overrides ``DEFAULT_STAGES`` per stage, e.g.
+    ``{'compress': {'kind': 'process', 'workers': 4}, 'upload': {'workers': 16}}``,
+    so compression can be sized to the cores and uploads to the link.
+    Encryption runs inside the compress stage, in the same pass over the
+    archive.
+    """
+
+    def __init__(self, stages=None):
+        stages = stages or {}
+        unknown = set(stages) - set(DEFAULT_STAGES)
+        if unknown:
+            raise ValueError(f"Unknown pipeline stages {sorted(unknown)}; expected {list(DEFAULT_STAGES)}")
+        self.stages = {name: Stage(name, **{**defaults, **(stages.get(name) or {})})
+                       for name, defaults in DEFAULT_STAGES.items()}
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    async def run(self, stage, fn, *args):
+        return await self.stages[stage].run(fn, *args)
+
+    def slot(self, stage):
+        return self.stages[stage].slot()
+
+    def stats(self):
+        """Return ``{stage: {kind, workers, running, waiting, utilization}}``."""
+        return {
+            name: {'kind': stage.kind, 'workers': stage.workers, 'running': stage.running,
+                   'waiting': stage.waiting, 'utilization': stage.utilization()}
+            for name, stage in self.stages.items()
+        }
+
+    def close(self):
+        for name, stats in self.stats().items():
+            logger.info(f"Stage {name} ({stats['workers']} {stats['kind']} workers): "
+                        f"{stats['utilization']:.0%} utilized")
+        for stage in self.stages.values():
+            stage.close()
+
+
+async def run(pipeline, stage, fn, *args):
+    """Run ``fn(*args)`` in ``stage`` of ``pipeline``, or on the loop's default executor without one."""
+    if pipeline is None:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    return await pipeline.run(stage, fn, *args)
+
+
+def slot(pipeline, stage):
+    """``async with slot(pipeline, 'upload'):`` holds a worker of the stage, if there is a pipeline."""
+    if pipeline is None:
+        return contextlib.nullcontext()
+    return pipeline.slot(stage)
@@ -0,0 +1,99 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread each ``interval`` seconds.
+
+    Nothing is instrumented, so it can be switched on in a running process
+    at a cost of one stack walk per thread per sample. ``stop`` returns the
+    samples as folded stacks (``thread;outer;...;inner count``), which
+    flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.counts.clear()
+        self.samples = 0
+        self.started = time.monotonic()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and return the folded stacks."""
+        if not self.running:
+            return []
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return [f"{stack} {count}" for stack, count in self.counts.most_common()]
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def dump(self, directory):
+        """Stop sampling and write the profile under ``directory``; returns its path."""
+        seconds = time.monotonic() - self.started if self.started else 0
+        folded = self.stop()
+        path = os.path.join(directory, f"bounce-profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, 'w') as f:
+            f.write("\n".join(folded) + "\n")
+        logger.info(f"Wrote {self.samples} samples over {seconds:.1f}s to {path}")
+        return path
+
+
+def install(directory=None, interval=0.005, signum=signal.SIGUSR1):
+    """Let ``kill -USR1 <pid>`` start the profiler and the next one stop it and write the profile.
+
+    Must be called from the main thread. Returns the profiler.
+    """
+    directory = directory or tempfile.gettempdir()
+    profiler = SamplingProfiler(interval)
+
+    def toggle(signum, frame):
+        if profiler.running:
+            try:
+                profiler.dump(directory)
+            except OSError as e:
+                logger.error(f"Could not write profile to {directory}: {e}")
+        else:
+            logger.info(f"Sampling profiler started (every {interval * 1000:g} ms); signal again to stop")
+            profiler.start()
+
+    signal.signal(signum, toggle)
+    return profiler
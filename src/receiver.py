@@ -0,0 +1,293 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from pynetdicom import AE, evt, AllStoragePresentationContexts
+from pynetdicom.sop_class import StorageCommitmentPushModel
+from pynetdicom.transport import ThreadedAssociationServer
+
+import metrics
+import profiler
+import tracing
+from commitment import CommitmentReporter
+from dicom_io import read_routing_dataset, write_raw_instance
+from instance_index import InstanceIndex, content_hash
+from spool import OUT_OF_RESOURCES
+from logger import RateLimitedLog, configure_logging
+from storage_writer import WRITE, StorageWriter
+
+logger = logging.getLogger(__name__)
+# One line per instance would cost every C-STORE console I/O; a few a second show traffic is flowing
+instance_log = RateLimitedLog(logger)
+
+
+def index_path(storage):
+    return storage.get('index', os.path.join(storage['base_dir'], '.bounce-index.sqlite'))
+
+
+def store_instance(event, storage, index, writer, on_stored, admit=None, refund=None):
+    """Store a received instance below ``storage['base_dir']`` through ``writer``.
+
+    With ``storage['raw_write']`` the dataset is written exactly as
+    received, behind freshly encoded file meta; only the routing UIDs are
+    parsed. Otherwise it is fully decoded and re-encoded by pydicom. An
+    instance whose received bytes match one already in ``index`` is
+    acknowledged without being written again. ``admit(study_id, nbytes)``
+    may refuse the instance when the spool is full (see ``spool``); it is
+    then answered with 0xA700 (out of resources) so the modality retries.
+    The instance is charged in full; once written, ``refund(study_id, nbytes)``
+    hands back what the file it replaced held (measured by the writer, off
+    the association thread), and the whole charge if the write fails.
+
+    ``on_stored(study_id, sop_instance, checksum, file_path, attributes)``
+    is called by the writer once the instance meets the durability policy;
+    ``attributes`` holds the instance's size, calling AE title, modality,
+    Number of Study Related Instances and association for scheduling and
+    completion detection, and the size of the file it replaced. Returns
+    ``(status, outcome, size)`` as soon as the policy allows.
+    """
+    started = time.perf_counter()
+    raw_write = storage.get('raw_write', False)
+    raw = event.request.DataSet.getvalue()
+    checksum = content_hash(raw)
+    if raw_write:
+        routing = read_routing_dataset(raw, event.context.transfer_syntax)
+        study_id, series_id, sop_instance = (str(routing.StudyInstanceUID), str(routing.SeriesInstanceUID),
+                                             str(routing.SOPInstanceUID))
+        modality = routing.get('Modality')
+        expected = routing.get('NumberOfStudyRelatedInstances')
+        file_meta = event.file_meta
+
+        def encode(f):
+            write_raw_instance(f, file_meta, raw)
+    else:
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+
+        study_id = ds.StudyInstanceUID
+        series_id = ds.SeriesInstanceUID
+        sop_instance = ds.SOPInstanceUID
+        modality = ds.get('Modality')
+        expected = ds.get('NumberOfStudyRelatedInstances')
+
+        def encode(f):
+            ds.save_as(f, write_like_original=False)
+
+    if index.is_duplicate(sop_instance, checksum):
+        instance_log.info('duplicate', f"Dropping duplicate of instance {sop_instance} in study {study_id}")
+        return 0x0000, "duplicate", len(raw)
+
+    # Construct the path where the file will be saved; the writer creates the directory
+    file_path = f"{storage['base_dir']}/{study_id}/{series_id}/{sop_instance}.dcm"
+    charged = len(raw)
+
+    if admit is not None and not admit(study_id, charged):
+        instance_log.warning('rejected', f"Spool is full; refusing instance {sop_instance} of study {study_id}")
+        return OUT_OF_RESOURCES, "rejected", len(raw)
+
+    attributes = {'size': len(raw), 'calling_ae': str(event.assoc.requestor.ae_title).strip(),
+                  'modality': str(modality) if modality else None,
+                  'expected_instances': int(expected) if isinstance(expected, int) else None,
+                  'association': association_key(event.assoc), 'replaced_size': 0}
+
+    def write(f):
+        # On the writer's thread, before the new file replaces the old one
+        try:
+            attributes['replaced_size'] = os.path.getsize(file_path)
+        except OSError:
+            pass
+        encode(f)
+
+    def on_written():
+        nonlocal charged
+        credit = min(attributes['replaced_size'], charged)
+        if refund is not None and credit:
+            refund(study_id, credit)
+            charged -= credit
+        on_stored(study_id, sop_instance, checksum, file_path, attributes)
+
+    try:
+        future = writer.submit(file_path, write, on_written, study_id=study_id)
+        writer.wait(future)
+        instance_log.info('stored', f"Stored DICOM file: {file_path}")
+        tracing.record(tracing.RECEIVE, study_id, time.perf_counter() - started, logging.DEBUG)
+        return 0x0000, "stored", len(raw)
+
+    except Exception as e:
+        instance_log.error('failed', f"Failed to save DICOM file: {e}")
+        if refund is not None:
+            refund(study_id, charged)
+        return 0xC000, "failed", len(raw)
+
+
+def association_key(assoc):
+    """Identify an association uniquely across receiver processes."""
+    return f"{os.getpid()}:{id(assoc)}"
+
+
+def open_writer(storage):
+    """Build the ``StorageWriter`` configured by the ``storage`` section."""
+    return StorageWriter(
+        durability=storage.get('durability', WRITE),
+        io_threads=storage.get('io_threads', 4),
+        max_queued=storage.get('write_queue', 256),
+        fsync_interval=storage.get('fsync_interval', 0.05),
+    )
+
+
+def observe_store(outcome, size, seconds):
+    metrics.RECEIVED_BYTES.inc(size)
+    metrics.INSTANCES.labels(outcome).inc()
+    metrics.CSTORE_SECONDS.labels(outcome).observe(seconds)
+
+
+class ReusePortAssociationServer(ThreadedAssociationServer):
+    """Association server bound with SO_REUSEPORT so several processes can share one port."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def shutdown(self):
+        """Stop ``serve_forever``; the socket is closed by its caller.
+
+        A server from ``AE.make_server`` is not among the AE's servers, which
+        pynetdicom's ``shutdown`` tries to remove it from.
+        """
+        socketserver.BaseServer.shutdown(self)
+
+
+def run_receiver(config, events, worker_id, spool_full, stop):
+    """Entry point of one receiver process.
+
+    Stores instances like ``DICOMServer.handle_store`` and reports each one
+    to the coordinator through ``events``; it keeps no study state. The
+    index is only read here, to drop duplicates; the coordinator writes it.
+    Instances are refused while the coordinator sets the shared
+    ``spool_full`` flag. Setting ``stop`` closes the port, finishes the
+    queued writes and exits once their events have been flushed to
+    ``events``.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The coordinator decides when to stop
+    configure_logging(**config.get('logging', {}))
+    profiler.install(**config.get('profiling', {}))
+    storage = config['storage']
+    index = InstanceIndex(index_path(storage))
+    writer = open_writer(storage)
+    commitment = CommitmentReporter(index, **config.get('commitment', {}))
+
+    def on_stored(*record):
+        events.put(('stored', record))
+
+    def handle_store(event):
+        started = time.perf_counter()
+        status, outcome, size = store_instance(event, storage, index, writer, on_stored,
+                                               admit=lambda study_id, nbytes: not spool_full.value)
+        events.put(('handled', (outcome, size, time.perf_counter() - started)))
+        return status
+
+    def handle_n_action(event):
+        events.put(('commitment', commitment.requested(event)))
+        return 0x0000, None
+
+    def handle_conn_close(event):
+        commitment.forget(event.assoc)
+        events.put(('closed', (association_key(event.assoc), False)))
+
+    handlers = [
+        (evt.EVT_C_STORE, handle_store),
+        (evt.EVT_N_ACTION, handle_n_action),
+        (evt.EVT_DIMSE_SENT, commitment.on_sent),
+        (evt.EVT_RELEASED, lambda event: events.put(('closed', (association_key(event.assoc), True)))),
+        (evt.EVT_CONN_CLOSE, handle_conn_close),
+    ]
+    ae = AE()
+    ae.supported_contexts = AllStoragePresentationContexts
+    ae.add_supported_context(StorageCommitmentPushModel)
+    address = (config['dicom']['host'], config['dicom']['port'])
+    server = ae.make_server(address, evt_handlers=handlers, server_class=ReusePortAssociationServer)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    threading.Thread(target=lambda: stop.wait() and server.shutdown(), name="ReceiverStop", daemon=True).start()
+    logger.info(f"Receiver {worker_id} (pid {os.getpid()}) listening on {address[0]}:{address[1]}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        writer.close()
+        index.close()
+
+
+class ReceiverPool:
+    """N receiver processes sharing the DICOM port, reporting to one coordinator.
+
+    The kernel spreads incoming associations across the processes, so
+    decoding and writing scale past one GIL. Receivers report over a queue;
+    each ``(kind, payload)`` event is handed to ``on_event`` on a thread in
+    the coordinator: ``('stored', record)`` once an instance is durable per
+    the storage policy, ``('handled', (outcome, size, seconds))`` for every
+    C-STORE, ``('closed', (association, released))`` when an association
+    ends and ``('commitment', sop_instance_uids)`` for a Storage Commitment
+    request. The coordinator owns the journal, the index and the
+    study scheduler, so a study whose associations land on different
+    workers is still debounced and uploaded once.
+    """
+
+    def __init__(self, config, workers, on_event):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("Multiple receiver processes need SO_REUSEPORT, which this platform lacks")
+        self.config = config
+        self.workers = workers
+        self.on_event = on_event
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self.spool_full = self.context.Value('b', 0, lock=False)
+        self.stop = self.context.Event()
+        self.processes = []
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._drain, name="ReceiverEvents", daemon=True)
+        self.thread.start()
+        for worker_id in range(self.workers):
+            process = self.context.Process(target=run_receiver,
+                                           args=(self.config, self.events, worker_id, self.spool_full,
+                                                 self.stop),
+                                           name=f"Receiver-{worker_id}", daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def _drain(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                self.on_event(*event)
+            except Exception as e:
+                logger.error(f"Failed to handle receiver event {event}: {e}")
+
+    def shutdown(self, timeout=5):
+        """Stop the receivers, then deliver whatever they reported before exiting.
+
+        Receivers are asked to stop and given ``timeout`` seconds to finish
+        their writes; only one that is still running after that is
+        terminated. The sentinel queued behind their last events then ends
+        the drain thread once everything before it was handled.
+        """
+        self.stop.set()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+        for process in self.processes:
+            if process.is_alive():
+                logger.warning(f"Receiver {process.name} did not stop in time; terminating it")
+                process.terminate()
+                process.join(timeout)
+        self.events.put(None)
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,203 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+
+import aiohttp
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TransmissionError(Exception):
+    """Base class for classified upload failures."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RetryableError(TransmissionError):
+    """A failure worth retrying: timeouts, dropped connections, 5xx, 429."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
+class FatalError(TransmissionError):
+    """A failure that will not go away by retrying: 4xx, bad credentials, bad data."""
+
+
+class CircuitOpenError(RetryableError):
+    """The destination's circuit breaker is open; try again after ``retry_after``."""
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds from a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def classify_status(status, retry_after=None):
+    """Return the TransmissionError for an unsuccessful HTTP status."""
+    if status in RETRYABLE_STATUSES:
+        return RetryableError(f"HTTP {status}", status=status, retry_after=retry_after)
+    return FatalError(f"HTTP {status}", status=status)
+
+
+def classify_exception(error):
+    """Wrap an exception raised during an upload as retryable or fatal.
+
+    Returns None for a local failure (reading the archive, a bug) that says
+    nothing about the destination; callers let it propagate as it is.
+    """
+    if isinstance(error, TransmissionError):
+        return error
+    if isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+                          ConnectionError)):
+        return RetryableError(f"{type(error).__name__}: {error}")
+    if isinstance(error, aiohttp.ClientResponseError):
+        return classify_status(error.status)
+    return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After up to a cap."""
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, max_retry_after=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def backoff(self, attempt):
+        """Delay before retry number ``attempt + 1``: uniform in [0, min(cap, base * 2^attempt)]."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def delay_for(self, error, attempt):
+        if error.retry_after is not None:
+            return min(error.retry_after, self.max_retry_after)
+        return self.backoff(attempt)
+
+
+class CircuitBreaker:
+    """Stop sending to a destination after repeated failures.
+
+    After ``failure_threshold`` consecutive retryable failures the circuit
+    opens and calls fail fast with ``CircuitOpenError`` for
+    ``reset_timeout`` seconds. Then one trial call is let through
+    (half-open); its outcome closes the circuit or opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def before_call(self):
+        """Raise ``CircuitOpenError`` or let the call through; returns True if it is the half-open trial."""
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.reset_timeout - self.clock()
+            if remaining > 0:
+                raise CircuitOpenError("circuit open", retry_after=remaining)
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError("circuit half-open, trial in flight", retry_after=self.reset_timeout)
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def end_trial(self):
+        """Let another trial through if the last one ended without an outcome (e.g. cancelled)."""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit opened after {self.failures} consecutive failures.")
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+
+async def call_with_retry(attempt_fn, policy=None, breaker=None, description="request", sleep=asyncio.sleep,
+                          destination=None):
+    """Await ``attempt_fn(attempt)`` until it succeeds, retrying retryable failures.
+
+    Exceptions are classified with ``classify_exception``; fatal ones and
+    the last retryable one are raised, local failures as they are. Only a
+    destination that answered, if with an error status, counts as up for
+    the circuit breaker. An open circuit is not retried here:
+    the caller should give the destination time to recover. Retries and
+    failures are counted under ``destination`` (a ``destination_key``).
+    """
+    policy = policy or RetryPolicy()
+    label = metrics.destination_label(destination or "unknown")
+    for attempt in range(policy.max_attempts):
+        trial = False
+        if breaker is not None:
+            try:
+                trial = breaker.before_call()
+            except CircuitOpenError:
+                metrics.FAILURES.labels(label, "circuit_open").inc()
+                raise
+        try:
+            result = await attempt_fn(attempt)
+        except Exception as e:
+            error = classify_exception(e)
+            if error is None:
+                metrics.FAILURES.labels(label, "local").inc()
+                raise
+            if isinstance(error, FatalError):
+                if breaker is not None and error.status is not None:
+                    breaker.record_success()  # The destination answered; it is up
+                metrics.FAILURES.labels(label, "fatal").inc()
+                raise error from e
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt + 1 >= policy.max_attempts:
+                logger.error(f"All {policy.max_attempts} attempts failed for {description}: {error}")
+                metrics.FAILURES.labels(label, "exhausted").inc()
+                raise error from e
+            delay = policy.delay_for(error, attempt)
+            logger.warning(f"Attempt {attempt + 1} failed for {description}: {error}; "
+                           f"retrying in {delay:.1f} seconds")
+            metrics.RETRIES.labels(label).inc()
+            await sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+        finally:
+            if trial:
+                breaker.end_trial()
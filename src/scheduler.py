@@ -0,0 +1,108 @@
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StudyScheduler:
+    """Debounce study completion with a single timer on the event loop.
+
+    Every received instance only refreshes its study's deadline, which is an
+    O(1) dict update. Deadlines are kept in a min-heap with at most one live
+    entry per study; when an entry surfaces whose study has since been
+    touched again it is simply pushed back with the newer deadline. Only one
+    ``loop.call_at`` handle is ever armed, for the earliest deadline, so tens
+    of thousands of open studies cost no threads and no per-instance tasks.
+
+    All methods except ``touch_threadsafe`` must be called from the loop's
+    own thread.
+    """
+
+    def __init__(self, loop, timeout, on_ready):
+        self.loop = loop
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.deadlines = {}  # study_id -> loop time at which the study is quiet
+        self._heap = []  # (deadline, study_id), possibly stale
+        self._queued = {}  # study_id -> deadline of its live heap entry
+        self._handle = None
+        self._handle_deadline = None
+
+    def touch(self, study_id, timeout=None):
+        """Record activity for a study and push back its deadline."""
+        timeout = self.timeout if timeout is None else timeout
+        self.deadlines[study_id] = self.loop.time() + timeout
+        self._enqueue(study_id)
+
+    def touch_threadsafe(self, study_id, timeout=None):
+        """Record activity from a thread other than the loop's."""
+        self.loop.call_soon_threadsafe(self.touch, study_id, timeout)
+
+    def reschedule(self, study_id, deadline):
+        """Move an open study's deadline to an absolute loop time."""
+        if study_id not in self.deadlines:
+            return
+        self.deadlines[study_id] = deadline
+        self._enqueue(study_id)
+
+    def cancel(self, study_id):
+        """Forget a study without firing it."""
+        self.deadlines.pop(study_id, None)
+
+    def pending(self):
+        """Return the number of studies waiting to go quiet."""
+        return len(self.deadlines)
+
+    def close(self):
+        """Disarm the timer; pending studies are left unfired."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._handle_deadline = None
+
+    def _enqueue(self, study_id):
+        deadline = self.deadlines[study_id]
+        queued = self._queued.get(study_id)
+        # A later deadline is picked up lazily when the current entry
+        # surfaces; only an earlier one needs a fresh heap entry.
+        if queued is not None and queued <= deadline:
+            return
+        self._queued[study_id] = deadline
+        heapq.heappush(self._heap, (deadline, study_id))
+        self._arm()
+
+    def _arm(self):
+        if not self._heap:
+            self.close()
+            return
+        deadline = self._heap[0][0]
+        if self._handle is not None and self._handle_deadline <= deadline:
+            return
+        self.close()
+        self._handle = self.loop.call_at(deadline, self._fire)
+        self._handle_deadline = deadline
+
+    def _fire(self):
+        self._handle = None
+        self._handle_deadline = None
+        now = self.loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            entry_deadline, study_id = heapq.heappop(self._heap)
+            if self._queued.get(study_id) != entry_deadline:
+                continue  # superseded by an earlier entry
+            del self._queued[study_id]
+
+            deadline = self.deadlines.get(study_id)
+            if deadline is None:
+                continue  # cancelled
+            if deadline > now:
+                self._queued[study_id] = deadline
+                heapq.heappush(self._heap, (deadline, study_id))
+                continue
+
+            del self.deadlines[study_id]
+            try:
+                self.on_ready(study_id)
+            except Exception as e:
+                logger.error(f"Study ready callback failed for {study_id}: {e}")
+        self._arm()
@@ -1,31 +1,22 @@
-import asyncio
-
-import requests
 from logger import get_logger
+from retry import RetryPolicy
+from transmission import post_file
 
 logger = get_logger(__name__)
 
 
-async def send_archive(api_endpoint, api_key, encrypted_file_path, checksum, max_retries=5):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/octet-stream",
-        "X-Checksum": checksum
-    }
-    with open(encrypted_file_path, "rb") as f:
-        data = f.read()
+async def send_archive(api_endpoint, api_key, encrypted_file_path, checksum, max_retries=5, client=None):
+    """Stream an encrypted archive to the destination and return its JSON response.
 
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(api_endpoint, headers=headers, data=data, timeout=30)
-            response.raise_for_status()
-            return response.json()
-        except requests.RequestException as e:
-            logger.error(f"Attempt {attempt + 1}: Failed to send archive - {e}")
-            if attempt < max_retries - 1:
-                backoff = 2 ** attempt
-                logger.info(f"Retrying in {backoff} seconds...")
-                await asyncio.sleep(backoff)
-            else:
-                logger.error(f"All {max_retries} attempts failed.")
-                raise e
+    Uses the shared async transmission engine: the file is never read into
+    memory, retries back off with full jitter and honour ``Retry-After``,
+    and with a shared ``HTTPClient`` a failing destination trips its
+    circuit breaker. Raises ``retry.TransmissionError`` once retries are
+    exhausted or on a fatal response.
+    """
+    try:
+        return await post_file(api_endpoint, api_key, encrypted_file_path, checksum=checksum, client=client,
+                               policy=RetryPolicy(max_attempts=max_retries))
+    except Exception as e:
+        logger.error(f"Failed to send archive {encrypted_file_path}: {e}")
+        raise
@@ -0,0 +1,279 @@
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# DICOM C-STORE status: Refused, Out of Resources
+OUT_OF_RESOURCES = 0xA700
+
+
+class _StudyUsage:
+    __slots__ = ('bytes', 'archives', 'sent', 'charged_at')
+
+    def __init__(self):
+        self.bytes = 0  # Instances in the study directory
+        self.archives = {}  # Archive (and upload checkpoint) path -> size
+        self.sent = False
+        self.charged_at = 0
+
+    def total(self):
+        return self.bytes + sum(self.archives.values())
+
+
+def study_of_archive(name):
+    """Return the study a top-level spool file belongs to, e.g. ``<study>.delta.tar.gz.enc``."""
+    if '.tar' not in name:
+        return None
+    study_id = name.split('.tar')[0]
+    return study_id[:-len('.delta')] if study_id.endswith('.delta') else study_id
+
+
+def tree_size(path):
+    """Bytes used by the files below ``path``."""
+    size = 0
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+class SpoolManager:
+    """Bounds the bytes held under the spool directory.
+
+    Usage is counted once at startup (``scan``) and then kept up to date as
+    instances are admitted (``charge``), archives are built
+    (``track_archives``) and studies are deleted after sending
+    (``release``). Once usage reaches ``high_watermark`` the spool is full:
+    ``admit`` refuses new instances, which the C-STORE handler reports as
+    0xA700 so the modality backs off and retries, and an evictor thread
+    removes already delivered studies and their left-over archives, least
+    recently used first, until usage is back under ``low_watermark``.
+    Studies that still have undelivered instances are never evicted; if
+    nothing can be evicted the spool stays full until uploads catch up.
+
+    ``on_full(full)`` is called whenever the spool fills up or drains, and
+    ``on_evict(study_id)`` after a study has been evicted.
+    """
+
+    def __init__(self, base_dir, high_watermark, low_watermark=None, on_full=None, on_evict=None):
+        if low_watermark is None:
+            low_watermark = int(high_watermark * 0.9)
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("The spool low watermark must lie between 0 and the high watermark")
+        self.base_dir = base_dir
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_full = on_full or (lambda full: None)
+        self.on_evict = on_evict or (lambda study_id: None)
+        self.cond = threading.Condition()
+        self.studies = OrderedDict()  # study_id -> _StudyUsage, least recently used first
+        self.evicting = set()
+        self.used = 0
+        self.full = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._evict_loop, name="SpoolEvictor", daemon=True)
+        self.thread.start()
+
+    def scan(self, sent=()):
+        """Count what is on disk; ``sent`` are the studies already delivered. Call before receiving."""
+        studies = OrderedDict()
+        if os.path.isdir(self.base_dir):
+            with os.scandir(self.base_dir) as entries:
+                entries = sorted(entries, key=lambda entry: entry.stat(follow_symlinks=False).st_mtime)
+            for entry in entries:
+                if entry.name.startswith('.evicting-'):
+                    shutil.rmtree(entry.path, ignore_errors=True)  # Interrupted eviction
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    studies.setdefault(entry.name, _StudyUsage()).bytes = tree_size(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.endswith('.partial'):
+                    study_id = study_of_archive(entry.name)
+                    if study_id is not None:
+                        usage = studies.setdefault(study_id, _StudyUsage())
+                        usage.archives[entry.path] = entry.stat(follow_symlinks=False).st_size
+        for study_id in sent:
+            if study_id in studies:
+                studies[study_id].sent = True
+        with self.cond:
+            self.studies = studies
+            self.used = sum(usage.total() for usage in studies.values())
+        logger.info(f"Spool holds {self.used / 1e6:.1f} MB in {len(studies)} studies "
+                    f"(high watermark {self.high_watermark / 1e6:.1f} MB)")
+        self._changed()
+
+    def admit(self, study_id, nbytes):
+        """Charge an incoming instance to its study; False if the spool is full or the study is being evicted."""
+        with self.cond:
+            if self.full or study_id in self.evicting:
+                return False
+            self._charge(study_id, nbytes)
+        self._changed()
+        return True
+
+    def refund(self, study_id, nbytes):
+        """Hand back what ``admit`` charged for an instance that was not written after all."""
+        with self.cond:
+            usage = self.studies.get(study_id)
+            if usage is not None:
+                usage.bytes -= nbytes
+                self.used -= nbytes
+        self._changed()
+
+    def charge(self, study_id, nbytes):
+        """Account for ``nbytes`` of new instances; the study has something to send again."""
+        with self.cond:
+            self._charge(study_id, nbytes)
+        self._changed()
+
+    def _charge(self, study_id, nbytes):
+        usage = self._touch(study_id)
+        usage.bytes += nbytes
+        usage.sent = False
+        usage.charged_at = time.time()
+        self.used += nbytes
+
+    def track_archives(self, study_id, paths):
+        """Re-measure the archives that may exist for a study, e.g. after an upload attempt.
+
+        Each archive's upload checkpoints (``<archive>.upload.json`` and one
+        ``<archive>.upload-<destination>.json`` per destination) count too.
+        """
+        sizes = {}
+        for path in paths:
+            for candidate in [path, f"{path}.upload.json", *glob.glob(f"{glob.escape(path)}.upload-*.json")]:
+                try:
+                    sizes[candidate] = os.path.getsize(candidate)
+                except OSError:
+                    pass
+        with self.cond:
+            usage = self.studies.get(study_id)
+            if usage is None:
+                if not sizes:
+                    return
+                usage = self._touch(study_id)
+            for path in paths:
+                for candidate in list(usage.archives):
+                    if candidate == path or (candidate.startswith(f"{path}.upload") and candidate.endswith('.json')):
+                        self.used -= usage.archives.pop(candidate)
+            usage.archives.update(sizes)
+            self.used += sum(sizes.values())
+        self._changed()
+
+    def mark_sent(self, study_id, stored_before):
+        """The study has been delivered, so it may be evicted unless it received more since ``stored_before``."""
+        with self.cond:
+            usage = self.studies.get(study_id)
+            if usage is not None and usage.charged_at <= stored_before:
+                usage.sent = True
+                self.studies.move_to_end(study_id)
+        self._changed()
+
+    def release(self, study_id):
+        """The study directory has been deleted; its archives are still accounted for."""
+        with self.cond:
+            usage = self.studies.get(study_id)
+            if usage is not None:
+                self.used -= usage.bytes
+                usage.bytes = 0
+        self._changed()
+
+    def _touch(self, study_id):
+        usage = self.studies.get(study_id)
+        if usage is None:
+            usage = self.studies[study_id] = _StudyUsage()
+        else:
+            self.studies.move_to_end(study_id)
+        return usage
+
+    def _changed(self):
+        """Update the full flag with hysteresis and wake the evictor when needed."""
+        with self.cond:
+            was_full = self.full
+            if self.used >= self.high_watermark:
+                self.full = True
+            elif self.used <= self.low_watermark:
+                self.full = False
+            full = self.full
+            if full:
+                self.cond.notify()
+        if full != was_full:
+            if full:
+                logger.warning(f"Spool is full ({self.used / 1e6:.1f} MB); refusing instances until it drains "
+                               f"below {self.low_watermark / 1e6:.1f} MB")
+            else:
+                logger.info(f"Spool drained to {self.used / 1e6:.1f} MB; accepting instances again")
+            self.on_full(full)
+
+    def _candidate(self):
+        """Least recently used study that holds nothing undelivered."""
+        for study_id, usage in self.studies.items():
+            if usage.sent or usage.bytes == 0:
+                return study_id
+        return None
+
+    def _evict_loop(self):
+        stalled = False
+        while True:
+            with self.cond:
+                while not self.closed and not (self.full and self.used > self.low_watermark
+                                               and self._candidate() is not None):
+                    if self.full and not stalled and self._candidate() is None:
+                        logger.warning("Spool is full and holds nothing delivered to evict; waiting for uploads")
+                        stalled = True
+                    self.cond.wait()
+                if self.closed:
+                    return
+                stalled = False
+                study_id = self._candidate()
+                usage = self.studies.pop(study_id)
+                self.used -= usage.total()
+                self.evicting.add(study_id)
+            self._remove(study_id, usage)
+            metrics.SPOOL_EVICTIONS.inc()
+            metrics.SPOOL_EVICTED_BYTES.inc(usage.total())
+            logger.info(f"Evicted study {study_id} from the spool ({usage.total() / 1e6:.1f} MB)")
+            self.on_evict(study_id)
+            self._changed()
+
+    def _remove(self, study_id, usage):
+        study_path = os.path.join(self.base_dir, study_id)
+        doomed = os.path.join(self.base_dir, f".evicting-{study_id}")
+        try:
+            # Move it out of the way first so the study can be received again while it is deleted
+            os.replace(study_path, doomed)
+        except FileNotFoundError:
+            doomed = None
+        except OSError as e:
+            logger.error(f"Failed to evict study directory {study_path}: {e}")
+            doomed = None
+        finally:
+            with self.cond:
+                self.evicting.discard(study_id)
+        if doomed is not None:
+            shutil.rmtree(doomed, ignore_errors=True)
+        for path in usage.archives:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to evict archive {path}: {e}")
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
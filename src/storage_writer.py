@@ -0,0 +1,230 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# When a C-STORE is acknowledged
+ENQUEUE = 'enqueue'  # As soon as the instance is queued for writing; a crash can lose it
+WRITE = 'write'      # Once it is written and renamed into place
+FSYNC = 'fsync'      # Once the group commit holding it has been fsynced
+DURABILITY_POLICIES = (ENQUEUE, WRITE, FSYNC)
+
+
+class _Job:
+    __slots__ = ('path', 'temp', 'write', 'on_written', 'study_id', 'future')
+
+    def __init__(self, path, temp, write, on_written, study_id=None):
+        self.path = path
+        self.temp = temp
+        self.write = write
+        self.on_written = on_written
+        self.study_id = study_id
+        self.future = Future()
+
+
+class StorageWriter:
+    """Write-behind storage for received instances.
+
+    ``submit`` queues a write on a bounded queue (a full queue blocks the
+    association thread, which is the backpressure) served by ``io_threads``
+    dedicated threads. Each file is written to a hidden temp file next to
+    its destination and renamed into place, so readers never see a partial
+    instance. Series directories are created once and the ``max_dirs`` most
+    recently used are remembered.
+
+    With an ``fsync_interval`` a sync thread fsyncs what was written since
+    the last round, then each touched directory once (group commit). Under
+    the ``fsync`` policy files are only renamed into place after their
+    commit; otherwise syncing happens in the background. ``on_written`` is
+    called when the instance reaches the policy's point (after the write
+    for ``enqueue``) and its failure fails the future. Failures are logged
+    and counted here, as nobody waits on the future under ``enqueue``.
+    """
+
+    def __init__(self, durability=WRITE, io_threads=4, max_queued=256, fsync_interval=0.05, max_dirs=1024):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy {durability!r}; expected one of {DURABILITY_POLICIES}")
+        if durability == FSYNC and not fsync_interval:
+            raise ValueError("The fsync durability policy needs an fsync_interval")
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue(max_queued)
+        self.dirs = OrderedDict()  # Directories known to exist, least recently used first
+        self.max_dirs = max_dirs
+        self.dirs_lock = threading.Lock()
+        self.sync_cond = threading.Condition()
+        self.to_sync = []
+        self.closed = False
+        self._names = itertools.count()
+        self.threads = [threading.Thread(target=self._io_loop, name=f"StorageWriter-{n}", daemon=True)
+                        for n in range(io_threads)]
+        for thread in self.threads:
+            thread.start()
+        self.syncer = None
+        if fsync_interval:
+            self.syncer = threading.Thread(target=self._sync_loop, name="StorageSync", daemon=True)
+            self.syncer.start()
+
+    def submit(self, file_path, write, on_written=None, study_id=None):
+        """Queue ``write(fileobj)`` to produce ``file_path``; returns a Future of the path.
+
+        ``study_id`` only labels the write's tracing span.
+        """
+        directory, name = os.path.split(file_path)
+        temp = os.path.join(directory, f".{name}.{next(self._names)}.tmp")
+        job = _Job(file_path, temp, write, on_written, study_id)
+        self.queue.put(job)
+        return job.future
+
+    def wait(self, future, timeout=None):
+        """Block until ``future`` satisfies the durability policy; raises if the write failed."""
+        if self.durability != ENQUEUE:
+            future.result(timeout)
+
+    def depth(self):
+        """Instances queued for writing."""
+        return self.queue.qsize()
+
+    def ensure_dir(self, path):
+        with self.dirs_lock:
+            if path in self.dirs:
+                self.dirs.move_to_end(path)
+                return
+            os.makedirs(path, exist_ok=True)
+            self.dirs[path] = None
+            if len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+
+    def _write(self, job):
+        directory = os.path.dirname(job.path)
+        self.ensure_dir(directory)
+        try:
+            f = open(job.temp, 'wb')
+        except FileNotFoundError:
+            # The directory was removed since it was cached, e.g. after a study was sent
+            with self.dirs_lock:
+                self.dirs.pop(directory, None)
+            self.ensure_dir(directory)
+            f = open(job.temp, 'wb')
+        with f:
+            job.write(f)
+
+    def _io_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                with tracing.span(tracing.WRITE, job.study_id, logging.DEBUG):
+                    self._write(job)
+                if self.durability == FSYNC:
+                    self._queue_sync(job)
+                    continue
+                os.replace(job.temp, job.path)
+                self._complete(job)
+                if self.syncer is not None:
+                    self._queue_sync(job)
+            except Exception as e:
+                logger.error(f"Failed to write {job.path}: {e}")
+                metrics.WRITE_FAILURES.labels('write').inc()
+                self._discard(job.temp)
+                job.future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def _queue_sync(self, job):
+        with self.sync_cond:
+            self.to_sync.append(job)
+
+    def _sync_loop(self):
+        while True:
+            with self.sync_cond:
+                if not self.closed:
+                    self.sync_cond.wait(self.fsync_interval)
+                batch, self.to_sync = self.to_sync, []
+                closed = self.closed
+            if batch:
+                self._commit(batch)
+            if closed:
+                return
+
+    def _commit(self, batch):
+        """fsync a batch of files and, once each, the directories they were renamed into."""
+        synced, directories = [], set()
+        for job in batch:
+            try:
+                _fsync(job.temp if self.durability == FSYNC else job.path)
+                if self.durability == FSYNC:
+                    os.replace(job.temp, job.path)
+                synced.append(job)
+                directories.add(os.path.dirname(job.path))
+            except FileNotFoundError:
+                if self.durability == FSYNC:
+                    logger.error(f"{job.temp} vanished before it was synced")
+                    metrics.WRITE_FAILURES.labels('sync').inc()
+                    job.future.set_exception(FileNotFoundError(f"{job.temp} vanished before it was synced"))
+                # Otherwise already moved or deleted, e.g. sent and cleaned up
+            except Exception as e:
+                logger.error(f"Failed to sync {job.path}: {e}")
+                metrics.WRITE_FAILURES.labels('sync').inc()
+                if self.durability == FSYNC:
+                    self._discard(job.temp)
+                    job.future.set_exception(e)
+        for directory in directories:
+            try:
+                _fsync(directory)
+            except OSError as e:
+                logger.warning(f"Failed to sync directory {directory}: {e}")
+        if self.durability == FSYNC:
+            for job in synced:
+                self._complete(job)
+
+    def _complete(self, job):
+        try:
+            if job.on_written is not None:
+                job.on_written()
+        except Exception as e:
+            logger.error(f"Wrote {job.path} but could not process it: {e}")
+            metrics.WRITE_FAILURES.labels('on_written').inc()
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(job.path)
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def flush(self):
+        """Wait until everything queued so far has been written."""
+        self.queue.join()
+
+    def close(self):
+        """Finish queued writes and a last sync, then stop the threads."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.syncer is not None:
+            with self.sync_cond:
+                self.closed = True
+                self.sync_cond.notify()
+            self.syncer.join()
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
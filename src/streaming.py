@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import shutil
+from compression import write_archive
+from encryption import EncryptingWriter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 256 * 1024  # Size of each chunk handed to the uploader
+DEFAULT_MAX_QUEUED = 8  # Chunks buffered between producer and uploader
+
+_EOF = object()
+
+
+class StreamAborted(Exception):
+    """Raised in the producer thread when the consumer has gone away."""
+
+
+class QueueWriter:
+    """Write-only file object that feeds fixed-size chunks to an asyncio.Queue.
+
+    It is written to from a worker thread (e.g. by ``tarfile``) and blocks
+    whenever the queue is full, so memory stays bounded by
+    ``chunk_size * queue.maxsize`` however large the stream gets. An optional
+    ``hasher`` (e.g. ``hashlib.sha256()``) sees every byte in the same pass,
+    on the producer thread.
+    """
+
+    def __init__(self, loop, queue, chunk_size=DEFAULT_CHUNK_SIZE, hasher=None):
+        self.loop = loop
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.hasher = hasher
+        self.aborted = False
+        self.bytes_written = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        if self.aborted:
+            raise StreamAborted("Stream consumer has stopped reading")
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.chunk_size:
+            self.put(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Hand over whatever is left in the buffer."""
+        if self._buffer and not self.aborted:
+            self.put(bytes(self._buffer))
+        self._buffer.clear()
+
+    def put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+
+async def stream_from_thread(produce, chunk_size=DEFAULT_CHUNK_SIZE, max_queued=DEFAULT_MAX_QUEUED,
+                             executor=None, hasher=None):
+    """Run ``produce(fileobj)`` in a worker thread and yield what it writes.
+
+    Exceptions raised by the producer are re-raised from the generator once
+    the chunks written before the failure have been consumed. If the
+    consumer stops early the producer is told to abort on its next write.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(max_queued)
+    writer = QueueWriter(loop, queue, chunk_size, hasher)
+
+    def run():
+        try:
+            produce(writer)
+            writer.close()
+        finally:
+            if not writer.aborted:
+                writer.put(_EOF)
+
+    future = loop.run_in_executor(executor, run)
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is _EOF:
+                break
+            yield chunk
+        await future
+    finally:
+        if not future.done():
+            writer.aborted = True
+            # Unblock a producer waiting for queue space; it will raise
+            # StreamAborted on its next write.
+            while not queue.empty():
+                queue.get_nowait()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+def stream_file(file_path, chunk_size=DEFAULT_CHUNK_SIZE, max_queued=DEFAULT_MAX_QUEUED, executor=None,
+                hasher=None):
+    """Yield a file's contents without blocking the event loop on disk reads."""
+    def produce(fileobj):
+        with open(file_path, 'rb') as f:
+            shutil.copyfileobj(f, fileobj, chunk_size)
+
+    return stream_from_thread(produce, chunk_size=chunk_size, max_queued=max_queued, executor=executor,
+                              hasher=hasher)
+
+
+def write_study_archive(study_path, fileobj, compression=None, encryption_key=None, delta=None):
+    """Compress a study into ``fileobj``, encrypting in the same pass when a key is given.
+
+    ``delta`` is a ``(files, manifest)`` pair from ``instance_index.plan_delta``
+    restricting the archive to the files not delivered yet.
+    """
+    sink = EncryptingWriter(fileobj, encryption_key) if encryption_key else fileobj
+    files, manifest = delta or (None, None)
+    report = write_archive(study_path, sink, files=files, manifest=manifest, **(compression or {}))
+    if encryption_key:
+        sink.close()
+        report['encryption_seconds'] = sink.seconds
+    return report
+
+
+def stream_study_archive(study_path, compression=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                         max_queued=DEFAULT_MAX_QUEUED, executor=None, hasher=None, encryption_key=None,
+                         delta=None):
+    """Yield the compressed (and optionally encrypted) archive of a study as it is produced.
+
+    ``compression`` holds ``write_archive`` options (codec, level, workers,
+    codec_aware); members are laid out like ``shutil.make_archive`` so
+    receivers see the same archive whichever mode produced it.
+    """
+    return stream_from_thread(lambda fileobj: write_study_archive(study_path, fileobj, compression, encryption_key,
+                                                                  delta),
+                              chunk_size=chunk_size, max_queued=max_queued, executor=executor, hasher=hasher)
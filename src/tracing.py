@@ -0,0 +1,65 @@
+import hashlib
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Stages a study passes through, in order
+RECEIVE = 'receive'
+WRITE = 'write'
+DEBOUNCE = 'debounce'
+COMPRESS = 'compress'
+ENCRYPT = 'encrypt'
+UPLOAD = 'upload'
+
+
+def correlation_id(study_id):
+    """Return a short ID for a study that is the same in every process and across restarts."""
+    if study_id is None:
+        return None
+    return hashlib.sha1(str(study_id).encode()).hexdigest()[:16]
+
+
+def record(stage, study_id, seconds, level=logging.INFO, **fields):
+    """Report a finished span: a ``stage_seconds`` observation plus a structured log record.
+
+    The record carries ``span``, ``trace_id`` (the study's correlation ID),
+    ``study_id``, ``duration_ms`` and any ``fields`` as ``extra``, so the
+    JSON log format turns it into a span event a trace viewer can group by
+    study. Per-instance stages log at DEBUG.
+    """
+    metrics.STAGE_SECONDS.labels(stage).observe(seconds)
+    if logger.isEnabledFor(level):
+        logger.log(level, f"{stage} of study {study_id} took {seconds * 1000:.1f} ms",
+                   extra={'span': stage, 'trace_id': correlation_id(study_id), 'study_id': study_id,
+                          'duration_ms': round(seconds * 1000, 3), **fields})
+
+
+class Span:
+    """Times a block as one stage of a study's trip; ``study_id`` may be filled in once it is known."""
+
+    __slots__ = ('stage', 'study_id', 'level', 'fields', 'started')
+
+    def __init__(self, stage, study_id=None, level=logging.INFO, **fields):
+        self.stage = stage
+        self.study_id = study_id
+        self.level = level
+        self.fields = fields
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        record(self.stage, self.study_id, time.perf_counter() - self.started, self.level, **self.fields)
+        return False
+
+
+def span(stage, study_id=None, level=logging.INFO, **fields):
+    """``with span('upload', study_id): ...`` records how long the block took."""
+    return Span(stage, study_id, level, **fields)
@@ -0,0 +1,230 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+
+from pydicom import dcmread
+from pydicom.pixels import get_encoder
+from pydicom.uid import UID, DeflatedExplicitVRLittleEndian, JPEG2000Lossless, JPEGLSLossless, RLELossless
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lossless target syntaxes by name, best compression first
+SYNTAXES = {
+    'jpegls': JPEGLSLossless,
+    'j2k': JPEG2000Lossless,
+    'rle': RLELossless,
+    'deflate': DeflatedExplicitVRLittleEndian,
+}
+AUTO = 'auto'
+
+# Outcomes per instance
+TRANSCODED = 'transcoded'
+SKIPPED = 'skipped'          # Already in a compressed or deflated syntax
+NOT_SMALLER = 'not_smaller'  # No target syntax made it smaller; kept as received
+UNSUPPORTED = 'unsupported'  # No target syntax could encode it
+CHANGED = 'changed'          # Re-sent while it was encoded; the new version gets its own pass
+FAILED = 'failed'
+
+
+def available_syntaxes(names=(AUTO,)):
+    """Resolve syntax names to the UIDs that can be written here, dropping codecs that are not installed."""
+    resolved = []
+    for name in names:
+        for candidate in (SYNTAXES if name == AUTO else [name]):
+            if candidate not in SYNTAXES:
+                raise ValueError(f"Unknown transfer syntax {candidate!r}; expected one of {[AUTO, *SYNTAXES]}")
+            uid = SYNTAXES[candidate]
+            if uid in resolved:
+                continue
+            if uid != DeflatedExplicitVRLittleEndian and not get_encoder(uid).is_available:
+                logger.info(f"No encoder for {uid.name} is installed; not transcoding to it")
+                continue
+            resolved.append(uid)
+    return resolved
+
+
+def _encode(raw, syntax):
+    ds = dcmread(BytesIO(raw))
+    if syntax == DeflatedExplicitVRLittleEndian:
+        ds.file_meta.TransferSyntaxUID = syntax
+    else:
+        # Lossless, so the instance keeps its identity
+        ds.compress(syntax, generate_instance_uid=False)
+    buffer = BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def _identity(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def transcode_file(path, syntaxes):
+    """Rewrite a stored instance in the first of ``syntaxes`` that encodes it smaller. Runs in a worker process.
+
+    Returns a report: modality, outcome, the syntax written, bytes in and
+    out and the CPU seconds spent. The file is replaced atomically, so a
+    reader sees either version whole, and only if it is still the file that
+    was read: a re-send stored meanwhile is not overwritten with the
+    encoding of the old one.
+    """
+    started = time.process_time()
+    with open(path, 'rb') as f:
+        raw = f.read()
+        read = _identity(os.fstat(f.fileno()))
+    ds = dcmread(BytesIO(raw))
+    report = {'path': path, 'modality': str(ds.get('Modality', '')) or None, 'outcome': UNSUPPORTED,
+              'transfer_syntax': None, 'bytes_in': len(raw), 'bytes_out': len(raw)}
+    current = UID(ds.file_meta.TransferSyntaxUID)
+    if current.is_compressed or current.is_deflated:
+        report['outcome'] = SKIPPED
+    else:
+        for syntax in syntaxes:
+            if syntax != DeflatedExplicitVRLittleEndian and 'PixelData' not in ds:
+                continue
+            try:
+                data = _encode(raw, syntax)
+            except Exception:
+                continue  # e.g. RLE of more than 16 bits allocated; try the next syntax
+            if len(data) >= len(raw):
+                report['outcome'] = NOT_SMALLER
+                continue
+            temp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.transcode")
+            with open(temp, 'wb') as f:
+                f.write(data)
+            try:
+                unchanged = _identity(os.stat(path)) == read
+            except FileNotFoundError:
+                unchanged = False
+            if not unchanged:
+                os.remove(temp)
+                report['outcome'] = CHANGED
+                break
+            os.replace(temp, path)
+            report.update(outcome=TRANSCODED, transfer_syntax=str(syntax), bytes_out=len(data))
+            break
+    report['cpu_seconds'] = time.process_time() - started
+    return report
+
+
+class Transcoder:
+    """Losslessly re-encodes stored uncompressed instances in a pool of worker processes.
+
+    Instances are queued as they are stored and rewritten in place in the
+    first of ``syntaxes`` (names from ``SYNTAXES`` or 'auto' for every
+    installed codec) that makes them smaller; already compressed syntaxes
+    are left alone. ``modalities`` limits it to those modalities. The
+    workers are separate processes so encoding never competes with the
+    receiver for the GIL. ``wait(study_id)`` blocks until a study is done,
+    before it is archived. Size reduction and CPU cost are counted per
+    modality (see ``summary``) to show where it pays off.
+    """
+
+    def __init__(self, syntaxes=(AUTO,), workers=1, modalities=None):
+        self.syntaxes = available_syntaxes(syntaxes)
+        self.modalities = set(modalities) if modalities else None
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending = {}  # study_id -> futures of its instances
+        self.waiters = {}  # study_id -> futures from ``idle``, completed once nothing of it is pending
+        self.stats = {}  # modality -> [instances, bytes in, bytes out, CPU seconds]
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        logger.info(f"Transcoding to {[uid.name for uid in self.syntaxes]} with {workers} worker processes")
+
+    def wants(self, modality):
+        return bool(self.syntaxes) and (self.modalities is None or modality in self.modalities)
+
+    def submit(self, study_id, path, on_done=None):
+        """Queue a stored instance; ``on_done(report)`` is called once it has been rewritten (or left alone)."""
+        future = self.pool.submit(transcode_file, path, self.syntaxes)
+        with self.cond:
+            self.pending.setdefault(study_id, set()).add(future)
+        future.add_done_callback(lambda done: self._done(study_id, done, on_done))
+        return future
+
+    def _done(self, study_id, future, on_done):
+        try:
+            if future.cancelled():
+                return
+            try:
+                report = future.result()
+            except Exception as e:
+                logger.error(f"Failed to transcode an instance of study {study_id}: {e}")
+                metrics.TRANSCODED.labels(metrics.modality_label(None), FAILED).inc()
+                report = None
+            else:
+                self._record(report)
+            if on_done is not None:
+                on_done(report)
+        finally:
+            # Only now is the instance done as far as ``wait`` is concerned
+            with self.cond:
+                futures = self.pending.get(study_id)
+                if futures is not None:
+                    futures.discard(future)
+                    if not futures:
+                        del self.pending[study_id]
+                        self.cond.notify_all()
+                        for waiter in self.waiters.pop(study_id, ()):
+                            waiter.set_result(True)
+
+    def _record(self, report):
+        modality = report['modality']
+        with self.lock:
+            stats = self.stats.setdefault(modality, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += report['bytes_in']
+            stats[2] += report['bytes_out']
+            stats[3] += report['cpu_seconds']
+        label = metrics.modality_label(modality)
+        metrics.TRANSCODED.labels(label, report['outcome']).inc()
+        metrics.TRANSCODE_BYTES.labels(label, "in").inc(report['bytes_in'])
+        metrics.TRANSCODE_BYTES.labels(label, "out").inc(report['bytes_out'])
+        metrics.TRANSCODE_CPU_SECONDS.labels(label).inc(report['cpu_seconds'])
+
+    def wait(self, study_id, timeout=None):
+        """Block until every queued instance of a study has been transcoded."""
+        with self.cond:
+            self.cond.wait_for(lambda: study_id not in self.pending, timeout)
+
+    def idle(self, study_id):
+        """Return a ``Future`` completed once every queued instance of a study has been transcoded.
+
+        Unlike ``wait`` it holds no thread, so the event loop can await it with ``asyncio.wrap_future``.
+        """
+        waiter = Future()
+        with self.cond:
+            if study_id in self.pending:
+                self.waiters.setdefault(study_id, []).append(waiter)
+                return waiter
+        waiter.set_result(True)
+        return waiter
+
+    def summary(self):
+        """Return ``{modality: {instances, bytes_in, bytes_out, ratio, cpu_seconds, cpu_ms_per_mb}}``."""
+        with self.lock:
+            stats = {modality: list(values) for modality, values in self.stats.items()}
+        return {
+            modality: {
+                'instances': instances,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'ratio': bytes_in / bytes_out if bytes_out else 0.0,
+                'cpu_seconds': cpu_seconds,
+                'cpu_ms_per_mb': cpu_seconds * 1000 / (bytes_in / 1e6) if bytes_in else 0.0,
+            }
+            for modality, (instances, bytes_in, bytes_out, cpu_seconds) in stats.items()
+        }
+
+    def close(self):
+        """Stop the workers, dropping what is still queued; the instances stay as received."""
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        for modality, stats in self.summary().items():
+            logger.info(f"Transcoded {stats['instances']} {modality or 'unknown'} instances: ratio "
+                        f"{stats['ratio']:.2f}, {stats['cpu_ms_per_mb']:.1f} ms CPU per MB")
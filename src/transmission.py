@@ -1,35 +1,139 @@
 import hashlib
 import logging
+import os
 import shutil
+import time
 import aiohttp
+import metrics
+import pipeline as stages
+import tracing
+from chunked_upload import DEFAULT_PARALLEL_PARTS, DEFAULT_PART_SIZE, load_checkpoint, upload_file_chunked
+from compression import get_engine
+from http_client import destination_key, open_session, shaped
+from retry import FatalError, RetryPolicy, TransmissionError, call_with_retry, classify_status, parse_retry_after
+from streaming import stream_file, stream_study_archive, write_study_archive
 
 logger = logging.getLogger(__name__)
 
-async def send_archive(api_endpoint, api_key, study_path, delete_after_send=False):
-    """Compress, send the archive to the destination, and optionally delete local files."""
+CHECKSUM_BUFFER_SIZE = 1024 * 1024
+
+async def send_archive(api_endpoint, api_key, study_path, delete_after_send=False, streaming=False,
+                       compression=None, on_state=None, client=None, chunked=None, policy=None,
+                       encryption_key=None, archive=None, delta=None, destination=None, pipeline=None):
+    """Compress, send the archive to the destination, and optionally delete local files.
+
+    With ``streaming`` the archive is never written to disk: tar members are
+    compressed in a worker thread and uploaded as a chunked request body while
+    they are produced. ``compression`` selects the archive codec and its
+    options (see ``compression.write_archive``). ``on_state`` is called with
+    'compressing' and 'sending' as the work progresses. ``client`` is the
+    shared ``HTTPClient``; without one a one-off session is used.
+
+    ``chunked`` enables resumable part uploads (see ``chunked_upload``) for
+    archives of at least ``chunked['threshold']`` bytes; a partly uploaded
+    archive of an unchanged study (same ``study_fingerprint``) is resumed
+    instead of being rebuilt.
+    Single-request uploads are retried according to ``policy``. With an
+    ``encryption_key`` the archive is encrypted (see ``encryption``) in the
+    same pass as compression and named ``<archive>.enc``. ``archive`` is a
+    ``(path, sha256)`` pair for an archive already built while the study was
+    received (see ``incremental_archive``); it is sent as is. ``delta`` is a
+    ``(files, manifest)`` pair (see ``instance_index.plan_delta``) for a
+    study that was sent before: only those files and the manifest are
+    archived, as ``<study>.delta<extension>``. ``destination`` names the
+    resumable upload's checkpoint when one archive goes to several
+    destinations. With a ``pipeline`` (see ``pipeline.Pipeline``) the
+    archive is built in its compress stage, hashed in its checksum stage
+    and sent holding an upload slot.
+
+    Returns True if the destination accepted the archive.
+    """
+    on_state = on_state or (lambda state: None)
     logger.info(f"Preparing to send archive from {study_path} to {api_endpoint}")
+    compression = compression or {}
+    engine = get_engine(compression.get('codec', 'gzip'))
+    archive_path = archive_path_for(study_path, compression, encryption_key, delta is not None)
+    content_type = 'application/octet-stream' if encryption_key else engine.content_type
+    headers = {'Authorization': f'Bearer {api_key}'}
+    study_id = os.path.basename(study_path)
+
+    def uploaded(mode, size, seconds):
+        metrics.observe_upload(destination_key(api_endpoint), mode, size, seconds)
+        tracing.record(tracing.UPLOAD, study_id, seconds, mode=mode, bytes=size)
 
     try:
-        # Compress the study folder into a .tar.gz archive
-        archive_path = await compress_study(study_path)
-        logger.info(f"Successfully compressed study to {archive_path}")
-
-        # Send the compressed archive to the external destination
-        async with aiohttp.ClientSession() as session:
-            with open(archive_path, 'rb') as archive_file:
-                data = {'file': archive_file}
-                headers = {'Authorization': f'Bearer {api_key}'}
-
-                async with session.post(api_endpoint, data=data, headers=headers) as response:
-                    if response.status == 200:
-                        logger.info(f"Successfully sent archive {archive_path} to {api_endpoint}")
-                    else:
-                        logger.error(f"Failed to send archive {archive_path}. Status: {response.status}")
-                        return  # Don't proceed to delete if the send fails
+        if streaming and archive is None:
+            on_state('sending')
+            hashers = []
+            executor = pipeline[stages.COMPRESS].executor if pipeline is not None and \
+                pipeline[stages.COMPRESS].kind == stages.THREAD else None
+
+            def make_data():
+                hasher = _SizedHasher()
+                hashers.append(hasher)
+                body = shaped(client, api_endpoint, stream_study_archive(
+                    study_path, compression, executor=executor, hasher=hasher, encryption_key=encryption_key,
+                    delta=delta))
+                return _archive_form(body, hasher, os.path.basename(archive_path), content_type)
+
+            # Compressing and sending at once, so it holds a worker of both stages
+            async with stages.slot(pipeline, stages.COMPRESS), stages.slot(pipeline, stages.UPLOAD):
+                started = time.monotonic()
+                await post_with_retry(api_endpoint, make_data, headers, client=client, policy=policy,
+                                      description=f"archive of {study_path}")
+            uploaded('streaming', hashers[-1].size, time.monotonic() - started)
+        else:
+            part_size = (chunked or {}).get('part_size', DEFAULT_PART_SIZE)
+            instances = fingerprint = checkpoint = None
+            if chunked:
+                instances, fingerprint = await stages.run(pipeline, stages.IO, study_fingerprint, study_path)
+                checkpoint = load_checkpoint(archive_path, part_size, destination)
+            checksum = None
+            if delta is not None:
+                on_state('compressing')
+                archive_path = await compress_study(study_path, compression, encryption_key, delta, pipeline)
+                logger.info(f"Compressed {len(delta[0])} new instances to {archive_path}")
+            elif archive is not None:
+                archive_path, checksum = archive
+                logger.info(f"Using incrementally built archive {archive_path}")
+            elif checkpoint is not None and checkpoint.get('fingerprint') == fingerprint:
+                logger.info(f"Reusing partly uploaded archive {archive_path}")
+            else:
+                # Compress the study folder into a .tar.gz archive before taking an upload slot
+                on_state('compressing')
+                archive_path = await compress_study(study_path, compression, encryption_key, pipeline=pipeline)
+                logger.info(f"Successfully compressed study to {archive_path}")
+
+            on_state('sending')
+            size = os.path.getsize(archive_path)
+            if chunked and size >= chunked.get('threshold', 0):
+                if checksum is None:
+                    checksum = await stages.run(pipeline, stages.CHECKSUM, compute_checksum, archive_path)
+                async with stages.slot(pipeline, stages.UPLOAD):
+                    started = time.monotonic()
+                    delivered = await upload_file_chunked(
+                        api_endpoint, api_key, archive_path, checksum, client=client, part_size=part_size,
+                        parallel=chunked.get('parallel', DEFAULT_PARALLEL_PARTS),
+                        metadata={'study': os.path.basename(study_path), 'instances': instances},
+                        destination=destination, fingerprint=fingerprint, pipeline=pipeline)
+                if not delivered:
+                    return False  # Don't proceed to delete if the send fails
+                uploaded('chunked', size, time.monotonic() - started)
+            else:
+                # Send the compressed archive to the external destination
+                async with stages.slot(pipeline, stages.UPLOAD):
+                    started = time.monotonic()
+                    await post_file(api_endpoint, api_key, archive_path, checksum=checksum, client=client,
+                                    policy=policy, multipart=True, content_type=content_type, pipeline=pipeline)
+                uploaded('single', size, time.monotonic() - started)
+        logger.info(f"Successfully sent archive of {study_path} to {api_endpoint}")
 
+    except TransmissionError as e:
+        logger.error(f"Failed to send archive {archive_path}: {e}")
+        return False  # Don't proceed to delete if the send fails
     except Exception as e:
         logger.error(f"Error sending archive {archive_path}: {e}")
-        return
+        return False
 
     # Optionally delete the local files after sending
     if delete_after_send:
@@ -39,16 +143,148 @@ async def send_archive(api_endpoint, api_key, study_path, delete_after_send=Fals
         except Exception as e:
             logger.error(f"Error while deleting local files for study {study_path}: {e}")
 
-async def compress_study(study_path):
-    """Compress the study directory into a .tar.gz archive."""
-    archive_path = f"{study_path}.tar.gz"
+    return True
+
+def study_fingerprint(study_path):
+    """Return ``(instances, digest)`` of a study directory's file names, sizes and modification times.
+
+    Any instance added, removed or rewritten since an archive was built
+    changes the digest, so a partly uploaded archive is only resumed for
+    exactly the content it holds. Blocking; run it in an executor.
+    """
+    entries = []
+    stack = [study_path]
+    while stack:
+        with os.scandir(stack.pop()) as scanned:
+            for entry in scanned:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                    stat = entry.stat(follow_symlinks=False)
+                    entries.append(f"{os.path.relpath(entry.path, study_path)}\0{stat.st_size}\0{stat.st_mtime_ns}")
+    digest = hashlib.sha256("\n".join(sorted(entries)).encode()).hexdigest()
+    return len(entries), digest
+
+
+class _SizedHasher:
+    """SHA-256 that also counts the bytes it has seen."""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+async def _read_response(response):
+    if response.content_type == 'application/json':
+        return await response.json()
+    return await response.text()
+
+async def _digest_field(hasher):
+    # Evaluated lazily by the multipart writer, after the file part has streamed
+    yield hasher.hexdigest().encode()
+
+def _archive_form(body, hasher, filename, content_type):
+    """Multipart body with the archive followed by its SHA-256, computed while it streams."""
+    data = aiohttp.FormData()
+    data.add_field('file', body, filename=filename, content_type=content_type)
+    data.add_field('checksum', _digest_field(hasher), content_type='text/plain')
+    return data
+
+async def post_with_retry(api_endpoint, make_data, headers, client=None, policy=None, description="archive"):
+    """POST a request body to the destination, retrying retryable failures.
+
+    ``make_data()`` must build a fresh body for every attempt because
+    streamed bodies cannot be replayed. Failures are classified as
+    retryable or fatal, ``Retry-After`` is honoured and the destination's
+    circuit breaker (when a shared ``client`` is used) is consulted before
+    each attempt. Returns the parsed response; raises ``TransmissionError``.
+    """
+    breaker = client.breaker(api_endpoint) if client is not None else None
+
+    async def attempt(n):
+        async with open_session(client, api_endpoint) as session:
+            async with session.post(api_endpoint, data=make_data(), headers=headers) as response:
+                if not 200 <= response.status < 300:
+                    raise classify_status(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                return await _read_response(response)
+
+    return await call_with_retry(attempt, policy or RetryPolicy(), breaker, description,
+                                 destination=destination_key(api_endpoint))
+
+async def post_file(api_endpoint, api_key, file_path, checksum=None, client=None, policy=None, multipart=False,
+                    content_type='application/octet-stream', pipeline=None):
+    """Stream a file to the destination with retries and return the parsed response.
+
+    The body is read off the event loop in bounded chunks and hashed in the
+    same pass. As a raw body the ``X-Checksum`` header is required up front,
+    so when not supplied it is computed first, in the checksum stage of
+    ``pipeline``; as multipart the checksum travels as a form field written
+    after the file, so no extra read is needed. Either way the streamed digest is checked against ``checksum``
+    to catch a file that changed while it was being sent.
+    """
+    headers = {'Authorization': f'Bearer {api_key}'}
+    if not multipart:
+        if checksum is None:
+            checksum = await stages.run(pipeline, stages.CHECKSUM, compute_checksum, file_path)
+        headers['Content-Type'] = content_type
+        headers['X-Checksum'] = checksum
+    hashers = []
+
+    def make_data():
+        hasher = hashlib.sha256()
+        hashers.append(hasher)
+        body = shaped(client, api_endpoint, stream_file(file_path, hasher=hasher))
+        if not multipart:
+            return body
+        return _archive_form(body, hasher, os.path.basename(file_path), content_type)
+
+    result = await post_with_retry(api_endpoint, make_data, headers, client=client, policy=policy,
+                                   description=file_path)
+    if checksum is not None and hashers[-1].hexdigest() != checksum:
+        raise FatalError(f"{file_path} changed while it was being sent")
+    return result
+
+def archive_path_for(study_path, compression=None, encryption_key=None, delta=False):
+    """Return where a study's archive is written for the given codec and encryption."""
+    extension = get_engine((compression or {}).get('codec', 'gzip')).extension
+    return f"{study_path}{'.delta' if delta else ''}{extension}{'.enc' if encryption_key else ''}"
+
+async def compress_study(study_path, compression=None, encryption_key=None, delta=None, pipeline=None):
+    """Compress (and optionally encrypt) the study directory into an archive next to it (.tar.gz by default).
+
+    Runs in the compress stage of ``pipeline`` when one is given.
+    """
+    compression = compression or {}
+    archive_path = archive_path_for(study_path, compression, encryption_key, delta is not None)
     try:
-        shutil.make_archive(study_path, 'gztar', study_path)
+        # Compression is synchronous (and may fan out to a process pool); keep it off the event loop
+        study_id = os.path.basename(study_path)
+        with tracing.span(tracing.COMPRESS, study_id, codec=compression.get('codec', 'gzip')):
+            report = await stages.run(pipeline, stages.COMPRESS, _write_archive_file, study_path, archive_path,
+                                      compression, encryption_key, delta)
+        if pipeline is not None and pipeline[stages.COMPRESS].kind == stages.PROCESS:
+            # Observed in the worker process, where nobody scrapes it
+            metrics.observe_compression(report)
+        if 'encryption_seconds' in report:
+            # Encrypted in the same pass, so this is part of the compress span
+            tracing.record(tracing.ENCRYPT, study_id, report['encryption_seconds'])
+        logger.info(f"Compressed {study_path} with {report['codec']}: {report['mb_per_s']:.1f} MB/s, "
+                    f"ratio {report['ratio']:.2f}")
         return archive_path
     except Exception as e:
         logger.error(f"Error compressing study at {study_path}: {e}")
         raise
 
+def _write_archive_file(study_path, archive_path, compression, encryption_key=None, delta=None):
+    with open(archive_path, 'wb') as archive_file:
+        return write_study_archive(study_path, archive_file, compression, encryption_key, delta)
+
 def delete_local_study_files(study_path):
     """Delete the local study files after they have been sent."""
     try:
@@ -64,7 +300,7 @@ def compute_checksum(file_path):
     sha256 = hashlib.sha256()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(CHECKSUM_BUFFER_SIZE), b""):
                 sha256.update(chunk)
         return sha256.hexdigest()
     except Exception as e:
@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from http_client import destination_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLASS = 'normal'
+
+
+class SchedulingPolicy:
+    """Priority classes and fair shares for the outbound queue.
+
+    Built from the ``scheduling`` config section::
+
+        {'classes': ['stat', 'normal', 'bulk'],      # strict priority, highest first
+         'default_class': 'normal',
+         'rules': [{'class': 'stat', 'calling_ae': ['ED_CR'], 'modality': ['CR', 'DX']},
+                   {'class': 'bulk', 'min_bytes': 1e9}],
+         'shares': {'ED_CR': 4},                     # fair-queuing weight per calling AE
+         'default_share': 1}
+
+    A rule matches when every criterion it names matches (``calling_ae``,
+    ``modality``, ``min_bytes``, ``max_bytes``); the first match picks the
+    study's class and unmatched studies get the default class.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.classes = list(config.get('classes') or [DEFAULT_CLASS])
+        self.default_class = config.get('default_class', self.classes[len(self.classes) // 2])
+        if self.default_class not in self.classes:
+            raise ValueError(f"Default class {self.default_class!r} is not one of {self.classes}")
+        self.rules = list(config.get('rules', []))
+        for rule in self.rules:
+            if rule.get('class') not in self.classes:
+                raise ValueError(f"Rule {rule} names an unknown class; expected one of {self.classes}")
+        self.shares = dict(config.get('shares', {}))
+        self.default_share = config.get('default_share', 1)
+        if any(share <= 0 for share in [self.default_share, *self.shares.values()]):
+            raise ValueError("Fair shares must be positive")
+
+    def classify(self, study):
+        """Return the priority (0 is highest) of a study's journal entry."""
+        for rule in self.rules:
+            if matches_rule(rule, study):
+                return self.classes.index(rule['class'])
+        return self.classes.index(self.default_class)
+
+    def share(self, calling_ae):
+        return self.shares.get(calling_ae, self.default_share)
+
+
+def matches_rule(rule, study):
+    """Whether a study's journal entry meets every criterion a rule names (calling_ae, modality, min/max_bytes)."""
+    for key in ('calling_ae', 'modality'):
+        wanted = rule.get(key)
+        if wanted is None:
+            continue
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        if study.get(key) not in wanted:
+            return False
+    size = study.get('bytes') or 0
+    if 'min_bytes' in rule and size < rule['min_bytes']:
+        return False
+    if 'max_bytes' in rule and size > rule['max_bytes']:
+        return False
+    return True
+
+
+class UploadQueue:
+    """Queue of ready studies ordered by priority class, then fair share.
+
+    A drop-in for the ``asyncio.Queue`` the outbound workers drain: the
+    highest non-empty priority class always goes first; within a class,
+    calling AEs share the upload workers in proportion to their weights by
+    self-clocked weighted fair queuing on study bytes, so one modality's
+    backlog of large studies cannot hold up another's. ``configure``
+    swaps the policy at runtime and re-orders what is queued.
+    """
+
+    def __init__(self, policy=None):
+        self.policy = policy or SchedulingPolicy()
+        self._heaps = {}  # priority -> [(finish tag, seq, study_id, study)]
+        self._vtime = {}  # priority -> virtual time
+        self._finish = {}  # (priority, calling AE) -> finish tag of its last queued study
+        self._seq = itertools.count()
+        self._size = 0
+        self._items = asyncio.Semaphore(0)
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def put_nowait(self, study_id, study=None):
+        """Queue a study; ``study`` is its journal entry (calling_ae, modality, bytes)."""
+        self._push(study_id, study or {})
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._items.release()
+
+    def _push(self, study_id, study):
+        priority = self.policy.classify(study)
+        flow = (priority, study.get('calling_ae'))
+        start = max(self._vtime.get(priority, 0), self._finish.get(flow, 0))
+        finish = start + max(study.get('bytes') or 0, 1) / self.policy.share(study.get('calling_ae'))
+        self._finish[flow] = finish
+        heapq.heappush(self._heaps.setdefault(priority, []), (finish, next(self._seq), study_id, study))
+
+    async def get(self):
+        await self._items.acquire()
+        priority = min(p for p, heap in self._heaps.items() if heap)
+        finish, _, study_id, _ = heapq.heappop(self._heaps[priority])
+        self._vtime[priority] = finish
+        self._size -= 1
+        return study_id
+
+    def qsize(self):
+        return self._size
+
+    def task_done(self):
+        self._unfinished -= 1
+        if self._unfinished <= 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+    def configure(self, policy):
+        """Switch to a new policy, re-classifying and re-tagging queued studies in their current order."""
+        queued = sorted((entry for heap in self._heaps.values() for entry in heap), key=lambda entry: entry[:2])
+        self.policy = policy
+        self._heaps, self._vtime, self._finish = {}, {}, {}
+        for _, _, study_id, study in queued:
+            self._push(study_id, study)
+        logger.info(f"Upload scheduling updated: classes {policy.classes}, {len(policy.rules)} rules, "
+                    f"{len(queued)} queued studies re-ordered")
+
+
+class TokenBucket:
+    """Limits a byte rate; callers may borrow past the bucket and wait off the debt."""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst if burst is not None else rate  # One second's worth by default
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def set_rate(self, rate, burst=None):
+        self._refill()
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = min(self.tokens, self.burst)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, nbytes):
+        """Take ``nbytes`` and return how many seconds to wait before sending them."""
+        self._refill()
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+    async def consume(self, nbytes):
+        delay = self.reserve(nbytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class BandwidthShaper:
+    """A global token bucket plus one per destination, from ``{'global': B/s, 'destinations': {url: B/s}}``."""
+
+    def __init__(self, config=None):
+        self.bucket = None
+        self.destinations = {}
+        self.configure(config)
+
+    def configure(self, config):
+        """Apply new limits; buckets keep their current balance."""
+        config = config or {}
+        self.bucket = _update_bucket(self.bucket, config.get('global'))
+        limits = {destination_key(url): rate for url, rate in (config.get('destinations') or {}).items()}
+        self.destinations = {key: _update_bucket(self.destinations.get(key), rate) for key, rate in limits.items()
+                             if rate}
+
+    async def consume(self, url, nbytes):
+        """Wait until ``nbytes`` may be sent to ``url``."""
+        delays = [bucket.reserve(nbytes) for bucket in (self.bucket, self.destinations.get(destination_key(url)))
+                  if bucket is not None]
+        if delays and max(delays):
+            await asyncio.sleep(max(delays))
+
+    def limited(self, url):
+        return self.bucket is not None or destination_key(url) in self.destinations
+
+    def shape(self, url, body):
+        """Wrap an async iterable body so it is produced no faster than the limits allow."""
+        if not self.limited(url):
+            return body
+        return self._shaped(url, body)
+
+    async def _shaped(self, url, body):
+        async for chunk in body:
+            await self.consume(url, len(chunk))
+            yield chunk
+
+
+def _update_bucket(bucket, rate):
+    if not rate:
+        return None
+    if bucket is None:
+        return TokenBucket(rate)
+    bucket.set_rate(rate)
+    return bucket
@@ -0,0 +1,58 @@
+"""Helpers shared by the test modules.
+
+The modules under ``src`` import each other by bare name, so ``src`` is put
+on the path once here for every test. Encoded instances, C-STORE events and
+free ports come from ``benchmarks.synthetic``, shared with the benchmarks.
+"""
+import os
+import sys
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+
+def make_dataset():
+    ds = Dataset()
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = "1.2.3.4.5"
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = "1.2.3.4"
+    ds.Modality = "CT"
+    ds.PatientName = "TEST^RAW"
+    ds.Rows = ds.Columns = 4
+    ds.BitsAllocated = 16
+    ds.PixelData = bytes(range(32))
+    return ds
+
+
+def save_dataset(path, ds=None, transfer_syntax=ExplicitVRLittleEndian):
+    """Write ``ds`` (``make_dataset()`` by default) as a DICOM file; returns the path."""
+    ds = ds if ds is not None else make_dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    ds.save_as(path, enforce_file_format=True)
+    return path
+
+
+def write_instance_file(study_path, name, content=b"data", series="series"):
+    """Write one stored instance below ``study_path``, creating its directories; returns its path."""
+    series_dir = os.path.join(str(study_path), series)
+    os.makedirs(series_dir, exist_ok=True)
+    path = os.path.join(series_dir, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def make_study(base_dir, study_id, instances=1, content=None, series="series"):
+    """Write a study directory of ``instances`` files ``<n>.dcm``; returns its path.
+
+    Each file holds ``content``, or a line naming the study and instance.
+    """
+    study_path = os.path.join(str(base_dir), study_id)
+    for n in range(instances):
+        data = content if content is not None else f"{study_id} instance {n}".encode()
+        write_instance_file(study_path, f"{n}.dcm", data, series)
+    return study_path
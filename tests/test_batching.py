@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.batching import StudyBatcher, batch_results, send_batch, write_batch_archive
+from src.journal import READY, SENT, StudyJournal
+from src.outbound import OutboundQueue
+from tests.conftest import make_study, write_instance_file
+
+
+def make_partial_study(tmpdir, study_id, files=2):
+    """A study with an instance still being written."""
+    study_path = make_study(tmpdir, study_id, files, series="1.2")
+    write_instance_file(study_path, ".0.dcm.7.tmp", b"partial", series="1.2")
+    return study_path
+
+
+def test_batch_archive_has_manifest_and_each_study(tmpdir):
+    studies = [("1.1", make_partial_study(tmpdir, "1.1"), None),
+               ("1.2", make_partial_study(tmpdir, "1.2", files=1), None)]
+    output = io.BytesIO()
+    write_batch_archive(studies, output)
+
+    output.seek(0)
+    with tarfile.open(fileobj=output, mode="r:gz") as tar:
+        names = tar.getnames()
+        manifest = json.load(tar.extractfile("./manifest.json"))
+    assert names[0] == "./manifest.json"
+    assert "./1.1/1.2/1.dcm" in names and "./1.2/1.2/0.dcm" in names
+    assert not any(".tmp" in name for name in names)
+    first = manifest['studies'][0]
+    assert first['study_instance_uid'] == "1.1" and len(first['instances']) == 2
+    assert first['instances'][0]['sha256'] == hashlib.sha256(b"1.1 instance 0").hexdigest()
+
+
+def test_batch_results_map_per_study_replies():
+    ids = ["a", "b", "c"]
+    assert batch_results({"studies": {"a": {"status": "ok"}, "b": {"status": "error"}}}, ids) == \
+        {"a": True, "b": False, "c": False}
+    assert batch_results({"studies": [{"study_instance_uid": "c", "status": "stored"}]}, ids)["c"] is True
+    assert batch_results({"message": "Success"}, ids) == dict.fromkeys(ids, True)
+
+
+@pytest.mark.asyncio
+async def test_batcher_flushes_on_count_and_age():
+    sent = []
+
+    async def send(study_ids, on_state):
+        sent.append(study_ids)
+        return {study_id: study_id != "b" for study_id in study_ids}
+
+    done = {}
+    batcher = StudyBatcher(send, study_bytes=100, max_studies=2, max_age=0.05)
+    assert not batcher.accepts({'bytes': 101}) and not batcher.accepts({'bytes': 0})
+    for study_id in ("a", "b", "c"):
+        batcher.add(study_id, {'bytes': 10}, lambda state: None,
+                    lambda delivered, study_id=study_id: done.__setitem__(study_id, delivered))
+    await asyncio.sleep(0.1)
+
+    assert sent == [["a", "b"], ["c"]]
+    assert done == {"a": True, "b": False, "c": True}
+
+
+@pytest.mark.asyncio
+async def test_partial_failure_only_retries_rejected_studies(tmpdir):
+    requests = []
+
+    async def upload(request):
+        form = await request.post()
+        with tarfile.open(fileobj=form['file'].file, mode="r:gz") as tar:
+            manifest = json.load(tar.extractfile("./manifest.json"))
+        uids = [study['study_instance_uid'] for study in manifest['studies']]
+        requests.append(uids)
+        return web.json_response({"studies": {uid: {"status": "error" if uid == "1.2" else "ok"} for uid in uids}})
+
+    app = web.Application()
+    app.router.add_post("/upload", upload)
+    journal = StudyJournal(str(tmpdir.join("journal.sqlite")))
+    paths = {study_id: make_partial_study(tmpdir, study_id) for study_id in ("1.1", "1.2")}
+    work_dir = tmpdir.mkdir(".batches")
+
+    async with TestServer(app) as server:
+        url = str(server.make_url("/upload"))
+
+        async def send(study_ids, on_state):
+            return await send_batch(url, "key", [(s, paths[s], None) for s in study_ids], str(work_dir),
+                                    on_state=on_state)
+
+        queue = OutboundQueue(journal, send=None, workers=2, max_attempts=2, retry_delay=60,
+                              batcher=StudyBatcher(send, study_bytes=1000, max_studies=2))
+        for study_id in paths:
+            journal.record_instance(study_id, size=100)
+            queue.enqueue(study_id)
+        queue.start()
+        await asyncio.wait_for(queue.join(), 5)
+        await queue.stop()
+
+    assert requests == [["1.1", "1.2"]]
+    assert journal.get("1.1")['state'] == SENT
+    assert journal.get("1.2")['state'] == READY  # Waiting for its own retry
+    assert not os.listdir(work_dir)  # The batch archive is removed after sending
+    journal.close()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import sys
+import uuid
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.chunked_upload import checkpoint_path, upload_file_chunked
+from src.pipeline import IO, Pipeline
+from src.transmission import compute_checksum
+
+PART_SIZE = 64 * 1024
+
+
+class StandInReceiver:
+    """Local receiver for the chunked upload protocol that can inject failures."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.completed = {}
+        self.part_requests = []
+        self.failures = {}  # part number -> number of 503s still to return
+
+    def app(self):
+        app = web.Application(client_max_size=PART_SIZE * 2)
+        app.router.add_post("/api/uploads", self.create)
+        app.router.add_put("/api/uploads/{upload_id}/parts/{number}", self.put_part)
+        app.router.add_post("/api/uploads/{upload_id}/complete", self.complete)
+        return app
+
+    async def create(self, request):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {'meta': await request.json(), 'parts': {}}
+        return web.json_response({'upload_id': upload_id})
+
+    async def put_part(self, request):
+        upload = self.uploads.get(request.match_info['upload_id'])
+        if upload is None:
+            return web.Response(status=404)
+        number = int(request.match_info['number'])
+        self.part_requests.append(number)
+        if self.failures.get(number):
+            self.failures[number] -= 1
+            return web.Response(status=503)
+        body = await request.read()
+        if hashlib.sha256(body).hexdigest() != request.headers['X-Checksum']:
+            return web.Response(status=422)
+        upload['parts'][number] = body
+        return web.Response(status=201)
+
+    async def complete(self, request):
+        upload_id = request.match_info['upload_id']
+        upload = self.uploads[upload_id]
+        data = b"".join(upload['parts'][n] for n in sorted(upload['parts']))
+        if hashlib.sha256(data).hexdigest() != (await request.json())['checksum']:
+            return web.Response(status=422)
+        self.completed[upload_id] = data
+        return web.json_response({'status': 'ok'})
+
+
+@pytest.fixture
+def archive(tmpdir):
+    path = tmpdir.join("study.tar.gz")
+    path.write_binary(os.urandom(PART_SIZE * 5 + 123))
+    return str(path)
+
+
+@pytest.mark.asyncio
+async def test_parts_reassemble_despite_transient_failures(archive):
+    receiver = StandInReceiver()
+    receiver.failures = {1: 1, 4: 2}
+
+    async with TestServer(receiver.app()) as server:
+        delivered = await upload_file_chunked(str(server.make_url("/api")), "key", archive,
+                                              compute_checksum(archive), part_size=PART_SIZE, parallel=3, retry_delay=0.01)
+
+    assert delivered
+    assert list(receiver.completed.values()) == [open(archive, 'rb').read()]
+    assert not os.path.exists(checkpoint_path(archive))
+
+
+@pytest.mark.asyncio
+async def test_resume_only_sends_missing_parts(archive):
+    receiver = StandInReceiver()
+    receiver.failures = {3: 1}
+
+    async with TestServer(receiver.app()) as server:
+        url = str(server.make_url("/api"))
+        # First attempt: part 3 keeps failing and no retries are allowed
+        pipeline = Pipeline({IO: {'workers': 1}})
+        try:
+            delivered = await upload_file_chunked(url, "key", archive, compute_checksum(archive),
+                                                  part_size=PART_SIZE, parallel=2, part_retries=0, pipeline=pipeline)
+        finally:
+            pipeline.close()
+        assert not delivered
+        with open(checkpoint_path(archive)) as f:
+            assert sorted(json.load(f)['parts']) == ["0", "1", "2", "4", "5"]
+
+        receiver.part_requests.clear()
+        delivered = await upload_file_chunked(url, "key", archive, compute_checksum(archive),
+                                              part_size=PART_SIZE, parallel=2)
+
+    assert delivered
+    assert receiver.part_requests == [3]
+    assert len(receiver.uploads) == 1  # The same upload was resumed
+    assert list(receiver.completed.values()) == [open(archive, 'rb').read()]
+
+
+def test_checkpoint_names_are_safe_for_any_destination(tmpdir):
+    archive = os.path.join(str(tmpdir), "1.2.3.tar.gz")
+    assert checkpoint_path(archive, "backup") == f"{archive}.upload-backup.json"
+    path = checkpoint_path(archive, "https://api.example.com/v1/upload")
+    assert os.path.dirname(path) == str(tmpdir)
+    assert path != checkpoint_path(archive, "https://api.example.com/v2/upload")
+    with open(path, 'w') as f:
+        f.write("{}")
+
+
+@pytest.mark.asyncio
+async def test_partial_upload_is_resumed_only_for_unchanged_content(tmpdir):
+    from unittest.mock import AsyncMock, patch
+    from src.chunked_upload import save_checkpoint
+    from src.transmission import archive_path_for, send_archive, study_fingerprint
+
+    study = tmpdir.mkdir("1.2.3")
+    instance = study.mkdir("series").join("1.dcm")
+    instance.write_binary(b"first")
+    archive = archive_path_for(str(study))
+    with open(archive, 'wb') as f:
+        f.write(b"archive")
+    _, fingerprint = study_fingerprint(str(study))
+    stat = os.stat(archive)
+    save_checkpoint(archive, {'upload_id': "u", 'size': stat.st_size, 'mtime': stat.st_mtime,
+                              'part_size': PART_SIZE, 'fingerprint': fingerprint, 'parts': {}})
+    chunked = {'threshold': 0, 'part_size': PART_SIZE}
+
+    async def send():
+        with patch("src.transmission.compress_study", new_callable=AsyncMock, return_value=archive) as compress, \
+                patch("src.transmission.upload_file_chunked", new_callable=AsyncMock, return_value=True):
+            assert await send_archive("http://dest", "key", str(study), chunked=chunked)
+        return compress.called
+
+    assert not await send()
+    instance.write_binary(b"other")  # Same instance count, different content
+    os.utime(str(instance), ns=(0, 0))
+    assert await send()
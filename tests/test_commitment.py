@@ -0,0 +1,109 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import StorageCommitmentPushModel, StorageCommitmentPushModelInstance
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.commitment import ALL_COMMITTED, NO_SUCH_OBJECT, SOME_FAILED, commitment_report
+from src.dicom_server import DICOMServer
+from benchmarks.synthetic import free_port
+from tests.conftest import make_dataset
+
+MISSING = "1.2.3.4.99"
+
+
+def test_report_lists_committed_and_missing_instances():
+    event_type, report = commitment_report("1.9", [("1.2", "1.2.3.4.5")], {"1.2.3.4.5"})
+    assert event_type == ALL_COMMITTED
+    assert [item.ReferencedSOPInstanceUID for item in report.ReferencedSOPSequence] == ["1.2.3.4.5"]
+    assert 'FailedSOPSequence' not in report
+
+    event_type, report = commitment_report("1.9", [("1.2", "1.2.3.4.5"), ("1.2", MISSING)], {"1.2.3.4.5"})
+    assert event_type == SOME_FAILED
+    assert report.TransactionUID == "1.9"
+    assert [(item.ReferencedSOPInstanceUID, item.FailureReason) for item in report.FailedSOPSequence] == \
+           [(MISSING, NO_SUCH_OBJECT)]
+
+
+def request_commitment(port, reports, keep_open):
+    """Store one instance, then ask to commit it and one that was never sent."""
+    ae = AE(ae_title="MODALITY")
+    ae.add_requested_context(make_dataset().SOPClassUID, ExplicitVRLittleEndian)
+    ae.add_requested_context(StorageCommitmentPushModel)
+    received = threading.Event()
+
+    def on_report(event):
+        reports.append((event.event_type, event.event_information))
+        received.set()
+        return 0x0000, None
+
+    assoc = ae.associate("127.0.0.1", port, evt_handlers=[(evt.EVT_N_EVENT_REPORT, on_report)])
+    assert assoc.is_established
+    try:
+        ds = make_dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        assert assoc.send_c_store(ds).Status == 0x0000
+        request = Dataset()
+        request.TransactionUID = "1.2.3.9"
+        request.ReferencedSOPSequence = []
+        for uid in (ds.SOPInstanceUID, MISSING):
+            item = Dataset()
+            item.ReferencedSOPClassUID = ds.SOPClassUID
+            item.ReferencedSOPInstanceUID = uid
+            request.ReferencedSOPSequence.append(item)
+        status, _ = assoc.send_n_action(request, 1, StorageCommitmentPushModel, StorageCommitmentPushModelInstance)
+        assert status.Status == 0x0000
+        if keep_open:
+            assert received.wait(10)
+    finally:
+        assoc.release()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("keep_open", [True, False])
+async def test_commitment_is_reported_to_the_modality(tmpdir, keep_open):
+    port = free_port()
+    reports = []
+    peer = None
+    config = {
+        'dicom': {'host': '127.0.0.1', 'port': port},
+        'storage': {'base_dir': str(tmpdir)},
+        'transmission': {'api_endpoint': 'https://api.example.com', 'api_key': 'dummy_key'},
+        'commitment': {'wait': 0.5},
+    }
+    if not keep_open:
+        # The modality releases right away and listens for the report on its own port
+        peer_port = free_port()
+        ae = AE(ae_title="MODALITY")
+        ae.add_supported_context(StorageCommitmentPushModel, scu_role=True, scp_role=True)
+        peer = ae.start_server(("127.0.0.1", peer_port), block=False, evt_handlers=[
+            (evt.EVT_N_EVENT_REPORT, lambda event: reports.append((event.event_type, event.event_information))
+             or (0x0000, None))])
+        config['commitment']['peers'] = {"MODALITY": {'host': "127.0.0.1", 'port': peer_port}}
+    server = DICOMServer(config)
+    server.start_in_thread()
+    await asyncio.sleep(0.2)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, request_commitment, port, reports, keep_open)
+        for _ in range(100):
+            if reports:
+                break
+            await asyncio.sleep(0.05)
+        [(event_type, report)] = reports
+        assert event_type == SOME_FAILED
+        assert report.TransactionUID == "1.2.3.9"
+        assert [item.ReferencedSOPInstanceUID for item in report.ReferencedSOPSequence] == ["1.2.3.4.5"]
+        assert [item.ReferencedSOPInstanceUID for item in report.FailedSOPSequence] == [MISSING]
+    finally:
+        server.shutdown()
+        await server.close()
+        if peer is not None:
+            peer.shutdown()
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pynetdicom import AE
+from pynetdicom.sop_class import StorageCommitmentPushModel
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.completion import CompletionDetector
+from src.dicom_server import DICOMServer
+from benchmarks.synthetic import free_port
+from tests.conftest import make_dataset
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.now = 0.0
+        self.loop = SimpleNamespace(time=lambda: self.now)
+        self.deadlines = {}
+
+    def touch(self, study_id, timeout=None):
+        self.deadlines[study_id] = self.now + timeout
+
+    def reschedule(self, study_id, deadline):
+        if study_id in self.deadlines:
+            self.deadlines[study_id] = deadline
+
+
+CT = {'calling_ae': 'CT_1', 'modality': 'CT'}
+
+
+def test_timeout_is_learned_from_gaps():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60, min_timeout=2, min_samples=5)
+    for _ in range(5):
+        detector.instance_stored("study", CT)
+        assert scheduler.deadlines["study"] == scheduler.now + 60  # Not enough samples yet
+        scheduler.now += 0.5
+    detector.instance_stored("study", CT)
+
+    assert scheduler.deadlines["study"] - scheduler.now == pytest.approx(2)  # mean 0.5, no deviation, floored
+    # Other calling AEs and modalities still use the fallback
+    detector.instance_stored("other", {'calling_ae': 'MR_1', 'modality': 'MR'})
+    assert scheduler.deadlines["other"] == scheduler.now + 60
+
+
+def test_fixed_timeout_when_not_adaptive():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60, adaptive=False, min_samples=1)
+    for _ in range(3):
+        detector.instance_stored("study", CT)
+        scheduler.now += 0.5
+    assert scheduler.deadlines["study"] == pytest.approx(scheduler.now - 0.5 + 60)
+
+
+def test_announced_instance_count_completes_study():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60)
+    detector.instance_stored("study", {**CT, 'expected_instances': 2})
+    assert scheduler.deadlines["study"] == 60
+    detector.instance_stored("study", CT)
+    assert scheduler.deadlines["study"] == 0
+
+
+def test_release_of_last_association_brings_deadline_forward():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60, release_grace=1)
+    detector.instance_stored("study", {**CT, 'association': 'a'})
+    detector.instance_stored("study", {**CT, 'association': 'b'})
+
+    detector.association_closed("a", released=True)
+    assert scheduler.deadlines["study"] == 60  # Association b may still send more
+    detector.association_closed("b", released=False)
+    assert scheduler.deadlines["study"] == 60  # An abort says nothing about completeness
+
+    detector.instance_stored("study", {**CT, 'association': 'c'})
+    detector.association_closed("c", released=True)
+    assert scheduler.deadlines["study"] == 1
+
+
+def test_release_reported_after_connection_close_still_counts():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60, release_grace=1)
+    detector.instance_stored("study", {**CT, 'association': 'a'})
+    detector.association_closed("a", released=False)
+    detector.association_closed("a", released=True)
+    assert scheduler.deadlines["study"] == 1
+    assert not detector.associations
+
+
+def test_commitment_request_completes_study():
+    scheduler = FakeScheduler()
+    detector = CompletionDetector(scheduler, timeout=60)
+    detector.instance_stored("study", CT)
+    detector.commitment_requested({"study", "unknown"})
+    assert scheduler.deadlines == {"study": 0}
+
+
+def send_study(port, count, commit=False):
+    """Send ``count`` instances of one study on one association; optionally request Storage Commitment."""
+    ae = AE()
+    ae.add_requested_context(make_dataset().SOPClassUID, ExplicitVRLittleEndian)
+    ae.add_requested_context(StorageCommitmentPushModel)
+    assoc = ae.associate("127.0.0.1", port)
+    assert assoc.is_established
+    sent = []
+    for _ in range(count):
+        ds = make_dataset()
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        assert assoc.send_c_store(ds).Status == 0x0000
+        sent.append(ds)
+    if commit:
+        request = Dataset()
+        request.TransactionUID = generate_uid()
+        request.ReferencedSOPSequence = []
+        for ds in sent:
+            item = Dataset()
+            item.ReferencedSOPClassUID = ds.SOPClassUID
+            item.ReferencedSOPInstanceUID = ds.SOPInstanceUID
+            request.ReferencedSOPSequence.append(item)
+        status, _ = assoc.send_n_action(request, 1, StorageCommitmentPushModel, "1.2.840.10008.1.20.1.1")
+        assert status.Status == 0x0000
+        return assoc
+    assoc.release()
+    return None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("commit", [False, True])
+async def test_study_is_sent_on_explicit_signal_long_before_timeout(tmpdir, commit):
+    port = free_port()
+    config = {
+        'dicom': {'host': '127.0.0.1', 'port': port},
+        'storage': {'base_dir': str(tmpdir)},
+        'transmission': {'api_endpoint': 'https://api.example.com', 'api_key': 'dummy_key'},
+        'timeout': 60,
+        'completion': {'release_grace': 0.1},
+    }
+    server = DICOMServer(config)
+    with patch('src.dicom_server.send_archive', new_callable=AsyncMock, return_value=True) as mock_send:
+        await server.start_outbound()
+        server.start_in_thread()
+        await asyncio.sleep(0.2)
+        assoc = None
+        try:
+            started = time.monotonic()
+            assoc = await asyncio.get_running_loop().run_in_executor(None, send_study, port, 3, commit)
+            while not mock_send.called and time.monotonic() - started < 10:
+                await asyncio.sleep(0.05)
+            assert mock_send.called
+            assert time.monotonic() - started < 10
+        finally:
+            if assoc is not None:
+                assoc.release()
+            server.shutdown()
+            await server.close()
@@ -1,11 +1,18 @@
+import io
 import os
+import sys
 import tarfile
+
 import pytest
-from src.compression import compress_study
-import sys
+from pydicom.dataset import FileMetaDataset
+from pydicom.filewriter import write_file_meta_info
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, JPEGBaseline8Bit, generate_uid
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
 
+from src.compression import (DEFAULT_BLOCK_SIZE, compress_study, get_process_pool, is_precompressed, shutdown_pools,
+                             write_archive)
+
 
 @pytest.fixture
 def test_dir(tmpdir):
@@ -30,3 +37,89 @@ def test_compress_study(test_dir):
     with tarfile.open(compressed_file, "r:gz") as tar:
         tar_files = tar.getnames()
         assert "test_file.dcm" in tar_files
+
+
+def write_dicom_stub(path, transfer_syntax, payload):
+    # Preamble, prefix and file meta are all is_precompressed() looks at
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = transfer_syntax
+    with open(path, "wb") as f:
+        f.write(b"\x00" * 128 + b"DICM")
+        write_file_meta_info(f, meta)
+        f.write(payload)
+
+
+@pytest.fixture
+def study_dir(tmpdir):
+    series = tmpdir.mkdir("study").mkdir("series")
+    write_dicom_stub(str(series.join("raw.dcm")), ExplicitVRLittleEndian, b"\x01\x00" * 400000)
+    write_dicom_stub(str(series.join("jpeg.dcm")), JPEGBaseline8Bit, os.urandom(300000))
+    return tmpdir.join("study")
+
+
+def extract_all(archive_path, mode):
+    with tarfile.open(archive_path, mode) as tar:
+        return {member.name: tar.extractfile(member).read() for member in tar.getmembers() if member.isfile()}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_parallel_gzip_is_standard_tar_gz(study_dir, workers):
+    archive = str(study_dir) + ".tar.gz"
+
+    with open(archive, "wb") as output:
+        report = write_archive(str(study_dir), output, codec="gzip", workers=workers)
+
+    files = extract_all(archive, "r:gz")
+    assert files["./series/raw.dcm"] == study_dir.join("series", "raw.dcm").read_binary()
+    assert files["./series/jpeg.dcm"] == study_dir.join("series", "jpeg.dcm").read_binary()
+    assert report["bytes_in"] > DEFAULT_BLOCK_SIZE  # Spans several parallel blocks
+    assert report["bytes_out"] == os.path.getsize(archive)
+    assert report["ratio"] > 1 and report["mb_per_s"] > 0
+
+
+def test_process_pools_restart_after_shutdown():
+    pool = get_process_pool(2)
+    assert get_process_pool(2) is pool
+
+    shutdown_pools()
+
+    assert get_process_pool(2) is not pool
+    shutdown_pools()
+
+
+def test_store_only_codec(study_dir):
+    archive = str(study_dir) + ".tar"
+
+    with open(archive, "wb") as output:
+        write_archive(str(study_dir), output, codec="store")
+
+    assert "./series/raw.dcm" in extract_all(archive, "r:")
+
+
+def test_zstd_codec(study_dir):
+    zstandard = pytest.importorskip("zstandard")  # Optional dependency
+
+    output = io.BytesIO()
+    report = write_archive(str(study_dir), output, codec="zstd")
+
+    raw_tar = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(output.getvalue())).read()
+    assert report["codec"] == "zstd"
+    with tarfile.open(fileobj=io.BytesIO(raw_tar), mode="r:") as tar:
+        assert "./series/jpeg.dcm" in tar.getnames()
+
+
+def test_precompressed_instances_are_stored(study_dir):
+    assert is_precompressed(str(study_dir.join("series", "jpeg.dcm")))
+    assert not is_precompressed(str(study_dir.join("series", "raw.dcm")))
+
+    aware, naive = io.BytesIO(), io.BytesIO()
+    aware_report = write_archive(str(study_dir), aware, codec_aware=True)
+    write_archive(str(study_dir), naive, codec_aware=False)
+
+    # Stored deflate blocks of random data cost ~5 bytes per 64 KiB
+    jpeg_size = os.path.getsize(str(study_dir.join("series", "jpeg.dcm")))
+    assert aware_report["bytes_out"] < jpeg_size + 20000
+    with tarfile.open(fileobj=io.BytesIO(aware.getvalue()), mode="r:gz") as tar:
+        assert len(tar.getnames()) == 4
@@ -0,0 +1,95 @@
+import os
+import sys
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.destinations import PRIMARY, load_destinations, pending, route
+from src.dicom_server import DICOMServer
+from src.journal import StudyJournal
+
+
+def test_single_endpoint_becomes_the_primary_destination():
+    destinations = load_destinations({'api_endpoint': "http://dest", 'api_key': "key"})
+    assert [(d.name, d.api_endpoint, d.api_key, d.required) for d in destinations] == \
+        [(PRIMARY, "http://dest", "key", True)]
+    assert load_destinations({}) == []
+
+
+def test_destinations_are_routed_by_rules():
+    destinations = load_destinations({'api_key': "key", 'destinations': [
+        {'name': "cloud", 'api_endpoint': "http://cloud"},
+        {'name': "dr", 'api_endpoint': "http://dr", 'api_key': "dr-key", 'rules': [{'modality': ["CT", "MR"]}]},
+    ]})
+    assert destinations[0].api_key == "key" and destinations[1].api_key == "dr-key"
+    assert [d.name for d in route(destinations, {'modality': "CT"})] == ["cloud", "dr"]
+    assert [d.name for d in route(destinations, {'modality': "CR"})] == ["cloud"]
+    with pytest.raises(ValueError):
+        load_destinations({'destinations': [{'name': "a", 'api_endpoint': "http://a"},
+                                            {'name': "a", 'api_endpoint': "http://b"}]})
+
+
+def test_pending_destinations_lack_the_newest_instances():
+    destinations = load_destinations({'destinations': [{'name': "a", 'api_endpoint': "http://a"},
+                                                       {'name': "b", 'api_endpoint': "http://b"}]})
+    assert [d.name for d in pending(destinations, {'a': 10.0}, 5.0)] == ["b"]
+    assert [d.name for d in pending(destinations, {'a': 10.0, 'b': 20.0}, 15.0)] == ["a"]
+
+
+def test_journal_keeps_the_last_delivery_per_destination(tmpdir):
+    journal = StudyJournal(str(tmpdir.join("journal.sqlite")))
+    journal.record_delivery("1.2.3", "a", 10.0)
+    journal.record_delivery("1.2.3", "b", error="upload failed")
+    journal.record_delivery("1.2.3", "a", error="upload failed")
+    assert journal.deliveries("1.2.3") == {'a': 10.0, 'b': None}
+    journal.close()
+
+
+@pytest.mark.asyncio
+async def test_study_is_fanned_out_and_retried_only_where_it_failed(tmpdir):
+    received = {'good': 0, 'bad': 0}
+    failing = {'bad': True}
+
+    def handler(name):
+        async def upload(request):
+            await request.read()
+            if failing.get(name):
+                return web.json_response({"error": "unavailable"}, status=500)
+            received[name] += 1
+            return web.json_response({"message": "Success"})
+        return upload
+
+    servers = {}
+    for name in received:
+        app = web.Application()
+        app.router.add_post("/upload", handler(name))
+        servers[name] = TestServer(app)
+        await servers[name].start_server()
+
+    study = tmpdir.mkdir("data").mkdir("1.2.3").mkdir("1.2.3.4")
+    study.join("1.dcm").write(b"instance" * 100)
+    config = {
+        'storage': {'base_dir': str(tmpdir.join("data"))},
+        'transmission': {'api_key': "key", 'retry': {'max_attempts': 1}, 'destinations': [
+            {'name': name, 'api_endpoint': str(server.make_url("/upload"))} for name, server in servers.items()]},
+        'delete_after_send': True,
+    }
+    server = DICOMServer(config)
+    try:
+        assert not await server.push_study("1.2.3")
+        assert received == {'good': 1, 'bad': 0}
+        assert os.path.exists(str(study))
+        deliveries = server.journal.deliveries("1.2.3")
+        assert deliveries['good'] is not None and deliveries['bad'] is None
+
+        failing['bad'] = False
+        assert await server.push_study("1.2.3")
+        assert received == {'good': 1, 'bad': 1}
+        assert not os.path.exists(str(study))
+    finally:
+        await server.close()
+        for test_server in servers.values():
+            await test_server.close()
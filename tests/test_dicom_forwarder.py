@@ -0,0 +1,123 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEGBaseline8Bit, \
+    MRImageStorage
+from pynetdicom import AE, evt, AllStoragePresentationContexts
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.dicom_forwarder import ContextCache, DicomForwarder, supports
+from src.dicom_server import DICOMServer
+from benchmarks.synthetic import free_port, make_store_event
+from tests.conftest import make_dataset, save_dataset
+
+
+class StorageSCP:
+    """A downstream PACS that counts associations and instances; ``refuse`` answers those UIDs once with 0xA700."""
+
+    def __init__(self, refuse=()):
+        self.port = free_port()
+        self.associations = 0
+        self.stored = []
+        self.refuse = set(refuse)
+        self.ae = AE(ae_title="PACS")
+        self.ae.supported_contexts = AllStoragePresentationContexts
+        self.server = self.ae.start_server(("127.0.0.1", self.port), block=False, evt_handlers=[
+            (evt.EVT_C_STORE, self.on_store), (evt.EVT_REQUESTED, self.on_requested)])
+
+    def on_requested(self, event):
+        self.associations += 1
+
+    def on_store(self, event):
+        uid = event.request.AffectedSOPInstanceUID
+        if uid in self.refuse:
+            self.refuse.discard(uid)
+            return 0xA700
+        self.stored.append(uid)
+        return 0x0000
+
+    def close(self):
+        self.server.shutdown()
+
+
+def write_instance(directory, uid):
+    ds = make_dataset()
+    ds.SOPInstanceUID = uid
+    return save_dataset(os.path.join(str(directory), f"{uid}.dcm"), ds)
+
+
+def test_context_cache_proposes_recent_contexts_first():
+    cache = ContextCache()
+    cache.request(CTImageStorage, ExplicitVRLittleEndian)
+    cache.request(MRImageStorage, JPEGBaseline8Bit)
+    cache.request(CTImageStorage, ImplicitVRLittleEndian)  # Same uncompressed context as the first
+    assert cache.contexts() == [(CTImageStorage, (ExplicitVRLittleEndian, ImplicitVRLittleEndian)),
+                                (MRImageStorage, (JPEGBaseline8Bit,))]
+
+    accepted = [SimpleNamespace(abstract_syntax=CTImageStorage, transfer_syntax=[ImplicitVRLittleEndian])]
+    assert supports(accepted, CTImageStorage, ExplicitVRLittleEndian)
+    assert not supports(accepted, CTImageStorage, JPEGBaseline8Bit)
+    assert not supports(accepted, MRImageStorage, ExplicitVRLittleEndian)
+
+
+def test_instances_share_one_association_and_failures_are_retried(tmpdir):
+    scp = StorageSCP(refuse={"1.2.3.4.7"})
+    forwarder = DicomForwarder("pacs", "127.0.0.1", scp.port, ae_title="PACS", associations=1,
+                               retry={'max_attempts': 3, 'base_delay': 0.01})
+    try:
+        for n in range(5, 9):
+            forwarder.forward("1.2.3", write_instance(tmpdir, f"1.2.3.4.{n}"))
+        assert forwarder.wait("1.2.3", timeout=30)
+        assert forwarder.delivered("1.2.3")
+        assert sorted(scp.stored) == ["1.2.3.4.5", "1.2.3.4.6", "1.2.3.4.7", "1.2.3.4.8"]
+        assert scp.associations == 1
+    finally:
+        forwarder.close()
+        scp.close()
+
+
+def test_instance_given_up_on_fails_the_study(tmpdir):
+    scp = StorageSCP(refuse={"1.2.3.4.5"})
+    forwarder = DicomForwarder("pacs", "127.0.0.1", scp.port, ae_title="PACS", associations=2,
+                               retry={'max_attempts': 1})
+    try:
+        forwarder.forward("1.2.3", write_instance(tmpdir, "1.2.3.4.5"))
+        forwarder.forward("1.2.3", write_instance(tmpdir, "1.2.3.4.6"))
+        assert forwarder.idle("1.2.3").result(timeout=30)
+        assert not forwarder.delivered("1.2.3")
+
+        # The next push only re-sends what did not make it
+        forwarder.forward_study("1.2.3", [os.path.join(str(tmpdir), f"1.2.3.4.{n}.dcm") for n in (5, 6)])
+        assert forwarder.wait("1.2.3", timeout=30)
+        assert forwarder.delivered("1.2.3")
+        assert sorted(scp.stored) == ["1.2.3.4.5", "1.2.3.4.6"]
+    finally:
+        forwarder.close()
+        scp.close()
+
+
+@pytest.mark.asyncio
+async def test_server_relays_instances_as_they_are_stored(tmpdir):
+    scp = StorageSCP()
+    config = {'storage': {'base_dir': str(tmpdir), 'raw_write': True},
+              'transmission': {'destinations': [
+                  {'name': "pacs", 'dicom': {'host': "127.0.0.1", 'port': scp.port, 'ae_title': "PACS"}}]}}
+    server = DICOMServer(config)
+    try:
+        for n in (5, 6):
+            ds = make_dataset()
+            ds.SOPInstanceUID = f"1.2.3.4.{n}"
+            assert server.handle_store(make_store_event(ds, ExplicitVRLittleEndian)) == 0x0000
+        assert server.forwarders["pacs"].wait("1.2.3", timeout=30)
+        assert sorted(scp.stored) == ["1.2.3.4.5", "1.2.3.4.6"]
+
+        assert await server.push_study("1.2.3")
+        assert sorted(scp.stored) == ["1.2.3.4.5", "1.2.3.4.6"]  # Nothing sent twice
+        assert server.journal.deliveries("1.2.3")["pacs"] is not None
+    finally:
+        server.scheduler.close()
+        await server.close()
+        scp.close()
@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import os
+from io import BytesIO
+
+import pytest
+from pydicom import dcmread
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.dicom_io import read_routing_uids, encode_raw_instance
+from src.dicom_server import DICOMServer
+from benchmarks.synthetic import encode, make_store_event
+from tests.conftest import make_dataset
+
+
+@pytest.mark.parametrize("transfer_syntax", [
+    ImplicitVRLittleEndian, ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian])
+def test_read_routing_uids(transfer_syntax):
+    raw = encode(make_dataset(), transfer_syntax)
+    assert read_routing_uids(raw, transfer_syntax) == ("1.2.3", "1.2.3.4", "1.2.3.4.5")
+
+
+def test_encode_raw_instance_keeps_dataset_bytes():
+    event = make_store_event(make_dataset(), ExplicitVRLittleEndian)
+    raw = event.request.DataSet.getvalue()
+
+    encoded = encode_raw_instance(event.file_meta, raw)
+
+    assert encoded.endswith(raw)
+    ds = dcmread(BytesIO(encoded))
+    assert ds.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+    assert ds.SOPInstanceUID == "1.2.3.4.5"
+    assert ds.PixelData == bytes(range(32))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("transfer_syntax", [ImplicitVRLittleEndian, DeflatedExplicitVRLittleEndian])
+async def test_handle_store_raw_write(tmpdir, transfer_syntax):
+    config = {'storage': {'base_dir': str(tmpdir), 'raw_write': True}}
+    dicom_server = DICOMServer(config)
+    event = make_store_event(make_dataset(), transfer_syntax)
+
+    status = dicom_server.handle_store(event)
+    await asyncio.sleep(0)
+
+    assert status == 0x0000
+    file_path = os.path.join(str(tmpdir), "1.2.3", "1.2.3.4", "1.2.3.4.5.dcm")
+    with open(file_path, 'rb') as f:
+        assert f.read().endswith(event.request.DataSet.getvalue())
+    ds = dcmread(file_path)
+    assert ds.file_meta.TransferSyntaxUID == transfer_syntax
+    assert ds.PatientName == "TEST^RAW"
+    assert dicom_server.scheduler.pending() == 1
+    dicom_server.scheduler.close()
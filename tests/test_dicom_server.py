@@ -1,5 +1,6 @@
 from unittest.mock import patch, MagicMock
 from src.dicom_server import DICOMServer
+import asyncio
 import pytest
 import sys
 import os
@@ -13,23 +14,47 @@ def mock_dicom_event():
     event.dataset.StudyInstanceUID = "1.2.840.10008.1"
     event.dataset.SeriesInstanceUID = "1.2.840.10008.2"
     event.dataset.SOPInstanceUID = "1.2.840.10008.3"
+    event.request.DataSet.getvalue.return_value = b"encoded dataset"
     event.file_meta.TransferSyntaxUID = "1.2.840.10008.1.2.1"
     return event
 
 
-@patch("src.dicom_server.os.makedirs")
-@patch("src.dicom_server.asyncio.create_task")
-def test_handle_store(mock_create_task, mock_makedirs, mock_dicom_event):
+@pytest.mark.asyncio
+async def test_handle_store(mock_dicom_event, tmpdir):
     # Arrange
     config = {
-        'storage': {'base_dir': '/tmp'},
+        'storage': {'base_dir': str(tmpdir)},
     }
     dicom_server = DICOMServer(config)
 
     # Act
-    status = dicom_server.handle_store(mock_dicom_event)
+    with patch("os.makedirs", wraps=os.makedirs) as mock_makedirs:
+        status = dicom_server.handle_store(mock_dicom_event)
+        mock_dicom_event.dataset.SOPInstanceUID = "1.2.840.10008.4"
+        dicom_server.handle_store(mock_dicom_event)
+    await asyncio.sleep(0)  # Let the threadsafe touch run on the loop
 
     # Assert
     assert status == 0x0000  # DICOM success status
-    mock_makedirs.assert_called_once()
-    mock_create_task.assert_called_once()
+    series_dir = os.path.join(str(tmpdir), "1.2.840.10008.1", "1.2.840.10008.2")
+    assert os.path.isdir(series_dir)
+    # The series directory is created once and then cached by the writer
+    assert [call.args[0] for call in mock_makedirs.call_args_list].count(series_dir) == 1
+    assert dicom_server.scheduler.pending() == 1
+    assert dicom_server.journal.get("1.2.840.10008.1")['state'] == 'receiving'
+    dicom_server.scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_handle_store_save_failure(mock_dicom_event, tmpdir):
+    config = {
+        'storage': {'base_dir': str(tmpdir)},
+    }
+    dicom_server = DICOMServer(config)
+    mock_dicom_event.dataset.save_as.side_effect = OSError("disk full")
+
+    status = dicom_server.handle_store(mock_dicom_event)
+    await asyncio.sleep(0)
+
+    assert status == 0xC000
+    assert dicom_server.scheduler.pending() == 0
@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from src.dicom_server import DICOMServer
 import asyncio
 
@@ -11,49 +11,41 @@ def mock_dicom_event():
     event.dataset.StudyInstanceUID = "1.2.3.4.5"
     event.dataset.SeriesInstanceUID = "1.2.3.4.5.6"
     event.dataset.SOPInstanceUID = "1.2.3.4.5.6.7"
+    event.request.DataSet.getvalue.return_value = b"encoded dataset"
     return event
 
 
 @pytest.fixture
 def mock_transmission():
-    with patch('src.transmission.send_archive', new_callable=MagicMock) as mock_send:
-        # Simulate an asynchronous return by setting up a future
-        future = asyncio.Future()
-        future.set_result({"message": "Success"})  # Set the future result
-        mock_send.return_value = future  # Mock send_archive to return the future
+    with patch('src.dicom_server.send_archive', new_callable=AsyncMock) as mock_send:
+        mock_send.return_value = True
         yield mock_send
 
 
 @pytest.mark.asyncio
-@patch("src.dicom_server.os.makedirs")
-@patch("src.dicom_server.asyncio.create_task")
-async def test_end_to_end(mock_makedirs, mock_create_task, mock_dicom_event, mock_transmission):
+async def test_end_to_end(mock_dicom_event, mock_transmission, tmpdir):
     # Mock config
     config = {
-        'storage': {'base_dir': '/tmp'},
-        'transmission': {'api_endpoint': 'https://api.example.com', 'api_key': 'dummy_key'}
+        'storage': {'base_dir': str(tmpdir)},
+        'transmission': {'api_endpoint': 'https://api.example.com', 'api_key': 'dummy_key'},
+        'timeout': 0.05,
     }
 
     # Create the DICOMServer instance
     dicom_server = DICOMServer(config)
+    await dicom_server.start_outbound()
 
-    # Simulate receiving a DICOM study
-    status = dicom_server.handle_store(mock_dicom_event)
+    # Simulate receiving a DICOM study of several instances
+    for _ in range(3):
+        status = dicom_server.handle_store(mock_dicom_event)
+        assert status == 0x0000
 
-    # Ensure the study is processed and the file is transmitted successfully
-    assert status == 0x0000
-    mock_makedirs.assert_called_once()
+    # Wait for the study to go quiet and the push to complete
+    await asyncio.sleep(0.2)
+    await dicom_server.outbound.join()
 
-    # Simulate the asynchronous task returned by create_task
-    mock_task = asyncio.Future()
-    mock_task.set_result(None)  # Simulate the task completing successfully
-    mock_create_task.return_value = mock_task  # Mock create_task to return the future
-
-    # Ensure the task is awaited
-    await mock_create_task.return_value  # Await the mocked task
-
-    # Assert that create_task and transmission were called
-    mock_create_task.assert_called_once()
-
-    # Assert that send_archive was called once
+    # The whole study is pushed exactly once
     mock_transmission.assert_called_once()
+    assert mock_transmission.call_args.args[2] == f"{tmpdir}/1.2.3.4.5"
+    assert dicom_server.journal.get("1.2.3.4.5")['state'] == 'sent'
+    await dicom_server.close()
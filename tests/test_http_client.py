@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.http_client import HTTPClient, destination_key
+
+
+def test_destination_key_defaults_ports():
+    assert destination_key("https://api.example.com/upload") == "https://api.example.com:443"
+    assert destination_key("http://localhost:8080/a?b=c") == "http://localhost:8080"
+
+
+@pytest.mark.asyncio
+async def test_uploads_reuse_connections_and_respect_cap():
+    peers = set()
+    state = {'in_flight': 0, 'peak': 0}
+
+    async def upload(request):
+        peers.add(request.transport.get_extra_info('peername'))
+        state['in_flight'] += 1
+        state['peak'] = max(state['peak'], state['in_flight'])
+        await asyncio.sleep(0.02)
+        state['in_flight'] -= 1
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post("/upload", upload)
+    client = HTTPClient(per_destination=2)
+
+    async def post(url):
+        async with client.slot(url) as session:
+            assert 1 <= client.in_flight(url) <= 2
+            async with session.post(url, data=b"archive") as response:
+                assert response.status == 200
+
+    async with TestServer(app) as server:
+        url = str(server.make_url("/upload"))
+        await asyncio.gather(*(post(url) for _ in range(8)))
+        assert client.in_flight(url) == 0
+
+    await client.close()
+    assert state['peak'] == 2
+    assert len(peers) == 2  # Eight uploads over two kept-alive connections
@@ -0,0 +1,131 @@
+import hashlib
+import io
+import os
+import sys
+import tarfile
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.compression import write_archive
+from src.encryption import decrypt_file
+from src.incremental_archive import IncrementalArchiver
+from src.transmission import send_archive
+from tests.conftest import write_instance_file
+
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_archive_grows_with_each_instance(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir)
+    for n in range(3):
+        archiver.add("study", write_instance_file(study_path, f"{n}.dcm", b"instance %d" % n * 1000))
+
+    path, checksum = archiver.finalize("study")
+
+    assert path == os.path.join(base_dir, "study.tar.gz")
+    assert checksum == sha256(path)
+    assert not os.path.exists(path + ".partial")
+    expected = io.BytesIO()
+    write_archive(study_path, expected)
+    with tarfile.open(path) as tar, tarfile.open(fileobj=io.BytesIO(expected.getvalue())) as reference:
+        assert sorted(tar.getnames()) == sorted(reference.getnames())
+        assert tar.extractfile("./series/1.dcm").read() == b"instance 1" * 1000
+    # A retried push gets the same archive back
+    assert archiver.finalize("study") == (path, checksum)
+
+
+def test_identical_duplicate_is_skipped(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir)
+    file_path = write_instance_file(study_path, "1.dcm", b"same")
+    archiver.add("study", file_path)
+    assert archiver.add("study", write_instance_file(study_path, "1.dcm", b"same")).result() is False
+
+    path, _ = archiver.finalize("study")
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames().count("./series/1.dcm") == 1
+
+
+def test_changed_duplicate_falls_back_to_rebuild(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir)
+    archiver.add("study", write_instance_file(study_path, "1.dcm", b"first")).result()  # Archived before the change
+    archiver.add("study", write_instance_file(study_path, "1.dcm", b"second"))
+
+    assert archiver.finalize("study") is None
+    assert not os.path.exists(os.path.join(base_dir, "study.tar.gz.partial"))
+
+
+def test_restart_seeds_from_disk_and_drops_partials(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    write_instance_file(study_path, "1.dcm", b"before restart")
+    with open(os.path.join(base_dir, "study.tar.gz.partial"), 'wb') as f:
+        f.write(b"truncated")
+
+    archiver = IncrementalArchiver(base_dir)
+    assert not os.path.exists(os.path.join(base_dir, "study.tar.gz.partial"))
+    archiver.add("study", write_instance_file(study_path, "2.dcm", b"after restart"))
+    path, _ = archiver.finalize("study")
+
+    with tarfile.open(path) as tar:
+        assert {"./series/1.dcm", "./series/2.dcm"} <= set(tar.getnames())
+
+
+def test_late_instance_starts_a_new_archive(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir, {'codec': 'store'})
+    archiver.add("study", write_instance_file(study_path, "1.dcm", b"one"))
+    archiver.finalize("study")
+    archiver.add("study", write_instance_file(study_path, "2.dcm", b"two"))
+
+    path, _ = archiver.finalize("study")
+
+    with tarfile.open(path) as tar:
+        assert {"./series/1.dcm", "./series/2.dcm"} <= set(tar.getnames())
+
+
+def test_encrypted_incremental_archive(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir, encryption_key="secret")
+    archiver.add("study", write_instance_file(study_path, "1.dcm", b"private" * 100))
+
+    path, checksum = archiver.finalize("study")
+    assert path.endswith(".tar.gz.enc")
+    assert checksum == sha256(path)
+
+    decrypt_file(path, str(tmpdir.join("plain.tar.gz")), "secret")
+    with tarfile.open(str(tmpdir.join("plain.tar.gz"))) as tar:
+        assert tar.extractfile("./series/1.dcm").read() == b"private" * 100
+
+
+@pytest.mark.asyncio
+async def test_send_archive_uses_prebuilt_archive(tmpdir):
+    base_dir = str(tmpdir)
+    study_path = os.path.join(base_dir, "study")
+    archiver = IncrementalArchiver(base_dir)
+    archiver.add("study", write_instance_file(study_path, "1.dcm", b"data"))
+    archive = archiver.finalize("study")
+
+    with patch("src.transmission.compress_study", new_callable=AsyncMock) as mock_compress, \
+            patch("src.transmission.post_file", new_callable=AsyncMock) as mock_post:
+        delivered = await send_archive("http://dest/upload", "key", study_path,
+                                       archive=archive)
+
+    assert delivered is True
+    mock_compress.assert_not_called()
+    assert mock_post.call_args.args[2] == archive[0]
+    assert mock_post.call_args.kwargs['checksum'] == archive[1]
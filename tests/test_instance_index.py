@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.compression import write_archive
+from src.dicom_server import DICOMServer
+from src.instance_index import InstanceIndex, plan_delta
+from benchmarks.synthetic import make_store_event
+from tests.conftest import make_dataset, write_instance_file
+from pydicom.uid import ExplicitVRLittleEndian
+
+
+@pytest.fixture
+def index(tmpdir):
+    index = InstanceIndex(str(tmpdir.join("index.sqlite")))
+    yield index
+    index.close()
+
+
+def test_duplicate_needs_same_uid_and_content(index, tmpdir):
+    path = write_instance_file(str(tmpdir.join("study")), "1.dcm")
+    index.record("1.1", "study", "aaa", path)
+
+    assert index.is_duplicate("1.1", "aaa")
+    assert not index.is_duplicate("1.1", "bbb")
+    assert not index.is_duplicate("1.2", "aaa")
+    os.remove(path)
+    assert not index.is_duplicate("1.1", "aaa")  # Unsent and gone from disk: store it again
+
+
+def test_changed_instance_must_be_sent_again(index, tmpdir):
+    path = write_instance_file(str(tmpdir.join("study")), "1.dcm")
+    index.record("1.1", "study", "aaa", path)
+    index.mark_sent("study", stored_before=float('inf'))
+    index.record("1.1", "study", "aaa", path)
+    assert index.get("1.1")['sent'] == 1
+
+    index.record("1.1", "study", "bbb", path)
+    assert index.get("1.1")['sent'] == 0
+
+
+def test_plan_delta(index, tmpdir):
+    study_path = str(tmpdir.join("study"))
+    old = write_instance_file(study_path, "old.dcm")
+    index.record("1.1", "study", "aaa", old)
+    assert plan_delta(index, "study", study_path) is None
+
+    index.mark_sent("study", stored_before=float('inf'))
+    new = write_instance_file(study_path, "new.dcm")
+    index.record("1.2", "study", "bbb", new)
+    write_instance_file(study_path, "unindexed.dcm")
+
+    files, manifest = plan_delta(index, "study", study_path)
+
+    assert files == [os.path.join("series", "new.dcm"), os.path.join("series", "unindexed.dcm")]
+    assert manifest['previously_sent'] == 1
+    assert manifest['instances'][0] == {'path': os.path.join("series", "new.dcm"), 'sop_instance_uid': "1.2",
+                                        'sha256': hashlib.sha256(b"data").hexdigest()}
+
+
+def test_write_archive_with_files_and_manifest(tmpdir):
+    study_path = str(tmpdir.join("study"))
+    write_instance_file(study_path, "old.dcm")
+    write_instance_file(study_path, "new.dcm", b"new")
+    output = io.BytesIO()
+
+    write_archive(study_path, output, files=[os.path.join("series", "new.dcm")], manifest={'delta': True})
+
+    with tarfile.open(fileobj=io.BytesIO(output.getvalue())) as tar:
+        assert "./series/old.dcm" not in tar.getnames()
+        assert tar.extractfile("./series/new.dcm").read() == b"new"
+        assert json.load(tar.extractfile("./manifest.json")) == {'delta': True}
+
+
+@pytest.mark.asyncio
+async def test_resent_study_is_deduplicated_and_sent_as_delta(tmpdir):
+    config = {'storage': {'base_dir': str(tmpdir), 'raw_write': True},
+              'transmission': {'api_endpoint': "http://dest", 'api_key': "key"}}
+    server = DICOMServer(config)
+    first = make_dataset()
+
+    assert server.handle_store(make_store_event(first, ExplicitVRLittleEndian)) == 0x0000
+    with patch("src.dicom_server.send_archive", new_callable=AsyncMock, return_value=True) as mock_send:
+        assert await server.push_study("1.2.3")
+    assert mock_send.call_args.kwargs['delta'] is None
+
+    # The modality re-sends the study with one more instance
+    file_path = os.path.join(str(tmpdir), "1.2.3", "1.2.3.4", "1.2.3.4.5.dcm")
+    mtime = os.path.getmtime(file_path)
+    assert server.handle_store(make_store_event(first, ExplicitVRLittleEndian)) == 0x0000
+    assert os.path.getmtime(file_path) == mtime
+    second = make_dataset()
+    second.SOPInstanceUID = "1.2.3.4.6"
+    assert server.handle_store(make_store_event(second, ExplicitVRLittleEndian)) == 0x0000
+    assert server.journal.get("1.2.3")['instances'] == 2
+
+    with patch("src.dicom_server.send_archive", new_callable=AsyncMock, return_value=True) as mock_send:
+        assert await server.push_study("1.2.3")
+    files, manifest = mock_send.call_args.kwargs['delta']
+    assert files == [os.path.join("1.2.3.4", "1.2.3.4.6.dcm")]
+    assert manifest['previously_sent'] == 1
+
+    with patch("src.dicom_server.send_archive", new_callable=AsyncMock) as mock_send:
+        assert await server.push_study("1.2.3")
+    mock_send.assert_not_called()
+    await asyncio.sleep(0)
+    server.scheduler.close()
+    await server.close()
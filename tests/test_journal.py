@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.journal import StudyJournal, scan_spool
+from src.outbound import OutboundQueue
+from tests.conftest import make_study
+
+
+@pytest.fixture
+def journal(tmpdir):
+    journal = StudyJournal(str(tmpdir.join("journal.sqlite")))
+    yield journal
+    journal.close()
+
+
+def test_journal_survives_reopen(journal, tmpdir):
+    journal.record_instance("study-1")
+    journal.record_instance("study-1")
+    journal.set_state("study-1", "sending")
+    assert journal.add_attempt("study-1") == 1
+
+    reopened = StudyJournal(journal.path)
+    study = reopened.get("study-1")
+    reopened.close()
+
+    assert study['state'] == "sending"
+    assert study['instances'] == 2
+    assert study['attempts'] == 1
+
+
+def test_new_instance_gives_a_failed_study_a_fresh_start(journal):
+    journal.record_instance("study-1")
+    journal.add_attempt("study-1")
+    journal.set_state("study-1", "failed", "HTTP 500")
+
+    journal.record_instance("study-1")
+
+    study = journal.get("study-1")
+    assert (study['state'], study['attempts'], study['last_error']) == ("receiving", 0, None)
+
+
+def test_scan_spool_counts_instances(tmpdir):
+    make_study(tmpdir, "study-1", 3)
+    make_study(tmpdir, "study-2", 1)
+    tmpdir.join("study-1.tar.gz").write("archive")
+
+    assert scan_spool(str(tmpdir)) == {"study-1": 3, "study-2": 1}
+
+
+def test_recover_requeues_unfinished_work(journal, tmpdir):
+    spool = tmpdir.mkdir("spool")
+    for study_id in ("receiving", "sending", "sent", "unknown"):
+        make_study(spool, study_id, 2)
+    journal.record_instance("receiving")
+    journal.set_state("sending", "sending")
+    journal.set_state("sent", "sent")
+    journal.set_state("vanished", "ready")
+
+    queue = OutboundQueue(journal, send=None)
+    requeue, debounce = queue.recover(str(spool))
+
+    assert sorted(requeue) == ["sending", "unknown"]
+    assert debounce == ["receiving"]
+    assert journal.get("vanished")['state'] == "failed"
+    assert journal.get("unknown")['instances'] == 2
+
+
+@pytest.mark.asyncio
+async def test_outbound_queue_retries_then_fails(journal):
+    calls = []
+
+    async def send(study_id, on_state):
+        calls.append(study_id)
+        on_state("sending")
+        return False
+
+    queue = OutboundQueue(journal, send, workers=2, max_attempts=2, retry_delay=0.01)
+    queue.start()
+    queue.enqueue("study-1")
+    await asyncio.sleep(0.1)
+    await queue.join()
+    await queue.stop()
+
+    assert calls == ["study-1", "study-1"]
+    assert journal.get("study-1")['state'] == "failed"
+
+
+@pytest.mark.asyncio
+async def test_instances_received_during_a_send_are_never_marked_sent(journal):
+    states = []
+
+    async def send(study_id, on_state):
+        on_state("sending")
+        if not states:
+            journal.record_instance(study_id)  # Arrives mid-send; the debouncer has not fired yet
+        states.append(journal.get(study_id)['state'])
+        return True
+
+    journal.record_instance("study-1")
+    queue = OutboundQueue(journal, send, workers=1)
+    queue.start()
+    queue.enqueue("study-1")
+    await queue.join()
+    assert journal.get("study-1")['state'] == "receiving"
+
+    queue.enqueue("study-1")  # The debouncer fires
+    await queue.join()
+    await queue.stop()
+
+    assert states == ["receiving", "sending"]
+    assert journal.get("study-1")['state'] == "sent"
@@ -0,0 +1,66 @@
+import io
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.logger import RateLimitedLog, configure_logging, stop_logging
+
+
+def test_json_records_carry_extra_fields():
+    stream = io.StringIO()
+    configure_logging(json_format=True, stream=stream)
+    try:
+        logging.getLogger("bounce.test").info("upload done", extra={'span': 'upload', 'trace_id': 'abc'})
+    finally:
+        stop_logging()  # Drains the queue before returning
+
+    entry = json.loads(stream.getvalue().splitlines()[-1])
+    assert entry['message'] == "upload done"
+    assert (entry['level'], entry['logger']) == ("INFO", "bounce.test")
+    assert (entry['span'], entry['trace_id']) == ("upload", "abc")
+
+
+def test_records_are_written_by_the_listener_thread():
+    stream = io.StringIO()
+    configure_logging(stream=stream)
+    try:
+        logging.getLogger("bounce.test").warning("spool is full")
+    finally:
+        stop_logging()
+    assert "[WARNING] spool is full" in stream.getvalue()
+
+
+class ListLogger:
+    def __init__(self):
+        self.messages = []
+
+    def isEnabledFor(self, level):
+        return level >= logging.INFO
+
+    def log(self, level, message, **kwargs):
+        self.messages.append(message)
+
+
+def test_rate_limit_drops_excess_and_reports_it():
+    now = [0.0]
+    target = ListLogger()
+    log = RateLimitedLog(target, burst=2, interval=1.0, clock=lambda: now[0])
+    for n in range(5):
+        log.info('stored', f"Stored {n}")
+    log.info('duplicate', "Duplicate")  # Keys have their own quota
+    assert target.messages == ["Stored 0", "Stored 1", "Duplicate"]
+
+    now[0] = 1.0
+    log.info('stored', "Stored 5")
+    assert target.messages[-1] == "Stored 5 (3 similar messages suppressed)"
+
+
+def test_rate_limit_skips_disabled_levels():
+    target = ListLogger()
+    log = RateLimitedLog(target, burst=1)
+    log.log(logging.DEBUG, 'stored', "Stored")
+    log.info('stored', "Stored")
+    assert target.messages == ["Stored"]
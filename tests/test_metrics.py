@@ -0,0 +1,62 @@
+import os
+import sys
+import urllib.request
+
+import pytest
+from pydicom.uid import ExplicitVRLittleEndian
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import metrics
+from src.dicom_server import DICOMServer
+from benchmarks.synthetic import free_port, make_store_event
+from tests.conftest import make_dataset
+
+
+def sample(name, labels=None):
+    return metrics.REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+def test_bounded_label_folds_excess_values():
+    label = metrics.BoundedLabel(limit=2)
+    assert [label(v) for v in ("a", "b", "c", "a")] == ["a", "b", metrics.OTHER, "a"]
+
+
+@pytest.mark.asyncio
+async def test_handle_store_is_measured(tmpdir):
+    server = DICOMServer({'storage': {'base_dir': str(tmpdir), 'raw_write': True}})
+    event = make_store_event(make_dataset(), ExplicitVRLittleEndian)
+    stored = sample("bounce_instances_total", {'outcome': "stored"})
+    duplicates = sample("bounce_instances_total", {'outcome': "duplicate"})
+    received = sample("bounce_received_bytes_total")
+
+    server.handle_store(event)
+    server.handle_store(make_store_event(make_dataset(), ExplicitVRLittleEndian))
+
+    assert sample("bounce_instances_total", {'outcome': "stored"}) == stored + 1
+    assert sample("bounce_instances_total", {'outcome': "duplicate"}) == duplicates + 1
+    assert sample("bounce_received_bytes_total") == received + 2 * len(event.request.DataSet.getvalue())
+    assert sample("bounce_cstore_seconds_count", {'outcome': "stored"}) >= 1
+    server.scheduler.close()
+
+
+def test_compression_is_measured(tmpdir):
+    from src.compression import compress_study
+    study = tmpdir.mkdir("study")
+    study.join("1.dcm").write(b"x" * 10000)
+    before = sample("bounce_compression_bytes_total", {'codec': "gzip", 'direction': "in"})
+
+    compress_study(str(study), str(tmpdir.join("study.tar.gz")))
+
+    assert sample("bounce_compression_bytes_total", {'codec': "gzip", 'direction': "in"}) > before + 10000
+    assert sample("bounce_compression_ratio_count", {'codec': "gzip"}) >= 1
+
+
+def test_metrics_endpoint():
+    port = free_port()
+    assert metrics.start_metrics_server(port, "127.0.0.1")
+
+    body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+
+    assert "# TYPE bounce_cstore_seconds histogram" in body
+    assert "bounce_outbound_queue_depth" in body
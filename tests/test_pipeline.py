@@ -0,0 +1,66 @@
+import asyncio
+import os
+import sys
+import tarfile
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.pipeline import ASYNC, COMPRESS, PROCESS, Pipeline, Stage, run
+from src.transmission import compress_study
+
+
+@pytest.mark.asyncio
+async def test_full_stage_holds_back_its_callers():
+    stage = Stage("test", workers=1, queue=1)
+    release = asyncio.Event()
+    entered = []
+
+    async def work(n):
+        async with stage.slot():
+            entered.append(n)
+            await release.wait()
+
+    tasks = [asyncio.ensure_future(work(n)) for n in range(3)]
+    await asyncio.sleep(0.01)
+    assert entered == [0]
+    assert (stage.running, stage.waiting) == (1, 1)  # The third caller is not even queued
+    release.set()
+    await asyncio.gather(*tasks)
+    assert entered == [0, 1, 2]
+    assert (stage.running, stage.waiting) == (0, 0)
+    assert 0 < stage.utilization() <= 1
+    stage.close()
+
+
+@pytest.mark.asyncio
+async def test_stages_run_on_their_executor_kind():
+    pipeline = Pipeline({'upload': {'workers': 2}})
+    try:
+        assert pipeline['upload'].kind == ASYNC and pipeline['upload'].workers == 2
+
+        async def upload(value):
+            return value * 2
+
+        assert await pipeline.run('upload', upload, 21) == 42
+        assert await pipeline.run('checksum', sum, [1, 2, 3]) == 6
+        assert await run(None, 'io', sum, [1, 2]) == 3  # No pipeline: the loop's default executor
+        assert set(pipeline.stats()) == {'io', 'compress', 'checksum', 'upload'}
+    finally:
+        pipeline.close()
+    with pytest.raises(ValueError):
+        Pipeline({'decompress': {'workers': 1}})
+
+
+@pytest.mark.asyncio
+async def test_study_compresses_in_a_process_stage(tmpdir):
+    study = tmpdir.mkdir("1.2.3")
+    study.mkdir("series").join("1.dcm").write(b"instance" * 1000)
+    pipeline = Pipeline({COMPRESS: {'kind': PROCESS, 'workers': 1}})
+    try:
+        archive_path = await compress_study(str(study), pipeline=pipeline)
+    finally:
+        pipeline.close()
+    with tarfile.open(archive_path) as tar:
+        assert "./series/1.dcm" in tar.getnames()
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pynetdicom import AE
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.dicom_server import DICOMServer
+from src.retry import RetryPolicy
+from benchmarks.synthetic import free_port
+from tests.conftest import make_dataset
+
+
+def associate(port, deadline=30):
+    ae = AE()
+    ae.add_requested_context(make_dataset().SOPClassUID, ExplicitVRLittleEndian)
+    started = time.monotonic()
+    while time.monotonic() - started < deadline:
+        assoc = ae.associate("127.0.0.1", port)
+        if assoc.is_established:
+            return assoc
+        time.sleep(0.2)  # Receivers are still starting
+    raise RuntimeError("No receiver accepted the association")
+
+
+def send_instances(port, count):
+    assoc = associate(port)
+    statuses = []
+    try:
+        for _ in range(count):
+            ds = make_dataset()
+            ds.SOPInstanceUID = generate_uid()
+            ds.file_meta = FileMetaDataset()
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            statuses.append(assoc.send_c_store(ds).Status)
+    finally:
+        assoc.release()
+    return statuses
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason="needs SO_REUSEPORT")
+async def test_study_across_receiver_processes_is_uploaded_once(tmpdir):
+    port = free_port()
+    config = {
+        'dicom': {'host': '127.0.0.1', 'port': port, 'workers': 2},
+        'storage': {'base_dir': str(tmpdir), 'raw_write': True},
+        'transmission': {'api_endpoint': 'https://api.example.com', 'api_key': 'dummy_key'},
+        'timeout': 0.5,
+    }
+    server = DICOMServer(config)
+    with patch('src.dicom_server.send_archive', new_callable=AsyncMock, return_value=True) as mock_send:
+        await server.start_outbound()
+        server.start_in_thread()
+        try:
+            # Several associations, likely spread over both receivers, all for one study
+            loop = asyncio.get_running_loop()
+            with ThreadPoolExecutor(4) as pool:
+                results = await asyncio.gather(*[loop.run_in_executor(pool, send_instances, port, 5)
+                                                 for _ in range(4)])
+            assert all(status == 0x0000 for statuses in results for status in statuses)
+
+            deadline = time.monotonic() + 10
+            while not mock_send.called and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await server.outbound.join()
+        finally:
+            server.shutdown()
+            await server.close()
+
+    mock_send.assert_called_once()
+    assert mock_send.call_args.args[2] == f"{tmpdir}/1.2.3"
+    assert len(os.listdir(os.path.join(str(tmpdir), "1.2.3", "1.2.3.4"))) == 20
+
+
+@pytest.mark.asyncio
+async def test_reported_instance_is_recorded_again_after_a_failure(tmpdir):
+    config = {'storage': {'base_dir': str(tmpdir)}}
+    server = DICOMServer(config)
+    record = ("1.2.3", "1.2.3.4.5", "checksum", f"{tmpdir}/1.2.3/1.2.3.4/1.2.3.4.5.dcm", {'size': 10})
+    try:
+        with patch.object(server, 'instance_stored', side_effect=[False, True]) as instance_stored, \
+                patch('src.dicom_server.RECORD_RETRY', RetryPolicy(max_attempts=3, base_delay=0.01)):
+            server.on_receiver_event('stored', record)
+            deadline = time.monotonic() + 5
+            while instance_stored.call_count < 2 and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+        assert instance_stored.call_count == 2
+    finally:
+        server.scheduler.close()
+        await server.close()
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.scheduler import StudyScheduler
+
+
+@pytest.mark.asyncio
+async def test_fires_once_per_quiet_study():
+    fired = []
+    scheduler = StudyScheduler(asyncio.get_running_loop(), 0.05, fired.append)
+
+    for _ in range(100):
+        scheduler.touch("study-a")
+    scheduler.touch("study-b")
+    await asyncio.sleep(0.02)
+    scheduler.touch("study-a")  # Activity pushes study-a's deadline back
+
+    await asyncio.sleep(0.045)
+    assert fired == ["study-b"]
+
+    await asyncio.sleep(0.05)
+    assert fired == ["study-b", "study-a"]
+    assert scheduler.pending() == 0
+
+
+@pytest.mark.asyncio
+async def test_reschedule_and_cancel():
+    fired = []
+    loop = asyncio.get_running_loop()
+    scheduler = StudyScheduler(loop, 60, fired.append)
+
+    scheduler.touch("early")
+    scheduler.touch("cancelled")
+    scheduler.reschedule("early", loop.time())
+    scheduler.cancel("cancelled")
+    await asyncio.sleep(0.01)
+
+    assert fired == ["early"]
+    assert scheduler.pending() == 0
+    scheduler.close()
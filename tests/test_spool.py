@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+from unittest.mock import patch
+
+import pytest
+from pydicom.uid import ExplicitVRLittleEndian
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.chunked_upload import checkpoint_path
+from src.dicom_server import DICOMServer
+from src.spool import SpoolManager, study_of_archive
+from benchmarks.synthetic import make_store_event
+from tests.conftest import make_dataset, make_study
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+def test_study_of_archive():
+    assert study_of_archive("1.2.3.tar.gz") == "1.2.3"
+    assert study_of_archive("1.2.3.delta.tar.zst.enc") == "1.2.3"
+    assert study_of_archive("1.2.3.tar.gz.upload.json") == "1.2.3"
+    assert study_of_archive("notes.txt") is None
+
+
+def test_scan_counts_studies_and_archives(tmpdir):
+    base_dir = str(tmpdir)
+    make_study(base_dir, "1.1", content=b"x" * 100)
+    with open(os.path.join(base_dir, "1.1.tar.gz"), 'wb') as f:
+        f.write(b"a" * 100)
+    make_study(base_dir, "1.2", content=b"x" * 50)
+    spool = SpoolManager(base_dir, high_watermark=1000)
+    spool.scan(sent=["1.1"])
+
+    assert spool.used == 250
+    assert spool.studies["1.1"].sent and not spool.studies["1.2"].sent
+    spool.close()
+
+
+def test_full_spool_refuses_then_evicts_least_recently_used(tmpdir):
+    base_dir = str(tmpdir)
+    full_states = []
+    evicted = []
+    spool = SpoolManager(base_dir, high_watermark=300, low_watermark=150, on_full=full_states.append,
+                         on_evict=evicted.append)
+    for study_id in ("1.1", "1.2", "1.3"):
+        make_study(base_dir, study_id, content=b"x" * 100)
+        assert spool.admit(study_id, 100)
+    assert spool.full and full_states == [True]
+    assert not spool.admit("1.4", 10)
+
+    # Nothing has been delivered yet, so nothing can go
+    time.sleep(0.05)
+    assert evicted == []
+
+    sent_at = time.time()
+    spool.mark_sent("1.2", sent_at)
+    spool.mark_sent("1.1", sent_at)
+    wait_for(lambda: not spool.full)
+
+    assert evicted == ["1.2", "1.1"]  # Least recently used first, down to the low watermark
+    assert not os.path.exists(os.path.join(base_dir, "1.1"))
+    assert os.path.exists(os.path.join(base_dir, "1.3"))
+    assert spool.used == 100
+    assert full_states == [True, False]
+    assert spool.admit("1.4", 10)
+    spool.close()
+
+
+def test_study_receiving_again_is_not_evicted(tmpdir):
+    spool = SpoolManager(str(tmpdir), high_watermark=1000)
+    spool.admit("1.1", 100)
+    sent_at = time.time()
+    time.sleep(0.01)
+    spool.admit("1.1", 100)  # Arrived while the study was being sent
+    spool.mark_sent("1.1", sent_at)
+
+    assert not spool.studies["1.1"].sent
+    spool.close()
+
+
+def test_release_and_archive_tracking(tmpdir):
+    base_dir = str(tmpdir)
+    spool = SpoolManager(base_dir, high_watermark=1000)
+    spool.admit("1.1", 100)
+    archive = os.path.join(base_dir, "1.1.tar.gz")
+    with open(archive, 'wb') as f:
+        f.write(b"a" * 40)
+    spool.track_archives("1.1", [archive, os.path.join(base_dir, "1.1.delta.tar.gz")])
+    assert spool.used == 140
+
+    # Per-destination upload checkpoints count, and are evicted, with their archive
+    with open(checkpoint_path(archive, "https://dest/upload"), 'w') as f:
+        f.write("x" * 10)
+    spool.track_archives("1.1", [archive])
+    assert spool.used == 150
+    assert checkpoint_path(archive, "https://dest/upload") in spool.studies["1.1"].archives
+
+    spool.release("1.1")
+    assert spool.used == 50
+    spool.close()
+
+
+@pytest.mark.asyncio
+async def test_full_spool_answers_out_of_resources(tmpdir):
+    config = {'storage': {'base_dir': str(tmpdir), 'spool': {'high_watermark': 1}}}
+    server = DICOMServer(config)
+    await server.loop.run_in_executor(None, server.spool.scan, [])
+
+    assert server.handle_store(make_store_event(make_dataset(), ExplicitVRLittleEndian)) == 0x0000
+    ds = make_dataset()
+    ds.SOPInstanceUID = "1.2.3.4.6"
+    assert server.handle_store(make_store_event(ds, ExplicitVRLittleEndian)) == 0xA700
+    assert not os.path.exists(os.path.join(str(tmpdir), "1.2.3", "1.2.3.4", "1.2.3.4.6.dcm"))
+    server.scheduler.close()
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_resent_and_failed_instances_are_charged_once(tmpdir):
+    config = {'storage': {'base_dir': str(tmpdir), 'spool': {'high_watermark': 10 ** 9}}}
+    server = DICOMServer(config)
+    await server.loop.run_in_executor(None, server.spool.scan, [])
+
+    assert server.handle_store(make_store_event(make_dataset(), ExplicitVRLittleEndian)) == 0x0000
+    used = server.spool.used
+    ds = make_dataset()
+    ds.PatientName = "TEST^FIXED"  # A few bytes more, still smaller than the file with its meta
+    assert server.handle_store(make_store_event(ds, ExplicitVRLittleEndian)) == 0x0000  # Replaces the first
+    assert server.spool.used == used
+
+    ds.SOPInstanceUID = "1.2.3.4.6"
+    with patch.object(server.writer, 'submit', side_effect=OSError("disk gone")):
+        assert server.handle_store(make_store_event(ds, ExplicitVRLittleEndian)) == 0xC000
+    assert server.spool.used == used
+    server.scheduler.close()
+    await server.close()
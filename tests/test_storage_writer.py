@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+import metrics
+from src.storage_writer import ENQUEUE, FSYNC, WRITE, StorageWriter
+
+
+def payload(data):
+    def write(f):
+        f.write(data)
+    return write
+
+
+@pytest.mark.parametrize("durability", [ENQUEUE, WRITE, FSYNC])
+def test_writes_land_under_every_policy(tmpdir, durability):
+    writer = StorageWriter(durability=durability, io_threads=2, fsync_interval=0.01)
+    written = []
+    paths = [os.path.join(str(tmpdir), "study", "series", f"{n}.dcm") for n in range(20)]
+    futures = [writer.submit(path, payload(b"x" * n), lambda path=path: written.append(path)) for n, path in
+               enumerate(paths)]
+    for future in futures:
+        writer.wait(future)
+    writer.close()
+
+    assert sorted(written) == sorted(paths)
+    for n, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            assert f.read() == b"x" * n
+    # No temp files are left behind
+    assert sorted(os.listdir(os.path.dirname(paths[0]))) == sorted(os.path.basename(p) for p in paths)
+
+
+def test_directory_cache_keeps_the_most_recently_used(tmpdir):
+    writer = StorageWriter(io_threads=1, max_dirs=2)
+    for series in ("a", "b", "a", "c"):
+        writer.wait(writer.submit(os.path.join(str(tmpdir), series, "1.dcm"), payload(b"x")))
+    writer.close()
+
+    assert list(writer.dirs) == [os.path.join(str(tmpdir), series) for series in ("a", "c")]
+
+
+def test_file_appears_only_once_complete(tmpdir):
+    path = os.path.join(str(tmpdir), "series", "1.dcm")
+    release = threading.Event()
+
+    def write(f):
+        f.write(b"partial")
+        assert not os.path.exists(path)
+        release.wait(5)
+        f.write(b" done")
+
+    writer = StorageWriter(durability=WRITE, io_threads=1, fsync_interval=None)
+    future = writer.submit(path, write)
+    release.set()
+    writer.wait(future, timeout=5)
+    writer.close()
+
+    with open(path, 'rb') as f:
+        assert f.read() == b"partial done"
+
+
+def test_failed_write_fails_the_future_and_cleans_up(tmpdir):
+    def write(f):
+        raise OSError("disk full")
+
+    writer = StorageWriter(durability=WRITE, io_threads=1)
+    future = writer.submit(os.path.join(str(tmpdir), "series", "1.dcm"), write)
+    with pytest.raises(OSError):
+        writer.wait(future, timeout=5)
+    writer.close()
+
+    assert os.listdir(os.path.join(str(tmpdir), "series")) == []
+
+
+@pytest.mark.parametrize("durability", [ENQUEUE, WRITE])
+def test_on_written_failure_fails_the_future(tmpdir, durability):
+    def on_written():
+        raise RuntimeError("journal unavailable")
+
+    failures = metrics.REGISTRY.get_sample_value("bounce_write_failures_total", {'step': "on_written"}) or 0
+    writer = StorageWriter(durability=durability, io_threads=1)
+    future = writer.submit(os.path.join(str(tmpdir), "1.dcm"), payload(b"x"), on_written)
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+    writer.close()
+    # Counted even when nobody waits for the future
+    assert metrics.REGISTRY.get_sample_value("bounce_write_failures_total", {'step': "on_written"}) == failures + 1
+
+
+def test_directory_recreated_after_removal(tmpdir):
+    series = os.path.join(str(tmpdir), "study", "series")
+    writer = StorageWriter(io_threads=1)
+    writer.wait(writer.submit(os.path.join(series, "1.dcm"), payload(b"1")), timeout=5)
+    os.remove(os.path.join(series, "1.dcm"))
+    os.rmdir(series)
+
+    writer.wait(writer.submit(os.path.join(series, "2.dcm"), payload(b"2")), timeout=5)
+    writer.close()
+
+    assert os.listdir(series) == ["2.dcm"]
+
+
+def test_group_commit_syncs_each_directory_once(tmpdir):
+    series = os.path.join(str(tmpdir), "series")
+    writer = StorageWriter(durability=FSYNC, io_threads=4, fsync_interval=0.2)
+    with patch("src.storage_writer._fsync") as fsync:
+        futures = [writer.submit(os.path.join(series, f"{n}.dcm"), payload(b"x")) for n in range(10)]
+        for future in futures:
+            writer.wait(future, timeout=5)
+        writer.close()
+
+    synced = [call.args[0] for call in fsync.call_args_list]
+    assert synced.count(series) < 10  # Directories are synced per batch, not per file
+    assert len([path for path in synced if path != series]) == 10
+
+
+def test_unknown_policy_rejected():
+    with pytest.raises(ValueError):
+        StorageWriter(durability="sometimes")
+    with pytest.raises(ValueError):
+        StorageWriter(durability=FSYNC, fsync_interval=0)
@@ -0,0 +1,84 @@
+import asyncio
+import io
+import os
+import sys
+import tarfile
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.streaming import stream_from_thread, stream_study_archive
+from src.transmission import send_archive
+
+
+@pytest.fixture
+def study_dir(tmpdir):
+    series = tmpdir.mkdir("study").mkdir("series")
+    for i in range(3):
+        series.join(f"{i}.dcm").write_binary(os.urandom(64 * 1024))
+    return tmpdir.join("study")
+
+
+@pytest.mark.asyncio
+async def test_stream_study_archive_is_valid_tar_gz(study_dir):
+    chunks = [chunk async for chunk in stream_study_archive(str(study_dir), chunk_size=4096, max_queued=2)]
+
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks)), mode="r:gz") as tar:
+        names = tar.getnames()
+    assert "./series/0.dcm" in names
+    assert len([name for name in names if name.endswith(".dcm")]) == 3
+
+
+@pytest.mark.asyncio
+async def test_stream_from_thread_propagates_producer_errors():
+    def produce(fileobj):
+        fileobj.write(b"partial")
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        async for _ in stream_from_thread(produce, chunk_size=2):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_stream_from_thread_aborts_producer_when_consumer_stops():
+    finished = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def produce(fileobj):
+        try:
+            while True:
+                fileobj.write(b"x" * 16)
+        finally:
+            loop.call_soon_threadsafe(finished.set)
+
+    stream = stream_from_thread(produce, chunk_size=16, max_queued=1)
+    await stream.__anext__()
+    await stream.aclose()
+
+    await asyncio.wait_for(finished.wait(), timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_send_archive_streaming_leaves_no_archive_on_disk(study_dir):
+    received = {}
+
+    async def upload(request):
+        form = await request.post()
+        received['archive'] = form['file'].file.read()
+        received['chunked'] = request.headers.get('Transfer-Encoding') == 'chunked'
+        return web.json_response({"message": "Success"})
+
+    app = web.Application()
+    app.router.add_post("/upload", upload)
+    async with TestServer(app) as server:
+        await send_archive(str(server.make_url("/upload")), "dummy_key", str(study_dir), streaming=True)
+
+    assert received['chunked']
+    assert not os.path.exists(f"{study_dir}.tar.gz")
+    with tarfile.open(fileobj=io.BytesIO(received['archive']), mode="r:gz") as tar:
+        assert "./series/2.dcm" in tar.getnames()
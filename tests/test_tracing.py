@@ -0,0 +1,66 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.profiler import SamplingProfiler
+from src.tracing import correlation_id, span
+
+
+def test_correlation_id_is_stable_and_short():
+    assert correlation_id("1.2.3") == correlation_id("1.2.3") != correlation_id("1.2.4")
+    assert len(correlation_id("1.2.3")) == 16
+    assert correlation_id(None) is None
+
+
+def test_span_logs_duration_with_study_fields(caplog):
+    caplog.set_level(logging.DEBUG, logger="tracing")
+    with span("compress", "1.2.3", codec="zstd") as trace:
+        time.sleep(0.01)
+    record = caplog.records[-1]
+    assert (record.span, record.study_id, record.codec) == ("compress", "1.2.3", "zstd")
+    assert record.trace_id == correlation_id("1.2.3")
+    assert record.duration_ms >= 10
+    assert trace.started is not None
+
+
+def test_span_marks_errors(caplog):
+    caplog.set_level(logging.INFO, logger="tracing")
+    try:
+        with span("upload", "1.2.3"):
+            raise ConnectionError("reset")
+    except ConnectionError:
+        pass
+    assert caplog.records[-1].error == "ConnectionError"
+
+
+def test_per_instance_spans_are_quiet_at_info(caplog):
+    caplog.set_level(logging.INFO, logger="tracing")
+    with span("write", "1.2.3", logging.DEBUG):
+        pass
+    assert not caplog.records
+
+
+def test_sampling_profiler_sees_busy_threads():
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=busy_loop, name="Busy")
+    worker.start()
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    folded = profiler.stop()
+    stop.set()
+    worker.join()
+
+    assert not profiler.running and profiler.samples > 0
+    busy = [line for line in folded if line.startswith("Busy;")]
+    assert busy and "busy_loop" in busy[0]
+    assert int(busy[0].rsplit(" ", 1)[1]) > 0
@@ -0,0 +1,126 @@
+import os
+import sys
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.uid import (CTImageStorage, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, RLELossless,
+                         generate_uid)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.transcoder import CHANGED, NOT_SMALLER, SKIPPED, TRANSCODED, Transcoder, available_syntaxes, transcode_file
+from tests.conftest import save_dataset
+
+
+def write_instance(path, pixels=True, transfer_syntax=ExplicitVRLittleEndian):
+    ds = Dataset()
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = generate_uid()
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = "1.2.3.4"
+    ds.Modality = "CT"
+    ds.PatientName = "TEST^TRANSCODE"
+    ds.ImageComments = "A comment that deflates well " * 20
+    if pixels:
+        # Smooth 12-bit data in 16-bit words, like most CT
+        ds.Rows = ds.Columns = 64
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+        ds.PixelData = (np.arange(64 * 64, dtype=np.uint16).reshape(64, 64) // 8).tobytes()
+    save_dataset(path, ds, transfer_syntax)
+    return ds
+
+
+def test_pixel_data_is_rle_encoded_losslessly(tmpdir):
+    path = str(tmpdir.join("ct.dcm"))
+    original = write_instance(path)
+    size = os.path.getsize(path)
+
+    report = transcode_file(path, [RLELossless])
+
+    assert report['outcome'] == TRANSCODED and report['modality'] == "CT"
+    assert report['bytes_in'] == size > report['bytes_out'] == os.path.getsize(path)
+    transcoded = dcmread(path)
+    assert transcoded.file_meta.TransferSyntaxUID == RLELossless
+    assert transcoded.SOPInstanceUID == original.SOPInstanceUID
+    assert np.array_equal(transcoded.pixel_array, original.pixel_array)
+
+
+def test_instance_without_pixels_is_deflated(tmpdir):
+    path = str(tmpdir.join("sr.dcm"))
+    write_instance(path, pixels=False)
+    report = transcode_file(path, [RLELossless, DeflatedExplicitVRLittleEndian])
+    assert report['outcome'] == TRANSCODED
+    assert dcmread(path).ImageComments.startswith("A comment")
+
+
+def test_compressed_syntaxes_are_skipped(tmpdir):
+    path = str(tmpdir.join("deflated.dcm"))
+    write_instance(path, pixels=False, transfer_syntax=DeflatedExplicitVRLittleEndian)
+    before = open(path, 'rb').read()
+    assert transcode_file(path, [RLELossless, DeflatedExplicitVRLittleEndian])['outcome'] == SKIPPED
+    assert open(path, 'rb').read() == before
+
+
+def test_larger_result_keeps_the_original(tmpdir):
+    path = str(tmpdir.join("noise.dcm"))
+    ds = write_instance(path)
+    ds.PixelData = np.random.default_rng(0).integers(0, 65535, 64 * 64, dtype=np.uint16).tobytes()
+    ds.BitsStored, ds.HighBit = 16, 15
+    ds.save_as(path, enforce_file_format=True)
+    before = open(path, 'rb').read()
+    assert transcode_file(path, [RLELossless])['outcome'] == NOT_SMALLER
+    assert open(path, 'rb').read() == before
+
+
+def test_instance_resent_while_encoding_is_not_overwritten(tmpdir):
+    import src.transcoder
+
+    path = str(tmpdir.join("ct.dcm"))
+    write_instance(path)
+    encode = src.transcoder._encode
+
+    def resend_then_encode(raw, syntax):
+        resent = write_instance(path)  # Stored again by the C-STORE handler meanwhile
+        resent_uid.append(resent.SOPInstanceUID)
+        return encode(raw, syntax)
+
+    resent_uid = []
+    with patch("src.transcoder._encode", side_effect=resend_then_encode):
+        assert transcode_file(path, [RLELossless])['outcome'] == CHANGED
+    assert dcmread(path).SOPInstanceUID == resent_uid[0]
+    assert dcmread(path).file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+    assert os.listdir(str(tmpdir)) == ["ct.dcm"]
+
+
+def test_unknown_or_missing_codecs():
+    with pytest.raises(ValueError):
+        available_syntaxes(["lzw"])
+    assert RLELossless in available_syntaxes(["auto"])
+    assert DeflatedExplicitVRLittleEndian in available_syntaxes(["deflate"])
+
+
+def test_transcoder_reports_per_modality(tmpdir):
+    transcoder = Transcoder(["rle"], workers=1, modalities=["CT"])
+    assert transcoder.wants("CT") and not transcoder.wants("MR")
+    done = []
+    try:
+        for n in range(3):
+            path = str(tmpdir.join(f"{n}.dcm"))
+            write_instance(path)
+            transcoder.submit("1.2.3", path, on_done=done.append)
+        idle = transcoder.idle("1.2.3")
+        transcoder.wait("1.2.3", timeout=60)
+        assert idle.result(timeout=1)
+        assert transcoder.idle("4.5.6").done()  # Nothing queued
+    finally:
+        transcoder.close()
+
+    assert len(done) == 3  # Callbacks have run by the time wait returns
+    summary = transcoder.summary()["CT"]
+    assert summary['instances'] == 3 and summary['ratio'] > 1
+    assert summary['cpu_seconds'] > 0
@@ -1,29 +1,169 @@
+import asyncio
+import hashlib
+import os
+import sys
+
 import pytest
-from unittest.mock import patch
-from src.transmission import send_archive
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.send_archive import send_archive
+from src.retry import (CircuitBreaker, CircuitOpenError, RetryPolicy, TransmissionError, call_with_retry,
+                       classify_status, parse_retry_after)
+from src.transmission import FatalError, post_file
 
 
-# Mocking an API response for successful transmission
-@pytest.fixture
-def mock_successful_response():
-    with patch('requests.post') as mock_post:
-        mock_post.return_value.status_code = 200
-        mock_post.return_value.json.return_value = {"message": "Success"}
-        yield mock_post
+# A local destination that answers with a scripted sequence of statuses
+@pytest_asyncio.fixture
+async def destination():
+    state = {'statuses': [], 'requests': []}
+
+    async def upload(request):
+        body = await request.read()
+        state['requests'].append({'headers': request.headers, 'body': body})
+        status = state['statuses'].pop(0) if state['statuses'] else 200
+        if status != 200:
+            return web.Response(status=status, headers={'Retry-After': '0'})
+        return web.json_response({"message": "Success"})
+
+    app = web.Application()
+    app.router.add_post("/upload", upload)
+    async with TestServer(app) as server:
+        state['url'] = str(server.make_url("/upload"))
+        yield state
 
 
 @pytest.mark.asyncio
-async def test_send_archive_success(mock_successful_response, tmpdir):
+async def test_send_archive_success(destination, tmpdir):
     # Arrange
     test_file = tmpdir.join("encrypted_file.enc")
     test_file.write("Encrypted content")
 
-    api_endpoint = "https://example.com/upload"
     api_key = "dummy_api_key"
-    checksum = "dummy_checksum"
+    checksum = hashlib.sha256(b"Encrypted content").hexdigest()
 
     # Act
-    response = await send_archive(api_endpoint, api_key, str(test_file), checksum)  # Await the async function
+    response = await send_archive(destination['url'], api_key, str(test_file), checksum)  # Await the async function
 
     # Assert
     assert response['message'] == "Success"
+    request = destination['requests'][0]
+    assert request['body'] == b"Encrypted content"
+    assert request['headers']['X-Checksum'] == checksum
+
+
+@pytest.mark.asyncio
+async def test_send_archive_retries_retryable_statuses(destination, tmpdir):
+    test_file = tmpdir.join("encrypted_file.enc")
+    test_file.write("Encrypted content")
+    destination['statuses'] = [503, 429]
+
+    response = await send_archive(destination['url'], "key", str(test_file), None)
+
+    assert response['message'] == "Success"
+    assert len(destination['requests']) == 3
+    assert all(r['body'] == b"Encrypted content" for r in destination['requests'])
+
+
+@pytest.mark.asyncio
+async def test_fatal_status_is_not_retried(destination, tmpdir):
+    test_file = tmpdir.join("encrypted_file.enc")
+    test_file.write("Encrypted content")
+    destination['statuses'] = [401]
+
+    with pytest.raises(FatalError):
+        await send_archive(destination['url'], "key", str(test_file), None)
+    assert len(destination['requests']) == 1
+
+
+@pytest.mark.asyncio
+async def test_multipart_checksum_is_computed_while_streaming(tmpdir):
+    fields = {}
+
+    async def upload(request):
+        form = await request.post()
+        fields['file'] = form['file'].file.read()
+        fields['checksum'] = form['checksum']
+        return web.json_response({"message": "Success"})
+
+    app = web.Application()
+    app.router.add_post("/upload", upload)
+    archive = tmpdir.join("study.tar.gz")
+    archive.write_binary(os.urandom(300000))
+    async with TestServer(app) as server:
+        await post_file(str(server.make_url("/upload")), "key", str(archive), multipart=True)
+
+    assert fields['file'] == archive.read_binary()
+    assert fields['checksum'] == hashlib.sha256(archive.read_binary()).hexdigest()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after(None) is None
+
+
+def test_full_jitter_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+    assert all(0 <= policy.backoff(attempt) <= 10 for attempt in range(20))
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_opens_and_fails_fast():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+    calls = []
+
+    async def failing(attempt):
+        calls.append(attempt)
+        raise ConnectionResetError("reset by peer")
+
+    async def no_sleep(delay):
+        pass
+
+    with pytest.raises(CircuitOpenError):
+        await call_with_retry(failing, RetryPolicy(max_attempts=5), breaker, sleep=no_sleep)
+    assert len(calls) == 2
+
+    # After the reset timeout a single trial call is allowed through
+    now[0] = 31.0
+
+    async def succeeding(attempt):
+        return "ok"
+
+    assert await call_with_retry(succeeding, RetryPolicy(), breaker) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_local_failures_and_cancelled_trials_leave_the_circuit_open():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+    breaker.record_failure()
+    now[0] = 31.0
+
+    async def unreadable(attempt):
+        raise FileNotFoundError("archive.tar.gz")
+
+    with pytest.raises(FileNotFoundError):  # Not wrapped, and not taken for an answer from the destination
+        await call_with_retry(unreadable, RetryPolicy(), breaker)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    async def hanging(attempt):
+        await asyncio.sleep(10)
+
+    trial = asyncio.ensure_future(call_with_retry(hanging, RetryPolicy(), breaker))
+    await asyncio.sleep(0)
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+
+    async def rejected(attempt):
+        raise classify_status(400)
+
+    with pytest.raises(TransmissionError):  # The next trial goes through and gets an answer
+        await call_with_retry(rejected, RetryPolicy(), breaker)
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+
+from src.journal import StudyJournal
+from src.upload_scheduler import BandwidthShaper, SchedulingPolicy, TokenBucket, UploadQueue
+
+POLICY = {
+    'classes': ['stat', 'normal', 'bulk'],
+    'default_class': 'normal',
+    'rules': [
+        {'class': 'stat', 'calling_ae': 'ED_CR', 'modality': ['CR', 'DX'], 'max_bytes': 50_000_000},
+        {'class': 'bulk', 'min_bytes': 1_000_000_000},
+    ],
+    'shares': {'CT_A': 3},
+}
+
+
+async def drain(queue):
+    order = []
+    while queue.qsize():
+        order.append(await queue.get())
+        queue.task_done()
+    return order
+
+
+def test_policy_classifies_by_ae_modality_and_size():
+    policy = SchedulingPolicy(POLICY)
+    assert policy.classify({'calling_ae': 'ED_CR', 'modality': 'CR', 'bytes': 10_000_000}) == 0
+    assert policy.classify({'calling_ae': 'ED_CR', 'modality': 'CT', 'bytes': 10_000_000}) == 1
+    assert policy.classify({'calling_ae': 'MR_1', 'modality': 'MR', 'bytes': 4_000_000_000}) == 2
+    assert policy.classify({}) == 1
+
+
+def test_policy_rejects_unknown_class():
+    with pytest.raises(ValueError):
+        SchedulingPolicy({'classes': ['a'], 'rules': [{'class': 'b'}]})
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_goes_first():
+    queue = UploadQueue(SchedulingPolicy(POLICY))
+    queue.put_nowait("mr", {'calling_ae': 'MR_1', 'modality': 'MR', 'bytes': 4_000_000_000})
+    queue.put_nowait("ct", {'calling_ae': 'CT_A', 'modality': 'CT', 'bytes': 200_000_000})
+    queue.put_nowait("cr", {'calling_ae': 'ED_CR', 'modality': 'CR', 'bytes': 10_000_000})
+
+    assert await drain(queue) == ["cr", "ct", "mr"]
+
+
+@pytest.mark.asyncio
+async def test_fair_share_across_calling_aes():
+    queue = UploadQueue(SchedulingPolicy(POLICY))
+    for n in range(6):
+        queue.put_nowait(f"a{n}", {'calling_ae': 'CT_A', 'bytes': 100})
+    for n in range(2):
+        queue.put_nowait(f"b{n}", {'calling_ae': 'CT_B', 'bytes': 100})
+
+    order = await drain(queue)
+    # CT_A has three times CT_B's share, so CT_B is not stuck behind CT_A's whole backlog
+    assert order.index("b0") < 4 and order.index("b1") < 8
+    assert order[:4].count("b0") + order[:4].count("b1") == 1
+
+
+@pytest.mark.asyncio
+async def test_reconfigure_reorders_queued_studies():
+    queue = UploadQueue(SchedulingPolicy(POLICY))
+    queue.put_nowait("ct", {'calling_ae': 'CT_A', 'modality': 'CT', 'bytes': 100})
+    queue.put_nowait("us", {'calling_ae': 'US_1', 'modality': 'US', 'bytes': 100})
+
+    queue.configure(SchedulingPolicy({**POLICY, 'rules': [{'class': 'stat', 'modality': 'US'}]}))
+    assert await drain(queue) == ["us", "ct"]
+    await asyncio.wait_for(queue.join(), 1)
+
+
+def test_token_bucket_paces_to_rate():
+    now = [0.0]
+    bucket = TokenBucket(rate=1000, clock=lambda: now[0])
+    assert bucket.reserve(1000) == 0  # The initial burst
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    now[0] = 1.5
+    assert bucket.reserve(500) == 0
+
+
+@pytest.mark.asyncio
+async def test_shaper_limits_body_rate():
+    shaper = BandwidthShaper({'global': 1_000_000, 'destinations': {'http://sink/upload': 200_000}})
+
+    async def body():
+        for _ in range(5):
+            yield b"x" * 50_000
+
+    started = time.monotonic()
+    chunks = [chunk async for chunk in shaper.shape("http://sink/upload", body())]
+    assert len(chunks) == 5
+    assert time.monotonic() - started >= 0.2  # 250 kB at 200 kB/s after a 200 kB burst
+
+
+def test_unlimited_shaper_passes_body_through():
+    body = object()
+    assert BandwidthShaper().shape("http://sink/upload", body) is body
+
+
+def test_journal_keeps_scheduling_attributes(tmpdir):
+    journal = StudyJournal(str(tmpdir.join("journal.sqlite")))
+    journal.record_instance("1.2.3", size=100, calling_ae="ED_CR", modality="CR")
+    journal.record_instance("1.2.3", size=50)
+    entry = journal.get("1.2.3")
+    assert (entry['bytes'], entry['calling_ae'], entry['modality'], entry['instances']) == (150, "ED_CR", "CR", 2)
+    journal.close()